@@ -0,0 +1,293 @@
+"""
+渲染基准测试 (无需显示器)
+
+直接调用 nii_viewer.SliceRenderer 的真实渲染代码，在合成体数据上逐阶段计时:
+normalize_mri / get_slice_view_axis / create_overlay / create_diff_overlay /
+process_zoom_pan / adjust_ras_physical_aspect / process_ras_view
+
+用法:
+    python src/bench_render.py                                  # 运行并打印结果
+    python src/bench_render.py --save-baseline bench.json       # 保存基线
+    python src/bench_render.py --baseline bench.json            # 与基线对比，退化超过阈值时返回码为 1
+    python src/bench_render.py --sizes 256x256x64,512x512x200 --labels 2,8 --repeats 100
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from nii_viewer import SliceRenderer, intensity_range
+
+DEFAULT_SIZES = "256x256x64,512x512x128"
+DEFAULT_LABELS = "2,8"
+STAGES = (
+    "normalize_mri",
+    "get_slice_view_axis:R",
+    "get_slice_view_axis:A",
+    "get_slice_view_axis:S",
+    "create_overlay",
+    "create_diff_overlay",
+    "process_zoom_pan",
+    "process_zoom_pan:zoom2",
+    "adjust_ras_physical_aspect",
+    "process_ras_view",
+)
+
+
+def make_volume(shape, n_labels, seed=0):
+    """
+    生成合成病例: 带平滑梯度与噪声的强度图，以及若干椭球组成的 GT / Pred
+    Pred 由 GT 的椭球整体平移得到，使 diff 叠加有真实的 FP/FN 区域
+    """
+    rng = np.random.default_rng(seed)
+    x, y, z = (np.linspace(-1, 1, n, dtype=np.float32) for n in shape)
+    xx, yy, zz = np.meshgrid(x, y, z, indexing="ij", sparse=True)
+    mri = (1000 * (1 - 0.5 * (xx ** 2 + yy ** 2)) + 200 * zz).astype(np.float64)
+    mri = mri + rng.normal(0, 50, shape)
+
+    gt = np.zeros(shape, dtype=np.int8)
+    pred = np.zeros(shape, dtype=np.int8)
+    for label in range(1, n_labels + 1):
+        center = rng.uniform(-0.5, 0.5, 3)
+        radius = rng.uniform(0.15, 0.35, 3)
+        shift = rng.uniform(-0.05, 0.05, 3)
+        gt[((xx - center[0]) / radius[0]) ** 2 + ((yy - center[1]) / radius[1]) ** 2
+           + ((zz - center[2]) / radius[2]) ** 2 <= 1] = label
+        c = center + shift
+        pred[((xx - c[0]) / radius[0]) ** 2 + ((yy - c[1]) / radius[1]) ** 2
+             + ((zz - c[2]) / radius[2]) ** 2 <= 1] = label
+    return mri, pred, gt
+
+
+def make_renderer(mri, pred, gt, voxel_sizes):
+    renderer = SliceRenderer()
+    g_min, g_max = intensity_range(mri)
+    renderer.current_case_data = {
+        'mri': mri,
+        'pred': pred,
+        'gt': gt,
+        'global_min': g_min,
+        'global_max': g_max
+    }
+    renderer.current_voxel_sizes = voxel_sizes
+    return renderer
+
+
+def stage_calls(renderer, display_constraints):
+    """
+    每个阶段返回 call(i)，i 为迭代序号，用于轮换切片位置
+    各阶段的输入在循环外准备好，只计该阶段本身的耗时
+    """
+    data = renderer.current_case_data
+    mri, pred, gt = data['mri'], data['pred'], data['gt']
+    nx, ny, nz = mri.shape
+
+    def s_index(i):
+        return (nz // 4 + i) % nz
+
+    mri_views = [renderer.get_slice_view(mri, z) for z in range(nz)]
+    pred_views = [renderer.get_slice_view(pred, z) for z in range(nz)]
+    gt_views = [renderer.get_slice_view(gt, z) for z in range(nz)]
+    overlay = renderer.create_overlay(mri_views[nz // 2], gt_views[nz // 2], True)
+    ras_overlay = renderer.create_overlay(
+        renderer.get_slice_view_axis(mri, "R", nx // 2), renderer.get_slice_view_axis(gt, "R", nx // 2), True)
+
+    def zoom_pan(zoom):
+        def call(i):
+            renderer.zoom_level = zoom
+            try:
+                renderer.process_zoom_pan(overlay, display_constraints)
+            finally:
+                renderer.zoom_level = 1.0
+        return call
+
+    calls = {
+        "normalize_mri": lambda i: renderer.normalize_mri(mri_views[s_index(i)]),
+        # 视图本身不复制数据，这里物化为连续数组以反映跨步读取的真实代价
+        "get_slice_view_axis:R": lambda i: np.ascontiguousarray(
+            renderer.get_slice_view_axis(mri, "R", (nx // 4 + i) % nx)),
+        "get_slice_view_axis:A": lambda i: np.ascontiguousarray(
+            renderer.get_slice_view_axis(mri, "A", (ny // 4 + i) % ny)),
+        "get_slice_view_axis:S": lambda i: np.ascontiguousarray(
+            renderer.get_slice_view_axis(mri, "S", s_index(i))),
+        "create_overlay": lambda i: renderer.create_overlay(mri_views[s_index(i)], gt_views[s_index(i)], True),
+        "create_diff_overlay": lambda i: renderer.create_diff_overlay(
+            mri_views[s_index(i)], pred_views[s_index(i)], gt_views[s_index(i)]),
+        "process_zoom_pan": zoom_pan(1.0),
+        "process_zoom_pan:zoom2": zoom_pan(2.0),
+        "adjust_ras_physical_aspect": lambda i: renderer.adjust_ras_physical_aspect(ras_overlay, "R"),
+        "process_ras_view": lambda i: renderer.process_ras_view(
+            ras_overlay, "R", display_constraints, Image.Resampling.NEAREST),
+    }
+    return calls
+
+
+def measure(call, repeats, warmup=3):
+    """
+    返回 (耗时列表 ms, tracemalloc 峰值 KB)；计时与内存统计分开运行，互不干扰
+    tracemalloc 统计 Python 与 numpy 的分配，PIL 内部的图像缓冲不计入
+    """
+    for i in range(warmup):
+        call(i)
+    times = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        call(i)
+        times.append((time.perf_counter() - t0) * 1000)
+
+    tracemalloc.start()
+    try:
+        call(0)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak / 1024
+
+
+def summarize(times, peak_kb):
+    arr = np.asarray(times)
+    return {
+        "p50": float(np.percentile(arr, 50)),
+        "p95": float(np.percentile(arr, 95)),
+        "p99": float(np.percentile(arr, 99)),
+        "mean": float(arr.mean()),
+        "peak_kb": float(peak_kb)
+    }
+
+
+def parse_size(text):
+    parts = tuple(int(v) for v in text.lower().split("x"))
+    if len(parts) != 3 or min(parts) <= 0:
+        raise argparse.ArgumentTypeError(f"无效尺寸: {text} (应为 XxYxZ)")
+    return parts
+
+
+def run_suite(sizes, label_counts, repeats, display_constraints, voxel_sizes, stages=None):
+    results = {}
+    for shape in sizes:
+        for n_labels in label_counts:
+            key = f"{shape[0]}x{shape[1]}x{shape[2]}_L{n_labels}"
+            print(f"[{key}] 生成合成数据...", file=sys.stderr)
+            mri, pred, gt = make_volume(shape, n_labels)
+            renderer = make_renderer(mri, pred, gt, voxel_sizes)
+            calls = stage_calls(renderer, display_constraints)
+            results[key] = {}
+            for stage in STAGES:
+                if stages and stage not in stages:
+                    continue
+                times, peak_kb = measure(calls[stage], repeats)
+                results[key][stage] = summarize(times, peak_kb)
+    return results
+
+
+def compare(results, baseline, metric, threshold, min_delta_ms):
+    """
+    与基线逐阶段比较，返回退化列表 [(case, stage, base, new, ratio)]
+    变慢超过 threshold (比例) 且绝对差超过 min_delta_ms 时视为退化，避免亚毫秒级噪声误报
+    """
+    regressions = []
+    for case, stages in results.items():
+        base_stages = baseline.get("results", {}).get(case)
+        if not base_stages:
+            continue
+        for stage, stats in stages.items():
+            base = base_stages.get(stage)
+            if not base:
+                continue
+            old, new = base[metric], stats[metric]
+            ratio = new / old if old > 0 else float("inf")
+            if ratio > 1 + threshold and new - old > min_delta_ms:
+                regressions.append((case, stage, old, new, ratio))
+    return regressions
+
+
+def print_table(results, baseline=None, metric="p50"):
+    base_results = (baseline or {}).get("results", {})
+    header = f"{'case':<22} {'stage':<28} {'p50':>8} {'p95':>8} {'p99':>8} {'peakKB':>9}"
+    if baseline:
+        header += f" {'base ' + metric:>10} {'ratio':>7}"
+    print(header)
+    print("-" * len(header))
+    for case, stages in results.items():
+        for stage, st in stages.items():
+            line = f"{case:<22} {stage:<28} {st['p50']:8.3f} {st['p95']:8.3f} {st['p99']:8.3f} {st['peak_kb']:9.1f}"
+            base = base_results.get(case, {}).get(stage)
+            if base:
+                ratio = st[metric] / base[metric] if base[metric] > 0 else float("inf")
+                line += f" {base[metric]:10.3f} {ratio:7.2f}"
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="NIfTI Viewer 渲染基准测试 (无需显示器)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help=f"合成体数据尺寸，逗号分隔 (默认 {DEFAULT_SIZES})")
+    parser.add_argument("--labels", default=DEFAULT_LABELS,
+                        help=f"标签数量，逗号分隔 (默认 {DEFAULT_LABELS})")
+    parser.add_argument("--repeats", type=int, default=50, help="每阶段计时次数 (默认 50)")
+    parser.add_argument("--display", default="900x700", help="显示区域尺寸 WxH (默认 900x700)")
+    parser.add_argument("--spacing", default="0.8,0.8,3.0", help="体素间距 x,y,z (默认 0.8,0.8,3.0)")
+    parser.add_argument("--stages", default="", help="只运行指定阶段，逗号分隔")
+    parser.add_argument("--baseline", help="基线 JSON，给出时与之比较")
+    parser.add_argument("--save-baseline", help="将本次结果保存为基线 JSON")
+    parser.add_argument("--metric", default="p50", choices=("p50", "p95", "p99", "mean"),
+                        help="比较所用的统计量 (默认 p50)")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="允许的变慢比例，超过即判定退化 (默认 0.2 即 20%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=0.05,
+                        help="绝对差低于该值时不判定退化 (默认 0.05 ms)")
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(s) for s in args.sizes.split(",") if s]
+    label_counts = [int(v) for v in args.labels.split(",") if v]
+    disp_w, disp_h = (int(v) for v in args.display.lower().split("x"))
+    voxel_sizes = tuple(float(v) for v in args.spacing.split(","))
+    stages = {s for s in args.stages.split(",") if s}
+    unknown = stages - set(STAGES)
+    if unknown:
+        parser.error(f"未知阶段: {', '.join(sorted(unknown))}")
+
+    results = run_suite(sizes, label_counts, args.repeats, (disp_w, disp_h), voxel_sizes, stages)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_table(results, baseline, args.metric)
+
+    if args.save_baseline:
+        payload = {
+            "meta": {
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "repeats": args.repeats,
+                "display": [disp_w, disp_h],
+                "spacing": list(voxel_sizes),
+                "created": time.strftime("%Y-%m-%d %H:%M:%S")
+            },
+            "results": results
+        }
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(payload, f, indent=2, ensure_ascii=False)
+        print(f"\n基线已保存: {args.save_baseline}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.metric, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f"\n性能退化 ({args.metric} 变慢超过 {args.threshold:.0%}):")
+            for case, stage, old, new, ratio in regressions:
+                print(f"  {case} {stage}: {old:.3f} ms -> {new:.3f} ms (x{ratio:.2f})")
+            return 1
+        print(f"\n未发现性能退化 ({args.metric}, 阈值 {args.threshold:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
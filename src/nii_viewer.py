@@ -1,12 +1,2637 @@
+import bisect
+import io
+import json
+import math
+import multiprocessing
 import os
+import queue
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import tkinter as tk
-from tkinter import filedialog, ttk, messagebox
+from tkinter import filedialog, font as tkfont, ttk, messagebox
 import numpy as np
 import nibabel as nib
 from PIL import Image, ImageTk
 
-class NiiViewerApp:
+
+def neighbor_offsets_3d(connectivity=6):
+    """返回 3D 邻域偏移 (dx, dy, dz) 列表，connectivity 取 6 或 26"""
+    offsets = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                order = abs(dx) + abs(dy) + abs(dz)
+                if order == 0:
+                    continue
+                if connectivity == 6 and order != 1:
+                    continue
+                offsets.append((dx, dy, dz))
+    return offsets
+
+
+def _union_find_labels(n_nodes, edges_u, edges_v):
+    """向量化并查集：按边合并节点，返回每个节点所属连通分量的根 (最小节点号)"""
+    labels = np.arange(n_nodes, dtype=np.int64)
+    if edges_u.size == 0:
+        return labels
+    while True:
+        lu = labels[edges_u]
+        lv = labels[edges_v]
+        pending = lu != lv
+        if not pending.any():
+            return labels
+        # 挂接：较大的根指向较小的根，不会形成环
+        np.minimum.at(labels, np.maximum(lu, lv)[pending], np.minimum(lu, lv)[pending])
+        # 指针跳跃，压缩到根
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+
+def _padded_runs(binary):
+    """外围补一圈 False 后展平，返回 (padded_shape, flat, starts, ends)：沿最后一轴各前景游程的首/尾位置"""
+    padded = np.pad(np.asarray(binary, dtype=bool), 1, mode="constant", constant_values=False)
+    flat = padded.reshape(-1)
+    # 补边保证游程不会跨行，相邻两行之间至少隔一个 False
+    starts = np.flatnonzero(flat[1:] & ~flat[:-1]) + 1
+    ends = np.flatnonzero(flat[:-1] & ~flat[1:])
+    return padded.shape, flat, starts, ends
+
+
+def label_runs_3d(binary, connectivity=6):
+    """
+    基于游程 (沿最后一轴的连续前景段) 的向量化 3D 连通域标记
+    只在游程之间建立邻接关系，图规模与游程数而非体素数成正比
+    :return: (padded_flat, starts, ends, run_labels)
+        padded_flat: 外围补一圈 False 后展平的前景
+        starts/ends: 每个游程首/尾体素在 padded_flat 中的位置
+        run_labels: 每个游程所属连通分量 (同一分量共享最小游程号)
+    """
+    padded_shape, flat, starts, ends = _padded_runs(binary)
+
+    stride_x = padded_shape[1] * padded_shape[2]
+    stride_y = padded_shape[2]
+    # 只取半数方向 (无向边)，同一行内的 z 邻接已由游程本身覆盖
+    if connectivity == 6:
+        directions = [(1, 0, 0), (0, 1, 0)]
+    else:
+        directions = [(dx, dy, dz) for dx, dy in ((1, 0), (0, 1), (1, 1), (1, -1)) for dz in (-1, 0, 1)]
+
+    run_index = np.arange(starts.size, dtype=np.int64)
+    edges_u = []
+    edges_v = []
+    for dx, dy, dz in directions:
+        offset = dx * stride_x + dy * stride_y + dz
+        # 两个游程重叠区间的第一个位置，必为其中一个游程的起点，因此每对只需检查起点
+        cand = starts + offset
+        hit = flat[cand]
+        edges_u.append(run_index[hit])
+        edges_v.append(np.searchsorted(starts, cand[hit], side="right") - 1)
+        cand = starts - offset
+        hit = flat[cand]
+        edges_u.append(np.searchsorted(starts, cand[hit], side="right") - 1)
+        edges_v.append(run_index[hit])
+
+    run_labels = _union_find_labels(starts.size, np.concatenate(edges_u), np.concatenate(edges_v))
+    return padded_shape, flat, starts, ends, run_labels
+
+
+def _paint_runs(padded_shape, starts, ends):
+    """将选中的游程还原为 (去掉补边的) 3D bool mask"""
+    size = int(np.prod(padded_shape))
+    delta = np.zeros(size + 1, dtype=np.int8)
+    delta[starts] = 1
+    delta[ends + 1] -= 1
+    mask = np.cumsum(delta[:-1], dtype=np.int8).astype(bool).reshape(padded_shape)
+    return mask[1:-1, 1:-1, 1:-1]
+
+
+FLOOD_FILL_MAX_RUNS = 8_000_000 # 3D 区域生长允许的游程数上限，超出时多为噪声阈值化后的破碎前景
+
+
+def flood_fill_3d(binary, seed, connectivity=6, max_runs=FLOOD_FILL_MAX_RUNS):
+    """
+    3D 种子连通域提取
+    从种子所在游程向外逐层扩展邻接游程 (广度优先)，只访问与种子连通的部分，
+    不为整卷建立邻接图；内存只与游程数成正比
+    :param binary: 3D bool array, True 表示可连通体素
+    :param seed: (x, y, z) 种子体素坐标
+    :param connectivity: 6 或 26 邻域
+    :param max_runs: 游程数上限，超出时抛出 ValueError (前景过于破碎，如噪声阈值化)
+    :return: 与 binary 同形状的 bool mask
+    """
+    binary = np.asarray(binary, dtype=bool)
+    if not binary[seed]:
+        return np.zeros(binary.shape, dtype=bool)
+
+    padded_shape, _, starts, ends = _padded_runs(binary)
+    if starts.size > max_runs:
+        raise ValueError(f"前景过于破碎 ({starts.size} 个游程，上限 {max_runs})，请减小容差或先做平滑")
+    seed_flat = np.ravel_multi_index(tuple(int(c) + 1 for c in seed), padded_shape)
+    seed_run = np.searchsorted(starts, seed_flat, side="right") - 1
+
+    stride_x = padded_shape[1] * padded_shape[2]
+    stride_y = padded_shape[2]
+    if connectivity == 6:
+        offsets = [dx * stride_x + dy * stride_y for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))]
+        reach = 0
+    else:
+        offsets = [dx * stride_x + dy * stride_y for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+        reach = 1 # 26 邻域允许 z 方向错开一个体素
+
+    visited = np.zeros(starts.size, dtype=bool)
+    visited[seed_run] = True
+    frontier = np.array([seed_run], dtype=np.int64)
+    while frontier.size:
+        found = []
+        for offset in offsets:
+            # 相邻行中与 [start - reach, end + reach] 重叠的游程是连续的一段：[first, last)
+            first = np.searchsorted(ends, starts[frontier] + offset - reach, side="left")
+            last = np.searchsorted(starts, ends[frontier] + offset + reach, side="right")
+            counts = np.maximum(last - first, 0)
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            # 把各段 [first, last) 展开为游程号
+            begin = np.cumsum(counts) - counts
+            found.append(np.arange(total) - np.repeat(begin - first, counts))
+        if not found:
+            break
+        candidates = np.concatenate(found)
+        frontier = np.unique(candidates[~visited[candidates]])
+        visited[frontier] = True
+    return _paint_runs(padded_shape, starts[visited], ends[visited])
+
+
+def foreground_box(binary):
+    """3D 前景外接框 (slice 三元组)，无前景时返回 None；只遍历整卷两次"""
+    xy = binary.any(axis=2)
+    xs = np.flatnonzero(xy.any(axis=1))
+    if xs.size == 0:
+        return None
+    ys = np.flatnonzero(xy.any(axis=0))
+    zs = np.flatnonzero(binary.any(axis=(0, 1)))
+    return slice(xs[0], xs[-1] + 1), slice(ys[0], ys[-1] + 1), slice(zs[0], zs[-1] + 1)
+
+
+def component_sizes(binary, connectivity=26):
+    """
+    3D 连通域体素数 (降序)
+    先裁剪到前景外接框再做游程标记，每个分量的体素数为其游程长度之和 (一次 bincount)
+    """
+    binary = np.asarray(binary, dtype=bool)
+    box = foreground_box(binary)
+    if box is None:
+        return np.zeros(0, dtype=np.int64)
+    _, _, starts, ends, run_labels = label_runs_3d(binary[box], connectivity)
+    sizes = np.bincount(run_labels, weights=ends - starts + 1).astype(np.int64)
+    return np.sort(sizes[sizes > 0])[::-1]
+
+
+def label_component_stats(labels, values, voxel_ml, connectivity=26):
+    """
+    逐标签体积与连通域统计
+    :param values: 需要统计的前景标签值
+    :return: {label: {'ml': 体积, 'n': 连通域数, 'largest_frac': 最大连通域体素占比}}
+    """
+    stats = {}
+    for value in values:
+        sizes = component_sizes(labels == value, connectivity)
+        total = int(sizes.sum())
+        stats[value] = {'ml': total * voxel_ml, 'n': int(sizes.size),
+                        'largest_frac': float(sizes[0] / total) if total else 0.0}
+    return stats
+
+
+def _envelope_min_1d(f, spacing=1.0):
+    """
+    一维下包络 (Felzenszwalb-Huttenlocher) 距离变换，对所有行同时向量化
+    :param f: (M, n) 初值，特征点为 0，其余为 inf 或上一轴得到的平方距离
+    :return: d[m, p] = min_q f[m, q] + (spacing * (p - q))^2
+    """
+    n_rows, n = f.shape
+    out = np.full((n_rows, n), np.inf)
+    rows_valid = np.isfinite(f).any(axis=1)
+    if not rows_valid.any():
+        return out
+
+    fv = f[rows_valid]
+    m = fv.shape[0]
+    s2 = float(spacing) ** 2
+    v = np.zeros((m, n), dtype=np.int64)       # 下包络中各抛物线的顶点位置
+    z = np.empty((m, n + 1), dtype=np.float64)  # 相邻抛物线的分界点
+    k = np.full(m, -1, dtype=np.int64)          # 每行下包络中最后一条抛物线的序号
+
+    # 1. 构造下包络：逐列推进，列内对所有行向量化
+    for q in range(n):
+        fq = fv[:, q]
+        cand = np.flatnonzero(np.isfinite(fq))
+        if cand.size == 0:
+            continue
+        started = k[cand] >= 0
+        first = cand[~started]
+        if first.size:
+            k[first] = 0
+            v[first, 0] = q
+            z[first, 0] = -np.inf
+            z[first, 1] = np.inf
+        act = cand[started]
+        while act.size:
+            kk = k[act]
+            vk = v[act, kk]
+            sq = ((fq[act] + s2 * q * q) - (fv[act, vk] + s2 * vk * vk)) / (2.0 * s2 * (q - vk))
+            pop = sq <= z[act, kk]
+            keep = ~pop
+            if keep.any():
+                rows_keep = act[keep]
+                kn = kk[keep] + 1
+                k[rows_keep] = kn
+                v[rows_keep, kn] = q
+                z[rows_keep, kn] = sq[keep]
+                z[rows_keep, kn + 1] = np.inf
+            act = act[pop]
+            k[act] -= 1
+
+    # 2. 按分界点读出每个位置的最小值
+    rows = np.arange(m)
+    j = np.zeros(m, dtype=np.int64)
+    res = np.empty((m, n), dtype=np.float64)
+    for p in range(n):
+        while True:
+            adv = z[rows, j + 1] < p
+            if not adv.any():
+                break
+            j[adv] += 1
+        vj = v[rows, j]
+        res[:, p] = s2 * (p - vj) ** 2 + fv[rows, vj]
+    out[rows_valid] = res
+    return out
+
+
+def distance_transform_sq(features, spacing=None, axes=None):
+    """
+    精确欧氏距离变换 (返回平方距离)，支持各向异性体素间距
+    :param features: bool array, True 为特征点 (距离为 0)
+    :param spacing: 各轴体素间距，默认全为 1
+    :param axes: 参与计算的轴 (默认全部)，其余轴上的各层相互独立
+    """
+    features = np.asarray(features, dtype=bool)
+    if spacing is None:
+        spacing = (1.0,) * features.ndim
+    if axes is None:
+        axes = range(features.ndim)
+
+    dist = np.where(features, 0.0, np.inf)
+    for ax in axes:
+        moved = np.moveaxis(dist, ax, -1)
+        shape = moved.shape
+        res = _envelope_min_1d(moved.reshape(-1, shape[-1]), spacing[ax])
+        dist = np.moveaxis(res.reshape(shape), -1, ax)
+    return dist
+
+
+def signed_distance(mask, spacing=None, axes=None):
+    """有符号距离图：前景外为到前景的距离 (正)，前景内为到背景的距离 (负)"""
+    mask = np.asarray(mask, dtype=bool)
+    outside = np.sqrt(distance_transform_sq(mask, spacing, axes))
+    inside = np.sqrt(distance_transform_sq(~mask, spacing, axes))
+    return outside - inside
+
+
+def _nearest_feature_sq_1d(features, axis, spacing=1.0):
+    """沿一轴到最近特征点的平方距离：前向/后向两次累积扫描，无逐列循环"""
+    moved = np.moveaxis(features, axis, -1)
+    n = moved.shape[-1]
+    idx = np.arange(n)
+    far = 2 * n + 2
+    before = np.maximum.accumulate(np.where(moved, idx, -far), axis=-1)
+    after = np.minimum.accumulate(np.where(moved, idx, far)[..., ::-1], axis=-1)[..., ::-1]
+    steps = np.minimum(idx - before, after - idx)
+    dist = np.where(steps <= n, (steps * float(spacing)) ** 2, np.inf)
+    return np.moveaxis(dist, -1, axis)
+
+
+def distance_at_points(features, points, spacing=None, chunk=4096):
+    """
+    各查询点到最近特征点的欧氏距离 (3D，支持各向异性间距)
+    与 distance_transform_sq 同为按轴分解的精确距离：第一轴用累积扫描，第二轴用下包络，
+    最后一轴只在查询点所在的行上直接取最小值，查询点稀疏 (如表面) 时省去一整轮下包络
+    :param points: (k, 3) 体素坐标
+    """
+    features = np.asarray(features, dtype=bool)
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 3)
+    if spacing is None:
+        spacing = (1.0,) * 3
+    if points.shape[0] == 0:
+        return np.zeros(0)
+    # 扫描轴取最短的轴，其余两轴保持原顺序
+    first = int(np.argmin(features.shape))
+    order = [first] + [ax for ax in range(3) if ax != first]
+    feats = np.transpose(features, order)
+    points = points[:, order]
+    sp = [float(spacing[ax]) for ax in order]
+
+    dist = _nearest_feature_sq_1d(feats, 0, sp[0])
+    moved = np.moveaxis(dist, 1, -1)
+    shape = moved.shape
+    dist = np.moveaxis(_envelope_min_1d(moved.reshape(-1, shape[-1]), sp[1]).reshape(shape), -1, 1)
+
+    coords = np.arange(dist.shape[2]) * sp[2]
+    out = np.empty(points.shape[0])
+    for start in range(0, points.shape[0], chunk):
+        p = points[start:start + chunk]
+        rows = dist[p[:, 0], p[:, 1]]
+        out[start:start + chunk] = (rows + (coords - p[:, 2:3] * sp[2]) ** 2).min(axis=1)
+    return np.sqrt(out)
+
+
+def surface_voxels(mask):
+    """6 邻域边界体素 (体外视为背景)"""
+    padded = np.pad(mask, 1)
+    inner = padded[1:-1, 1:-1, 1:-1].copy()
+    for axis in range(3):
+        for shift in (0, 2):
+            index = [slice(1, -1)] * 3
+            index[axis] = slice(shift, shift + mask.shape[axis])
+            inner &= padded[tuple(index)]
+    return mask & ~inner
+
+
+def surface_distances(a, b, spacing=None):
+    """
+    两个 3D 掩码表面体素之间的双向距离 (mm)
+    只在两者并集的外接框内计算：框外两者都为空，裁剪不影响结果
+    :return: (a 表面各点到 b 表面的距离, b 表面各点到 a 表面的距离)；任一为空时返回 None
+    """
+    box = foreground_box(a | b)
+    if box is None or not a.any() or not b.any():
+        return None
+    surf_a = surface_voxels(a[box])
+    surf_b = surface_voxels(b[box])
+    return (distance_at_points(surf_b, np.argwhere(surf_a), spacing),
+            distance_at_points(surf_a, np.argwhere(surf_b), spacing))
+
+
+def surface_metrics(pred, gt, spacing=None, labels=(1, 2), tolerance=1.0):
+    """
+    Label 1 和 2 的表面距离指标 (按体素间距，单位 mm)
+    hd95: 两个方向 95 分位距离的较大者；assd: 双向表面距离均值；
+    nsd: 表面 Dice，两侧距离不超过 tolerance 的表面体素占比 (按体素计数)
+    两者皆空时为 0 / 0 / 1，仅一侧为空时为 inf / inf / 0
+    :return: {'hd95_1', 'assd_1', 'nsd_1', 'hd95_2', ...}
+    """
+    result = {}
+    for label in labels:
+        p_mask = pred == label
+        g_mask = gt == label
+        dists = surface_distances(p_mask, g_mask, spacing)
+        if dists is None:
+            both_empty = not p_mask.any() and not g_mask.any()
+            hd95, assd, nsd = (0.0, 0.0, 1.0) if both_empty else (np.inf, np.inf, 0.0)
+        else:
+            d_pg, d_gp = dists
+            hd95 = max(np.percentile(d_pg, 95), np.percentile(d_gp, 95))
+            assd = (d_pg.sum() + d_gp.sum()) / (d_pg.size + d_gp.size)
+            nsd = ((d_pg <= tolerance).sum() + (d_gp <= tolerance).sum()) / (d_pg.size + d_gp.size)
+        result[f"hd95_{label}"] = float(hd95)
+        result[f"assd_{label}"] = float(assd)
+        result[f"nsd_{label}"] = float(nsd)
+    return result
+
+
+def write_gzip_parallel(data, file_path, level=1, block_size=1 << 20, workers=None, progress=None, total=None):
+    """
+    多线程分块压缩并写出标准 gzip 文件 (与 pigz 相同的做法)
+    每块以前一块末尾 32KB 作为预置字典单独 deflate，块间用 SYNC_FLUSH 对齐字节，
+    拼接后即为单个合法的 deflate 流；zlib 压缩时释放 GIL，因此线程池即可并行
+    :param data: bytes-like 未压缩内容，或按顺序产生 bytes-like 片段的可迭代对象
+                 (流式输入，内存只与在途的块数有关，不需要整份未压缩数据)
+    :param progress: 可选回调 progress(fraction, text)
+    :param total: 流式输入的总字节数，仅用于进度
+    """
+    try:
+        chunks = [memoryview(data).cast("B")]
+        total = len(chunks[0])
+    except TypeError:
+        chunks = data
+    window = 32 * 1024
+    workers = workers or os.cpu_count() or 1
+
+    def blocks():
+        """把片段重新切成 block_size 大小的块，返回 (块, 前一块末尾 32KB)"""
+        buffer = bytearray()
+        prev = b""
+        for chunk in chunks:
+            buffer += memoryview(chunk).cast("B")
+            while len(buffer) >= block_size:
+                block = bytes(buffer[:block_size])
+                del buffer[:block_size]
+                yield block, prev
+                prev = block[-window:]
+        if buffer or not prev:
+            yield bytes(buffer), prev
+
+    def compress_block(block, prev, last):
+        if prev:
+            comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, prev)
+        else:
+            comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+        return comp.compress(block) + comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    tmp_path = file_path + ".part"
+    crc = 0
+    size = 0
+    with open(tmp_path, "wb") as f:
+        # gzip 头: magic, deflate, 无标志, mtime, xfl, OS=unknown
+        f.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + b"\x00\xff")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            done = 0
+
+            def write_oldest():
+                nonlocal done
+                f.write(pending.popleft().result())
+                done += 1
+                if progress is not None:
+                    fraction = min(1.0, done * block_size / total) if total else None
+                    progress(fraction, f"导出压缩中... {done} 块")
+
+            # 向前多取一块，才能知道当前块是否为最后一块 (需要 Z_FINISH)
+            iterator = blocks()
+            current = next(iterator)
+            for following in iterator:
+                crc = zlib.crc32(current[0], crc)
+                size += len(current[0])
+                pending.append(pool.submit(compress_block, *current, False))
+                current = following
+                # 限制在途块数，按提交顺序写出，保证块顺序
+                if len(pending) >= 2 * workers:
+                    write_oldest()
+            crc = zlib.crc32(current[0], crc)
+            size += len(current[0])
+            pending.append(pool.submit(compress_block, *current, True))
+            while pending:
+                write_oldest()
+        f.write(struct.pack("<II", crc & 0xFFFFFFFF, size & 0xFFFFFFFF))
+    os.replace(tmp_path, file_path)
+
+
+def _pad_to_even(block):
+    """各维补到偶数长度 (末端复制边缘)"""
+    pads = [(0, n % 2) for n in block.shape]
+    if any(p[1] for p in pads):
+        block = np.pad(block, pads, mode='edge')
+    return block
+
+
+def downsample2(data, labels=False, chunk=32, progress=None):
+    """
+    三个方向各 2 倍下采样 (奇数维末端复制边缘后向上取整)
+    强度图取 2x2x2 块均值 (float32)，标签图取块内众数 (并列时取较大的标签值，尽量保留前景)；
+    沿第 0 轴分块处理，峰值内存只与块大小有关
+    """
+    out_shape = tuple((n + 1) // 2 for n in data.shape)
+    out = np.empty(out_shape, dtype=data.dtype if labels else np.float32)
+    chunk += chunk % 2
+    for x0 in range(0, data.shape[0], chunk):
+        block = _pad_to_even(np.asarray(data[x0:x0 + chunk]))
+        bx, by, bz = (n // 2 for n in block.shape)
+        cells = block.reshape(bx, 2, by, 2, bz, 2)
+        if labels:
+            best = np.zeros((bx, by, bz), dtype=np.int8)
+            result = np.zeros((bx, by, bz), dtype=block.dtype)
+            for v in np.unique(block).tolist():
+                count = (cells == v).sum(axis=(1, 3, 5), dtype=np.int8)
+                take = count >= best
+                best[take] = count[take]
+                result[take] = v
+            out[x0 // 2:x0 // 2 + bx] = result
+        else:
+            out[x0 // 2:x0 // 2 + bx] = cells.mean(axis=(1, 3, 5), dtype=np.float32)
+        if progress is not None:
+            progress(min(1.0, (x0 + chunk) / data.shape[0]))
+    return out
+
+
+PROJECTION_AXES = {"R": 0, "A": 1, "S": 2} # 投影方向 -> RAS 数组的维度
+PROJECTION_OPS = {"max": np.maximum, "min": np.minimum}
+
+
+def axis_projections(data, ops=("max", "min"), chunk=16, progress=None):
+    """
+    全体积沿 R/A/S 三个方向的最大/最小强度投影，沿第 0 轴分块一次遍历
+    (每块只做三次轴向归约，临时内存与块大小成正比)
+    :return: {(方向, op): 2D 数组}，形状与 data 在该方向上的原始切片一致 (R: (Y, Z)，A: (X, Z)，S: (X, Y))
+    """
+    nx, ny, nz = data.shape
+    out = {}
+    for op in ops:
+        out[("R", op)] = None
+        out[("A", op)] = np.empty((nx, nz), dtype=data.dtype)
+        out[("S", op)] = np.empty((nx, ny), dtype=data.dtype)
+    for x0 in range(0, nx, chunk):
+        block = np.asarray(data[x0:x0 + chunk])
+        for op in ops:
+            ufunc = PROJECTION_OPS[op]
+            r = ufunc.reduce(block, axis=0)
+            out[("R", op)] = r if out[("R", op)] is None else ufunc(out[("R", op)], r)
+            out[("A", op)][x0:x0 + len(block)] = ufunc.reduce(block, axis=1)
+            out[("S", op)][x0:x0 + len(block)] = ufunc.reduce(block, axis=2)
+        if progress is not None:
+            progress(min(1.0, (x0 + chunk) / nx))
+    return out
+
+
+class SlabProjector:
+    """
+    沿一个方向、固定厚度 width 的滑动窗口最大/最小投影 (van Herk / Gil-Werman)：
+    按 width 把切片分块，块内前缀与后缀累积只在窗口首次触及该块时计算；
+    任意窗口 [a, a + width) 恰好跨越相邻两块，结果为 op(后缀[a], 前缀[a + width - 1])，
+    窗口平移一层只需一次单层运算 (跨块时摊销为 O(单层))
+    """
+
+    def __init__(self, data, axis, width, op="max", max_blocks=4):
+        self.data = data
+        self.axis = axis
+        self.volume = np.moveaxis(data, PROJECTION_AXES[axis], 0) # 视图，第 0 维为投影方向
+        self.n = self.volume.shape[0]
+        self.width = max(1, min(int(width), self.n))
+        self.ufunc = PROJECTION_OPS[op]
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict() # 块号 -> (前缀累积, 后缀累积)，LRU
+
+    def _block(self, b):
+        entry = self.blocks.get(b)
+        if entry is not None:
+            self.blocks.move_to_end(b)
+            return entry
+        block = np.asarray(self.volume[b * self.width:(b + 1) * self.width])
+        prefix = self.ufunc.accumulate(block, axis=0)
+        suffix = self.ufunc.accumulate(block[::-1], axis=0)[::-1]
+        self.blocks[b] = entry = (prefix, suffix)
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return entry
+
+    def window_start(self, center):
+        """以 center 为中心的窗口起点 (靠近两端时整体平移，保持厚度不变)"""
+        return int(np.clip(center - self.width // 2, 0, self.n - self.width))
+
+    def project(self, center):
+        """返回以 center 为中心的厚层投影 (2D，形状与该方向的原始切片一致)"""
+        a = self.window_start(center)
+        e = a + self.width - 1
+        b0, b1 = a // self.width, e // self.width
+        suffix = self._block(b0)[1][a - b0 * self.width]
+        if b1 == b0:
+            return suffix.copy()
+        prefix = self._block(b1)[0][e - b1 * self.width]
+        return self.ufunc(suffix, prefix)
+
+    def nbytes(self):
+        return sum(p.nbytes + s.nbytes for p, s in self.blocks.values())
+
+
+CHANNEL_SUFFIX_LEN = len("_0000.nii.gz")
+
+
+def scan_dataset(root_dir, has_pred_folder=True, has_gt_folder=True):
+    """
+    扫描 nnU-Net 风格数据集：imagesTr 下的 {name}_{通道号4位}.nii.gz 按病例分组
+    :return: 按名称排序的病例列表，每项为
+        {'name', 'mri_path' (_0000 通道), 'channel_paths' (按通道号排序), 'pred_path', 'gt_path'}
+    """
+    images_dir = os.path.join(root_dir, "imagesTr")
+    channels = {} # case_name -> {channel: path}
+    for root, _, files in os.walk(images_dir):
+        for f in files:
+            # 规则：以 _XXXX.nii.gz 结尾 (XXXX 为 4 位通道号)
+            if not f.endswith('.nii.gz') or f.startswith('._') or len(f) <= CHANNEL_SUFFIX_LEN:
+                continue
+            suffix = f[-CHANNEL_SUFFIX_LEN:]
+            if suffix[0] != '_' or not suffix[1:5].isdigit():
+                continue
+            # 例如: Case10_0001.nii.gz -> Case10, 通道 1
+            case_name = f[:-CHANNEL_SUFFIX_LEN]
+            channels.setdefault(case_name, {})[int(suffix[1:5])] = os.path.join(root, f)
+
+    cases = []
+    for case_name, paths in channels.items():
+        if 0 not in paths:
+            continue # 必须存在 _0000 通道
+        # 预测与 GT 文件应该是 {name}.nii.gz
+        pred_path = os.path.join(root_dir, "predictsTr", f"{case_name}.nii.gz")
+        gt_path = os.path.join(root_dir, "labelsTr", f"{case_name}.nii.gz")
+        channel_paths = [paths[c] for c in sorted(paths)]
+        cases.append({
+            'name': case_name,
+            'mri_path': channel_paths[0],
+            'channel_paths': channel_paths,
+            'pred_path': pred_path if has_pred_folder and os.path.exists(pred_path) else None,
+            'gt_path': gt_path if has_gt_folder and os.path.exists(gt_path) else None
+        })
+
+    # 按名称自然排序 (Case2 在 Case10 之前)
+    cases.sort(key=lambda x: natural_sort_key(x['name']))
+    return cases
+
+
+_DIGITS_RE = re.compile(r"(\d+)")
+
+
+def natural_sort_key(name):
+    """自然排序键：数字段按数值比较，其余部分不区分大小写；整体相同时才按原始字符串区分大小写/前导零"""
+    parts = _DIGITS_RE.split(name)
+    return tuple((0, int(part)) if i % 2 else (1, part.lower()) for i, part in enumerate(parts)), name
+
+
+def intensity_range(data):
+    """全局归一化窗口：下采样后取 0.5% / 99.5% 分位数，避免不同 Slice 亮度跳变"""
+    try:
+        sample_data = data[::2, ::2, ::2]
+        g_min = np.percentile(sample_data, 0.5)
+        g_max = np.percentile(sample_data, 99.5)
+    except Exception:
+        g_min = np.min(data)
+        g_max = np.max(data)
+
+    if g_max <= g_min:
+        g_max = g_min + 1
+    return g_min, g_max
+
+
+def canonical_geometry(img):
+    """
+    与 nib.as_closest_canonical 相同的 RAS 重排，但不读取体素数据
+    :return: (ornt, canonical_affine, canonical (x, y, z) spacing)，数据用 apply_orientation(data, ornt) 转换
+    """
+    ornt = nib.orientations.io_orientation(img.affine)
+    raw_shape = img.shape[:3]
+    affine = img.affine.dot(nib.orientations.inv_ornt_aff(ornt, raw_shape))
+    zooms = [0.0, 0.0, 0.0]
+    raw_zooms = img.header.get_zooms()
+    for i, (axis, _) in enumerate(ornt):
+        zooms[int(axis)] = float(raw_zooms[i])
+    return ornt, affine, tuple(zooms)
+
+
+def load_canonical(path, dtype=np.float32):
+    """
+    读取 NIfTI 并转换为 RAS 标准方向 (按 dtype 直接读取，不经过 float64 的 get_fdata)，4D 只取第 0 帧
+    :return: (data, canonical_affine, canonical (x, y, z) spacing)
+    """
+    img = nib.load(path)
+    ornt, affine, voxel_sizes = canonical_geometry(img)
+    if len(img.shape) == 4:
+        data = np.asarray(img.dataobj[..., 0], dtype=dtype)
+    else:
+        data = np.asarray(img.dataobj, dtype=dtype)
+    return nib.orientations.apply_orientation(data, ornt), affine, voxel_sizes
+
+
+def load_case_volumes(case):
+    """
+    批量工具 (QC 报告等) 使用的病例读取：MRI (_0000 通道) + Pred + GT，均为 RAS 方向
+    :return: dict 'mri', 'pred', 'gt' (缺失为 None), 'global_min', 'global_max', 'voxel_sizes'
+    """
+    mri, _, voxel_sizes = load_canonical(case['mri_path'])
+    volumes = {'mri': mri, 'voxel_sizes': voxel_sizes}
+    for key, path_key in (('pred', 'pred_path'), ('gt', 'gt_path')):
+        data = None
+        if case.get(path_key):
+            data = load_canonical(case[path_key], np.int8)[0]
+            if data.shape != mri.shape:
+                raise ValueError(f"MRI维度 {mri.shape} 与 {key} 维度 {data.shape} 不匹配")
+        volumes[key] = data
+    volumes['global_min'], volumes['global_max'] = intensity_range(mri)
+    return volumes
+
+
+def overlap_metrics(pred, gt):
+    """计算 Label 1 和 2 的 Dice 和 IoU: (dice1, iou1, dice2, iou2)"""
+    def compute_dice_iou(p, g, label):
+        p_mask = (p == label)
+        g_mask = (g == label)
+        
+        intersection = np.logical_and(p_mask, g_mask).sum()
+        union = np.logical_or(p_mask, g_mask).sum()
+        sum_masks = p_mask.sum() + g_mask.sum()
+        
+        # Dice
+        dice = 1.0 if sum_masks == 0 else 2.0 * intersection / sum_masks
+        # IoU
+        iou = 1.0 if union == 0 else intersection / union
+            
+        return dice, iou
+
+    d1, i1 = compute_dice_iou(pred, gt, 1)
+    d2, i2 = compute_dice_iou(pred, gt, 2)
+    return d1, i1, d2, i2
+
+
+def format_orientation(affine):
+    """根据 affine 返回方向字符串，如 RAS/PSI"""
+    try:
+        codes = nib.aff2axcodes(affine)
+        return ''.join(codes)
+    except Exception:
+        return "UNKNOWN"
+
+
+def format_mask_values(values):
+    """格式化 mask 值，优先按整数展示"""
+    formatted = []
+    for v in values:
+        fv = float(v)
+        if abs(fv - round(fv)) < 1e-6:
+            formatted.append(int(round(fv)))
+        else:
+            formatted.append(round(fv, 6))
+    return sorted(set(formatted))
+
+
+def value_counts(data):
+    """返回 (取值, 体素数)；非负小整数用 bincount 单次遍历，其余退回 np.unique (需要排序)"""
+    if np.issubdtype(data.dtype, np.integer) and data.size and 0 <= data.min() and data.max() < 65536:
+        counts = np.bincount(data.ravel(order="K"))
+        values = np.flatnonzero(counts)
+        return values, counts[values]
+    return np.unique(data, return_counts=True)
+
+
+def file_stamp(path):
+    """文件 (大小, mtime_ns)，用于判断缓存是否过期"""
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def case_file_stamps(case):
+    return {key: file_stamp(case.get(key)) for key in ('mri_path', 'pred_path', 'gt_path')}
+
+
+COMPONENT_CONNECTIVITY = 26 # 病例统计中连通域的邻域定义
+SURFACE_DICE_TOLERANCE = 1.0 # 表面 Dice 的距离容差 (mm)
+
+
+def json_safe(value):
+    """非有限浮点数 (如单侧为空时的 HD95 = inf) 转为 None，保证写出的是标准 JSON"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {k: json_safe(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [json_safe(v) for v in value]
+    return value
+
+
+def format_metric(value, spec, unit=""):
+    """格式化指标值；None 或非有限值 (单侧为空时无定义) 显示为“无定义”"""
+    if value is None or not math.isfinite(value):
+        return "无定义"
+    return f"{value:{spec}}{unit}"
+
+
+def compute_case_record(case):
+    """
+    计算单个病例的指标记录 (进程池任务，不依赖 Tk)
+    :return: dict 'name', 'stamps', 'files' ({'mri'/'pred'/'gt': 文件信息}), 'orientation_mismatch',
+             'shape_mismatch', 'volume_ml' ({'pred1', 'gt2', ...})，
+             'components' ({'pred1': {'ml', 'n', 'largest_frac'}, ...}，覆盖全部整数前景标签)，
+             Pred 与 GT 均可用时另有 'metrics' (Dice/IoU 与 hd95_1/assd_1/nsd_1 等表面距离指标，
+             单侧为空时无定义的 HD95/ASSD 记为 None)
+    """
+    record = {'name': case['name'], 'stamps': case_file_stamps(case), 'files': {}, 'volume_ml': {},
+              'components': {}}
+    masks = {}
+    spacing = None
+    for key, path_key in (('mri', 'mri_path'), ('pred', 'pred_path'), ('gt', 'gt_path')):
+        path = case.get(path_key)
+        if not path:
+            record['files'][key] = {"exists": False, "error": "MISSING"}
+            continue
+        try:
+            img = nib.load(path)
+            ornt, _, zooms = canonical_geometry(img)
+            shape = [0, 0, 0]
+            for i, (axis, _) in enumerate(ornt):
+                shape[int(axis)] = int(img.shape[i])
+            info = {
+                "exists": True,
+                "orientation": format_orientation(img.affine),
+                "shape": shape, # RAS 方向下的维度
+                "error": None
+            }
+            if key != 'mri':
+                data = np.asanyarray(img.dataobj)
+                if data.ndim == 4:
+                    data = data[..., 0]
+                values, counts = value_counts(data)
+                info["mask_values"] = format_mask_values(values)
+                info["fg_mask_values"] = [v for v in info["mask_values"] if v != 0]
+                voxel_ml = float(np.prod(zooms)) / 1000.0
+                label_voxels = dict(zip(values.tolist(), counts.tolist()))
+                for label in (1, 2):
+                    record['volume_ml'][f"{key}{label}"] = label_voxels.get(label, 0) * voxel_ml
+                # 连通域与方向无关，直接在原始数组上统计
+                fg_labels = [v for v in info["fg_mask_values"] if isinstance(v, int)]
+                for label, stats in label_component_stats(data, fg_labels, voxel_ml,
+                                                          COMPONENT_CONNECTIVITY).items():
+                    record['components'][f"{key}{label}"] = stats
+                masks[key] = nib.orientations.apply_orientation(data, ornt)
+                spacing = zooms
+        except Exception as e:
+            info = {"exists": True, "error": str(e)}
+        record['files'][key] = info
+
+    infos = [info for info in record['files'].values() if not info.get("error")]
+    record['orientation_mismatch'] = len({info["orientation"] for info in infos}) > 1
+    record['shape_mismatch'] = len({tuple(info["shape"]) for info in infos}) > 1
+    if 'pred' in masks and 'gt' in masks and masks['pred'].shape == masks['gt'].shape:
+        d1, i1, d2, i2 = overlap_metrics(masks['pred'], masks['gt'])
+        record['metrics'] = {'dice1': float(d1), 'iou1': float(i1), 'dice2': float(d2), 'iou2': float(i2),
+                             'min_dice': float(min(d1, d2))}
+        record['metrics'].update(json_safe(surface_metrics(masks['pred'], masks['gt'], spacing,
+                                                           tolerance=SURFACE_DICE_TOLERANCE)))
+    return record
+
+
+# 病例列表排序字段: 显示名 -> 记录中的键路径，None 为按名称
+CASE_SORT_FIELDS = OrderedDict([
+    ("名称", None),
+    ("最小 Dice", ('metrics', 'min_dice')),
+    ("Dice 1", ('metrics', 'dice1')),
+    ("Dice 2", ('metrics', 'dice2')),
+    ("IoU 1", ('metrics', 'iou1')),
+    ("IoU 2", ('metrics', 'iou2')),
+    ("HD95 1 (mm)", ('metrics', 'hd95_1')),
+    ("HD95 2 (mm)", ('metrics', 'hd95_2')),
+    ("ASSD 1 (mm)", ('metrics', 'assd_1')),
+    ("ASSD 2 (mm)", ('metrics', 'assd_2')),
+    ("表面 Dice 1", ('metrics', 'nsd_1')),
+    ("表面 Dice 2", ('metrics', 'nsd_2')),
+    ("Pred 体积 1 (mL)", ('volume_ml', 'pred1')),
+    ("Pred 体积 2 (mL)", ('volume_ml', 'pred2')),
+    ("GT 体积 1 (mL)", ('volume_ml', 'gt1')),
+    ("GT 体积 2 (mL)", ('volume_ml', 'gt2')),
+    ("Pred 连通域数 1", ('components', 'pred1', 'n')),
+    ("Pred 连通域数 2", ('components', 'pred2', 'n')),
+    ("Pred 最大连通域占比 1", ('components', 'pred1', 'largest_frac')),
+    ("Pred 最大连通域占比 2", ('components', 'pred2', 'largest_frac')),
+])
+CASE_FILTERS = ("全部", "最小 Dice < 阈值", "缺失 Pred/GT", "方向/维度不一致", "读取错误", "指标未计算")
+
+
+class CaseMetricTable:
+    """
+    病例指标表：每个病例一条 compute_case_record 记录 (Dice/IoU、表面距离、标签体积与连通域、mask 值、方向与维度检查)
+    缓存于 <root>/.nii_viewer_cache/case_metrics.json，按文件 (大小, mtime) 判断是否需要重新计算
+    """
+
+    VERSION = 3
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.path = os.path.join(root_dir, ".nii_viewer_cache", "case_metrics.json")
+        self.records = {} # case name -> record
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            return
+        if payload.get("version") == self.VERSION:
+            # 旧缓存中可能存有 Infinity，统一转为 None
+            self.records = json_safe(payload.get("records", {}))
+
+    def save(self):
+        """原子写入 (先写临时文件再替换)；数据目录只读时跳过"""
+        with self._lock:
+            payload = {"version": self.VERSION, "records": dict(self.records)}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(json_safe(payload), f, ensure_ascii=False, allow_nan=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            return False
+        return True
+
+    def get(self, case):
+        return self.records.get(case['name'])
+
+    @staticmethod
+    def error_record(case, error):
+        """单个病例计算失败时的记录：各文件标记为读取错误；不记录文件戳，下次更新时重试"""
+        message = f"{type(error).__name__}: {error}"
+        files = {key: {"exists": True, "error": message} if case.get(path_key) else {"exists": False, "error": "MISSING"}
+                 for key, path_key in (('mri', 'mri_path'), ('pred', 'pred_path'), ('gt', 'gt_path'))}
+        return {'name': case['name'], 'stamps': None, 'files': files, 'volume_ml': {}, 'components': {},
+                'orientation_mismatch': False, 'shape_mismatch': False}
+
+    def update(self, cases, progress=None, max_workers=None, save_every=200):
+        """
+        在进程池中重新计算缺失或文件已变化的记录，并移除已不在数据集中的病例
+        :return: 重新计算的病例数
+        """
+        names = {case['name'] for case in cases}
+        stale = [case for case in cases
+                 if (self.records.get(case['name']) or {}).get('stamps') != case_file_stamps(case)]
+        with self._lock:
+            removed = [name for name in self.records if name not in names]
+            for name in removed:
+                del self.records[name]
+        if not stale:
+            if removed:
+                self.save()
+            return 0
+
+        # 在 Tk 进程的后台线程中启动，fork 多线程进程可能死锁，与渲染进程一样使用 spawn
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(compute_case_record, case): case for case in stale}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = self.error_record(futures[future], e)
+                with self._lock:
+                    self.records[record['name']] = record
+                if progress is not None:
+                    progress(done / len(stale), f"计算病例指标 {done}/{len(stale)}")
+                if done % save_every == 0:
+                    self.save()
+        self.save()
+        return len(stale)
+
+
+class _ProfileStage:
+    """FrameProfiler.stage 返回的计时上下文"""
+
+    __slots__ = ("profiler", "name", "cat", "start")
+
+    def __init__(self, profiler, name, cat):
+        self.profiler = profiler
+        self.name = name
+        self.cat = cat
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.record(self.name, self.cat, self.start, time.perf_counter_ns() - self.start)
+        return False
+
+
+class FrameProfiler:
+    """
+    分阶段帧耗时统计
+    用法: with profiler.stage("overlay"): ...
+    关闭时 stage() 直接返回共享的空上下文，开销只有一次属性判断；
+    开启后记录每个阶段的起止时间 (环形缓冲)，可导出为 Chrome trace JSON (chrome://tracing / Perfetto)
+    """
+
+    _NULL = nullcontext()
+
+    def __init__(self, max_events=50000):
+        self.enabled = False
+        self.events = deque(maxlen=max_events) # (name, cat, start_ns, dur_ns, tid)
+        self.stage_ms = {} # name -> 指数平滑耗时 (ms)
+        self.frame_ms = deque(maxlen=120)  # 最近若干帧的总耗时
+        self.frame_ends = deque(maxlen=120) # 最近若干帧的结束时间 (秒)
+        self._lock = threading.Lock()
+
+    def stage(self, name, cat="render"):
+        if not self.enabled:
+            return self._NULL
+        return _ProfileStage(self, name, cat)
+
+    def record(self, name, cat, start_ns, dur_ns):
+        with self._lock:
+            self.events.append((name, cat, start_ns, dur_ns, threading.get_ident()))
+            ms = dur_ns / 1e6
+            prev = self.stage_ms.get(name)
+            self.stage_ms[name] = ms if prev is None else prev + 0.2 * (ms - prev)
+
+    def frame_done(self, frame_ms):
+        with self._lock:
+            self.frame_ms.append(frame_ms)
+            self.frame_ends.append(time.perf_counter())
+
+    def fps(self):
+        """最近 1 秒内的实际帧率 (两帧间隔超过 1 秒视为空闲，不计入)"""
+        ends = [t for t in self.frame_ends if t >= time.perf_counter() - 1.0]
+        if len(ends) < 2:
+            return 0.0
+        return (len(ends) - 1) / (ends[-1] - ends[0])
+
+    def hud_text(self, stages=("slice", "normalize", "overlay", "resize", "blit")):
+        if not self.frame_ms:
+            return "Profiler: 等待刷新..."
+        frames = np.asarray(self.frame_ms)
+        parts = [f"FPS {self.fps():.1f}",
+                 f"帧 {frames[-1]:.1f}ms (p95 {np.percentile(frames, 95):.1f})"]
+        detail = " ".join(f"{name} {self.stage_ms[name]:.1f}" for name in stages if name in self.stage_ms)
+        if detail:
+            parts.append(detail)
+        return " | ".join(parts)
+
+    def reset(self):
+        with self._lock:
+            self.events.clear()
+            self.stage_ms.clear()
+            self.frame_ms.clear()
+            self.frame_ends.clear()
+
+    def export_chrome_trace(self, path):
+        """导出 Chrome trace (Trace Event Format, 'X' 完整事件，时间单位 us)"""
+        with self._lock:
+            events = list(self.events)
+        pid = os.getpid()
+        trace = [{
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": start_ns / 1000.0,
+            "dur": dur_ns / 1000.0,
+            "pid": pid,
+            "tid": tid
+        } for name, cat, start_ns, dur_ns, tid in events]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        return len(trace)
+
+
+def process_rss_bytes():
+    """
+    当前进程常驻内存 (RSS)，返回 (字节数, 是否为峰值)
+    Linux 读取 /proc/self/statm；其他平台退回 resource.getrusage 的峰值 RSS
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE"), False
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 单位为字节，Linux/BSD 为 KB
+        return (peak if os.uname().sysname == "Darwin" else peak * 1024), True
+    except (ImportError, AttributeError):
+        return 0, False
+
+
+def physical_memory_bytes():
+    """物理内存总量，无法获取时返回 0"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+REBUILDABLE_MAX_PRIORITY = 40 # priority 不超过该值的消费者为可重建缓存，可自动回收
+
+
+class MemoryRegistry:
+    """
+    内存占用登记表
+    每个消费者提供 size_fn() -> 字节数，可回收的缓存再提供 evict_fn()；
+    回收时按 priority 从小到大依次调用，直到 stop() 返回 True
+    """
+
+    def __init__(self):
+        self._consumers = []
+
+    def register(self, name, size_fn, evict_fn=None, priority=50):
+        self._consumers.append((priority, name, size_fn, evict_fn))
+        self._consumers.sort(key=lambda item: item[0])
+
+    def snapshot(self):
+        """返回 [(名称, 字节数, 是否可回收), ...]"""
+        rows = []
+        for _, name, size_fn, evict_fn in self._consumers:
+            try:
+                nbytes = int(size_fn())
+            except Exception:
+                nbytes = 0
+            rows.append((name, nbytes, evict_fn is not None))
+        return rows
+
+    def evict(self, stop=None, max_priority=None):
+        """按优先级回收缓存，返回 [(名称, 回收前字节数), ...]"""
+        evicted = []
+        for priority, name, size_fn, evict_fn in self._consumers:
+            if evict_fn is None or (max_priority is not None and priority > max_priority):
+                continue
+            if stop is not None and stop():
+                break
+            nbytes = int(size_fn())
+            if nbytes == 0:
+                continue
+            evict_fn()
+            evicted.append((name, nbytes))
+        return evicted
+
+
+class TimeSeriesVolume:
+    """
+    4D 图像的惰性时间轴访问
+    通过 nibabel 代理按需读取单个时间点并转换为 RAS 标准方向，LRU 缓存最近的 cache_frames 帧，
+    并由单个后台线程按顺序预取后续时间点 (顺序读取 .nii.gz 时只需解压新增部分)
+    """
+
+    def __init__(self, img_raw, cache_frames=48):
+        self.img = img_raw
+        self.n_frames = int(img_raw.shape[3])
+        # 原始方向 -> RAS 的重排方式，与 nib.as_closest_canonical 一致
+        self.ornt, self.affine, self.voxel_sizes = canonical_geometry(img_raw)
+        shape = [0, 0, 0]
+        for i, (axis, _) in enumerate(self.ornt):
+            shape[int(axis)] = int(img_raw.shape[i])
+        self.shape = tuple(shape)
+
+        self.cache_frames = max(2, int(cache_frames))
+        self.read_ms = 0.0 # 最近一次读取单帧的耗时
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._wanted = set() # 最近一次预取请求的窗口，不在窗口内的排队任务直接丢弃
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _read(self, t):
+        t0 = time.perf_counter()
+        frame = np.asarray(self.img.dataobj[..., t], dtype=np.float32)
+        frame = nib.orientations.apply_orientation(frame, self.ornt)
+        self.read_ms = (time.perf_counter() - t0) * 1000
+        return frame
+
+    def _store(self, t, frame):
+        with self._lock:
+            self._cache[t] = frame
+            self._cache.move_to_end(t)
+            while len(self._cache) > self.cache_frames:
+                self._cache.popitem(last=False)
+
+    def get_cached(self, t):
+        """缓存命中时返回该帧，否则返回 None (不触发读取)"""
+        with self._lock:
+            frame = self._cache.get(t)
+            if frame is not None:
+                self._cache.move_to_end(t)
+            return frame
+
+    def frame(self, t):
+        """同步读取时间点 t (优先命中缓存)"""
+        t = int(t) % self.n_frames
+        frame = self.get_cached(t)
+        if frame is None:
+            frame = self._read(t)
+            self._store(t, frame)
+        return frame
+
+    def prefetch(self, t, count):
+        """在后台依次预取 t, t+1, ..., t+count (循环到序列开头)"""
+        window = [(int(t) + k) % self.n_frames for k in range(min(count + 1, self.n_frames))]
+        with self._lock:
+            self._wanted = set(window)
+            todo = [tt for tt in window if tt not in self._cache and tt not in self._pending]
+            self._pending.update(todo)
+        for tt in todo:
+            self._executor.submit(self._prefetch_one, tt)
+
+    def _prefetch_one(self, t):
+        try:
+            with self._lock:
+                if t not in self._wanted or t in self._cache:
+                    return
+            self._store(t, self._read(t))
+        except Exception:
+            pass # 预取失败不影响前台，前台读取时会再次报错
+        finally:
+            with self._lock:
+                self._pending.discard(t)
+
+    def cached_nbytes(self):
+        with self._lock:
+            return sum(frame.nbytes for frame in self._cache.values())
+
+    def evict_cache(self, keep=None):
+        """丢弃帧缓存 (可保留 keep 指定的时间点)，后续访问时重新读取"""
+        with self._lock:
+            kept = {t: self._cache[t] for t in (keep or ()) if t in self._cache}
+            self._cache.clear()
+            self._cache.update(kept)
+
+    def close(self):
+        with self._lock:
+            self._wanted = set()
+            self._cache.clear()
+        self._executor.shutdown(wait=False)
+
+
+class EditJournal:
+    """
+    追加写的编辑日志 (崩溃恢复用)
+    每条记录是一次切片写入的体素差分: (z, 变化体素在切片内的 flat 索引, 新值)，
+    绘制时只在内存中追加，由后台线程每隔 flush_interval 秒批量写盘并 fsync
+    """
+
+    MAGIC = b"NIIJRNL1"
+
+    def __init__(self, path, shape, source_tag, flush_interval=3.0):
+        self.path = path
+        self.shape = tuple(int(v) for v in shape)
+        self.source_tag = source_tag
+        self.flush_interval = flush_interval
+        self.seq = 0 # 已记录的差分条数 (含未落盘)
+        self._pending = []
+        self._lock = threading.Lock()    # 保护 _pending
+        self._io_lock = threading.Lock() # 保护文件写入
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def _header_bytes(cls, shape, source_tag):
+        tag = source_tag.encode("utf-8")
+        return cls.MAGIC + struct.pack("<3IH", *shape, len(tag)) + tag
+
+    def start(self, reset=False):
+        """创建/续写日志文件并启动后台落盘线程"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if reset or not os.path.exists(self.path):
+            self.reset()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def record(self, z, old_slice, new_slice):
+        """CopyOnWriteMask 监听器：只记录发生变化的体素"""
+        changed = np.flatnonzero(np.asarray(old_slice) != np.asarray(new_slice))
+        if changed.size == 0:
+            return
+        values = np.ascontiguousarray(new_slice).reshape(-1)[changed].astype(np.int8)
+        with self._lock:
+            self._pending.append((int(z), changed.astype(np.uint32), values))
+            self.seq += 1
+
+    def pending_nbytes(self):
+        """尚未落盘的差分记录占用的内存"""
+        with self._lock:
+            return sum(idx.nbytes + values.nbytes for _, idx, values in self._pending)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        parts = []
+        for z, idx, values in pending:
+            parts.append(struct.pack("<II", z, idx.size))
+            parts.append(idx.tobytes())
+            parts.append(values.tobytes())
+        with self._io_lock:
+            with open(self.path, "ab") as f:
+                f.write(b"".join(parts))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                pass # 磁盘暂时不可写时保留在内存，下个周期重试
+
+    def close(self):
+        """停止后台线程并把剩余差分写盘"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def reset(self):
+        """清空日志 (编辑已导出后调用)"""
+        with self._io_lock:
+            with self._lock:
+                self._pending = []
+            with open(self.path, "wb") as f:
+                f.write(self._header_bytes(self.shape, self.source_tag))
+                f.flush()
+                os.fsync(f.fileno())
+
+    @classmethod
+    def read_records(cls, path, shape, source_tag):
+        """
+        读取日志记录；文件头与当前病例不符时返回 None
+        末尾不完整的记录 (崩溃时写了一半) 被忽略
+        """
+        try:
+            with open(path, "rb") as f:
+                buf = f.read()
+        except OSError:
+            return None
+        header = cls._header_bytes(tuple(int(v) for v in shape), source_tag)
+        if not buf.startswith(header):
+            return None
+
+        records = []
+        pos = len(header)
+        while pos + 8 <= len(buf):
+            z, count = struct.unpack_from("<II", buf, pos)
+            end = pos + 8 + count * 5
+            if end > len(buf):
+                break
+            idx = np.frombuffer(buf, dtype=np.uint32, count=count, offset=pos + 8)
+            values = np.frombuffer(buf, dtype=np.int8, count=count, offset=pos + 8 + count * 4)
+            records.append((z, idx, values))
+            pos = end
+        return records
+
+    @staticmethod
+    def replay(records, mask):
+        """把日志记录应用到 mask 上，同一切片的连续记录合并后一次写入"""
+        current_z = None
+        current = None
+        for z, idx, values in records:
+            if z != current_z:
+                if current is not None:
+                    mask[:, :, current_z] = current
+                current_z = z
+                current = mask[:, :, z].copy()
+            current.reshape(-1)[idx] = values
+        if current is not None:
+            mask[:, :, current_z] = current
+
+
+class CopyOnWriteMask:
+    """
+    写时复制的 3D 标签体 (RAS)
+    未修改的切片 (沿 S 轴) 直接读取源标签，只有被修改过的切片才单独存储一份
+    """
+
+    def __init__(self, base, shape=None, dtype=np.int8):
+        """
+        :param base: 源标签数组 (不会被修改)，为 None 时表示全 0 的空白 mask
+        :param shape/dtype: base 为 None 时使用
+        """
+        self.base = base
+        self.shape = tuple(base.shape) if base is not None else tuple(shape)
+        self.dtype = base.dtype if base is not None else np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self._slices = {} # z -> 已修改的 2D 切片
+        self._base_values = None
+        self.listeners = [] # listener(z, old_slice, new_slice)，切片内容变化时调用
+
+    def base_slice(self, z):
+        if self.base is None:
+            return np.zeros(self.shape[:2], dtype=self.dtype)
+        view = self.base[:, :, z]
+        view.flags.writeable = False # 防止误写源标签
+        return view
+
+    @staticmethod
+    def _slice_index(key):
+        """判断 key 是否为 [:, :, z] 形式，是则返回 z"""
+        if (isinstance(key, tuple) and len(key) == 3
+                and key[0] == slice(None) and key[1] == slice(None)
+                and isinstance(key[2], (int, np.integer))):
+            return int(key[2])
+        return None
+
+    def __getitem__(self, key):
+        z = self._slice_index(key)
+        if z is not None:
+            return self.get_slice(z)
+        if isinstance(key, tuple) and len(key) == 3 and all(isinstance(k, (int, np.integer)) for k in key):
+            return self.get_slice(int(key[2]))[key[0], key[1]]
+        # 其余索引需要整卷副本，必须显式调用 to_array()
+        raise TypeError("CopyOnWriteMask 仅支持 mask[:, :, z] 与 mask[x, y, z] 读取，整卷请用 to_array()")
+
+    def __setitem__(self, key, value):
+        z = self._slice_index(key)
+        if z is None:
+            raise TypeError("CopyOnWriteMask 仅支持整切片写入: mask[:, :, z] = slice")
+        self.set_slice(z, value)
+
+    def __array__(self, dtype=None, copy=None):
+        raise TypeError("CopyOnWriteMask 不支持隐式转换为数组，整卷副本请用 to_array()")
+
+    def get_slice(self, z):
+        """读取第 z 层 (只读视图，修改前需 copy)"""
+        data = self._slices.get(z)
+        if data is None:
+            return self.base_slice(z)
+        return data
+
+    def set_slice(self, z, data):
+        """写入第 z 层；与源标签一致时释放该层的副本"""
+        data = np.asarray(data, dtype=self.dtype)
+        old = self.get_slice(z)
+        if np.array_equal(data, old):
+            return
+        if np.array_equal(data, self.base_slice(z)):
+            self._slices.pop(z, None)
+        else:
+            self._slices[z] = data.copy()
+        for listener in self.listeners:
+            listener(z, old, data)
+
+    def modified_slices(self):
+        """返回已修改切片的索引 (升序)"""
+        return sorted(self._slices)
+
+    def overlay_nbytes(self):
+        return sum(a.nbytes for a in self._slices.values())
+
+    def to_array(self, dtype=None):
+        """生成完整的 3D 数组副本 (导出时使用)"""
+        if self.base is None:
+            out = np.zeros(self.shape, dtype=dtype or self.dtype)
+        else:
+            out = self.base.astype(dtype or self.dtype, copy=True)
+        for z, data in self._slices.items():
+            out[:, :, z] = data
+        return out
+
+    def equal_to(self, value):
+        """返回 mask == value 的 3D bool 数组"""
+        if self.base is None:
+            out = np.full(self.shape, value == 0, dtype=bool)
+        else:
+            out = (self.base == value)
+        for z, data in self._slices.items():
+            out[:, :, z] = (data == value)
+        return out
+
+    def unique_values(self):
+        """返回出现过的标签值 (升序)；源标签按层统计一次后缓存"""
+        if self._base_values is None:
+            # value -> 每层是否出现该值
+            if self.base is None:
+                self._base_values = {0: np.ones(self.shape[2], dtype=bool)}
+            else:
+                self._base_values = {
+                    v: (self.base == v).any(axis=(0, 1)) for v in np.unique(self.base).tolist()
+                }
+        unmodified = np.ones(self.shape[2], dtype=bool)
+        unmodified[list(self._slices)] = False
+        values = {v for v, present in self._base_values.items() if np.any(present & unmodified)}
+        for data in self._slices.values():
+            values.update(np.unique(data).tolist())
+        return sorted(values)
+
+
+class LabelSliceIndex:
+    """
+    逐层标签索引 (沿 S 轴)：各来源 ('pred' / 'gt' / 'edit') 每个标签在每层的体素数与 2D 包围盒，
+    以及 Pred 与 GT (编辑中为编辑 Mask) 每层不一致的体素数。
+    加载时每个标签一次比较 + 两次轴向归约得到全部层的统计，编辑后只重算被修改的层。
+    """
+
+    def __init__(self, n_slices):
+        self.n_slices = n_slices
+        self.counts = {} # source -> {label: (n_slices,) int64 体素数}
+        self.boxes = {} # source -> {label: (n_slices, 4) int32 每层 (x0, x1, y0, y1)，空层为 -1}
+        self.disagree = None # (n_slices,) int64，无法比较时为 None
+
+    @staticmethod
+    def slice_stats(volume):
+        """
+        :param volume: 3D (X, Y, Z) 标签体，或单层 2D (X, Y)
+        :return: {label: (每层体素数, 每层包围盒)}，不含背景 0
+        """
+        if volume.ndim == 2:
+            volume = volume[:, :, None]
+        if volume.size == 0:
+            return {}
+        # 标签通常是 0..K 的小整数：取值范围很小时逐个比较，比 bincount/unique 统计取值快得多
+        lo, hi = int(volume.min()), int(volume.max())
+        candidates = range(lo, hi + 1) if hi - lo <= 64 else value_counts(volume)[0].tolist()
+        stats = {}
+        for label in candidates:
+            if label == 0:
+                continue
+            m = volume == label
+            per_xz = m.sum(axis=1, dtype=np.int32) # (X, Z)
+            counts = per_xz.sum(axis=0, dtype=np.int64)
+            if not counts.any():
+                continue
+            has_x = per_xz > 0
+            has_y = m.any(axis=0) # (Y, Z)
+            boxes = np.full((volume.shape[2], 4), -1, dtype=np.int32)
+            present = counts > 0
+            boxes[present, 0] = has_x.argmax(axis=0)[present]
+            boxes[present, 1] = (volume.shape[0] - 1 - has_x[::-1].argmax(axis=0))[present]
+            boxes[present, 2] = has_y.argmax(axis=0)[present]
+            boxes[present, 3] = (volume.shape[1] - 1 - has_y[::-1].argmax(axis=0))[present]
+            stats[int(label)] = (counts, boxes)
+        return stats
+
+    @classmethod
+    def build(cls, n_slices, pred=None, gt=None):
+        index = cls(n_slices)
+        for source, volume in (('pred', pred), ('gt', gt)):
+            if volume is not None:
+                stats = cls.slice_stats(volume)
+                index.counts[source] = {label: c for label, (c, _) in stats.items()}
+                index.boxes[source] = {label: b for label, (_, b) in stats.items()}
+        if pred is not None and gt is not None:
+            index.disagree = (pred != gt).sum(axis=(0, 1), dtype=np.int64)
+        return index
+
+    def copy_source(self, src, dst):
+        """以 src 的统计初始化 dst (编辑 Mask 从其来源标签开始)"""
+        self.counts[dst] = {label: c.copy() for label, c in self.counts.get(src, {}).items()}
+        self.boxes[dst] = {label: b.copy() for label, b in self.boxes.get(src, {}).items()}
+
+    def update_slice(self, source, z, data):
+        """第 z 层内容变化后重算该层统计"""
+        counts = self.counts.setdefault(source, {})
+        boxes = self.boxes.setdefault(source, {})
+        stats = self.slice_stats(data)
+        for label in set(counts) | set(stats):
+            if label not in counts:
+                counts[label] = np.zeros(self.n_slices, dtype=np.int64)
+                boxes[label] = np.full((self.n_slices, 4), -1, dtype=np.int32)
+            c, b = stats.get(label, (np.zeros(1, dtype=np.int64), np.full((1, 4), -1, dtype=np.int32)))
+            counts[label][z] = c[0]
+            boxes[label][z] = b[0]
+
+    def total(self, source):
+        """(n_slices,) 每层所有标签的体素数之和"""
+        out = np.zeros(self.n_slices, dtype=np.int64)
+        for c in self.counts.get(source, {}).values():
+            out += c
+        return out
+
+    def labels(self, sources):
+        return sorted({label for source in sources for label, c in self.counts.get(source, {}).items() if c.any()})
+
+    def presence(self, sources, label=None):
+        """(n_slices,) bool，任一来源在该层含有标签 (或指定标签)"""
+        present = np.zeros(self.n_slices, dtype=bool)
+        for source in sources:
+            for lab, c in self.counts.get(source, {}).items():
+                if label is None or lab == label:
+                    present |= c > 0
+        return present
+
+    def disagreement(self):
+        return self.disagree > 0 if self.disagree is not None else np.zeros(self.n_slices, dtype=bool)
+
+    @staticmethod
+    def find_next(present, start, direction):
+        """从 start 起 (不含) 沿 direction (+1 / -1) 找下一个 True 的层，没有时返回 None"""
+        if direction > 0:
+            hits = np.flatnonzero(present[start + 1:])
+            return int(start + 1 + hits[0]) if len(hits) else None
+        hits = np.flatnonzero(present[:max(start, 0)])
+        return int(hits[-1]) if len(hits) else None
+
+    def bbox(self, source, label):
+        """标签的 3D 包围盒 (x0, x1, y0, y1, z0, z1)，不存在时返回 None"""
+        counts = self.counts.get(source, {}).get(label)
+        if counts is None or not counts.any():
+            return None
+        z = np.flatnonzero(counts)
+        b = self.boxes[source][label][z]
+        return (int(b[:, 0].min()), int(b[:, 1].max()), int(b[:, 2].min()), int(b[:, 3].max()),
+                int(z[0]), int(z[-1]))
+
+
+class ImagePanel(tk.Canvas):
+    """
+    基于 Canvas 的显示面板：每个面板只持有一个 PhotoImage，尺寸不变时原地 paste 更新，
+    标题字母、笔刷光标等作为 Canvas 图元叠加，不参与像素重绘。
+    图像居中放置，与 screen_to_image_coords 的居中偏移约定一致。
+    """
+
+    def __init__(self, master, text="", title="", bg="#e0e0e0", **kwargs):
+        super().__init__(master, bg=bg, highlightthickness=0, bd=0, width=1, height=1, **kwargs)
+        self.photo = None
+        self.image_size = None
+        # 最近一次合成 (切片 -> 叠加 -> 重采样) 与上屏 (paste/新建 PhotoImage) 耗时，单位 ms，指数平滑
+        self.render_ms = 0.0
+        self.blit_ms = 0.0
+        self.frame_count = 0
+
+        self._image_item = self.create_image(0, 0, anchor=tk.NW, state=tk.HIDDEN)
+        self._text_item = self.create_text(0, 0, text=text, fill="black")
+        self._title_bg = self.create_rectangle(0, 0, 0, 0, fill="#202020", outline="", state=tk.HIDDEN)
+        self._title_item = self.create_text(0, 0, text="", anchor=tk.NW, fill="white",
+                                            font=("Arial", 12, "bold"), state=tk.HIDDEN)
+        self._cursor_item = self.create_oval(0, 0, 0, 0, outline="white", width=1, state=tk.HIDDEN)
+        self.set_title(title)
+        self.bind("<Configure>", self._on_configure, add="+")
+
+    def image_offset(self):
+        """图像左上角在面板中的位置 (居中)"""
+        if self.image_size is None:
+            return 0, 0
+        iw, ih = self.image_size
+        return (self.winfo_width() - iw) // 2, (self.winfo_height() - ih) // 2
+
+    def _on_configure(self, event=None):
+        self.coords(self._text_item, self.winfo_width() // 2, self.winfo_height() // 2)
+        off_x, off_y = self.image_offset()
+        self.coords(self._image_item, off_x, off_y)
+        self._place_title(off_x, off_y)
+
+    def _place_title(self, off_x, off_y):
+        if self.itemcget(self._title_item, "state") == tk.HIDDEN:
+            return
+        x, y = max(0, off_x) + 4, max(0, off_y) + 4
+        self.coords(self._title_item, x, y)
+        x1, y1, x2, y2 = self.bbox(self._title_item)
+        self.coords(self._title_bg, x1 - 3, y1 - 1, x2 + 3, y2 + 1)
+
+    def set_title(self, title):
+        """设置左上角的方位字母 (空字符串表示隐藏)"""
+        state = tk.NORMAL if title else tk.HIDDEN
+        self.itemconfig(self._title_item, text=title, state=state)
+        self.itemconfig(self._title_bg, state=state)
+        if title:
+            self._place_title(*self.image_offset())
+
+    def show_image(self, img_pil, render_start=None):
+        """
+        显示 PIL 图像；尺寸与上一帧相同时复用 PhotoImage 原地 paste
+        :param render_start: 本面板开始合成的 perf_counter 时间戳，用于统计合成耗时
+        """
+        t0 = time.perf_counter()
+        size = img_pil.size
+        if self.photo is not None and size == self.image_size:
+            self.photo.paste(img_pil)
+        else:
+            self.photo = ImageTk.PhotoImage(img_pil)
+            self.itemconfig(self._image_item, image=self.photo)
+            self.image_size = size
+            # 与原 Label 一致：请求尺寸跟随图像，固定高度模式下窗口可随之撑开
+            self.config(width=size[0], height=size[1])
+            self._on_configure()
+        self.itemconfig(self._image_item, state=tk.NORMAL)
+        self.itemconfig(self._text_item, state=tk.HIDDEN)
+
+        t1 = time.perf_counter()
+        alpha = 1.0 if self.frame_count == 0 else 0.2
+        self.blit_ms += alpha * ((t1 - t0) * 1000 - self.blit_ms)
+        if render_start is not None:
+            self.render_ms += alpha * ((t0 - render_start) * 1000 - self.render_ms)
+        self.frame_count += 1
+
+    def show_text(self, text):
+        """清空图像并显示提示文字"""
+        self.photo = None
+        self.image_size = None
+        self.frame_count = 0
+        self.itemconfig(self._image_item, image="", state=tk.HIDDEN)
+        self.itemconfig(self._text_item, text=text, state=tk.NORMAL)
+        self.hide_cursor()
+        self._on_configure()
+
+    def set_cursor_circle(self, cx, cy, radius, color):
+        """以面板坐标绘制圆形光标"""
+        r = max(radius, 1.5)
+        self.coords(self._cursor_item, cx - r, cy - r, cx + r, cy + r)
+        self.itemconfig(self._cursor_item, outline=color, state=tk.NORMAL)
+        self.tag_raise(self._cursor_item)
+
+    def hide_cursor(self):
+        self.itemconfig(self._cursor_item, state=tk.HIDDEN)
+
+
+class VirtualListbox(tk.Frame):
+    """
+    虚拟化列表 (Canvas 实现)：只为可见行创建并复用文本图元，设置/重排/滚动的开销与总行数无关
+    接口与 tk.Listbox 的常用子集一致 (size / curselection / selection_set / see)，
+    单击选中后产生 <<ListboxSelect>> 事件；find() 在名称索引上做增量查找
+    """
+
+    def __init__(self, master, bg="white", fg="black", select_bg="#3875d7", select_fg="white", **kwargs):
+        super().__init__(master, bg=bg, **kwargs)
+        self.fg = fg
+        self.select_fg = select_fg
+        self.font = tkfont.nametofont("TkDefaultFont")
+        self.row_height = self.font.metrics("linespace") + 4
+        self.items = []
+        self.top = 0 # 首个可见行
+        self.selected = None
+        self._search_text = None # 小写名称以换行拼接，find 时惰性构建
+        self._search_offsets = None # 每行在 _search_text 中的起始位置
+
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas = tk.Canvas(self, bg=bg, highlightthickness=0, bd=0, width=1, height=1)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self._select_rect = self.canvas.create_rectangle(0, 0, 0, 0, fill=select_bg, outline="", state=tk.HIDDEN)
+        self._text_items = []
+
+        self.canvas.bind("<Configure>", lambda e: self._redraw())
+        self.canvas.bind("<ButtonPress-1>", self._on_click)
+        self.canvas.bind("<MouseWheel>", self._on_wheel)
+        self.canvas.bind("<Button-4>", self._on_wheel)
+        self.canvas.bind("<Button-5>", self._on_wheel)
+
+    def visible_rows(self):
+        """完整可见的行数"""
+        return max(1, self.canvas.winfo_height() // self.row_height)
+
+    def set_items(self, items):
+        """整体替换列表内容 (不逐行插入)"""
+        self.items = list(items)
+        self.selected = None
+        self._search_text = None
+        self._search_offsets = None
+        self._set_top(0)
+
+    def size(self):
+        return len(self.items)
+
+    def get(self, row):
+        return self.items[row]
+
+    def curselection(self):
+        return () if self.selected is None else (self.selected,)
+
+    def selection_set(self, row):
+        self.selected = row if 0 <= row < len(self.items) else None
+        self._redraw()
+
+    def selection_clear(self):
+        self.selected = None
+        self._redraw()
+
+    def see(self, row):
+        """滚动使第 row 行可见"""
+        visible = self.visible_rows()
+        if row < self.top:
+            self._set_top(row)
+        elif row >= self.top + visible:
+            self._set_top(row - visible + 1)
+
+    def yview(self, *args):
+        """Scrollbar 回调: ('moveto', 比例) 或 ('scroll', n, 'units'/'pages')"""
+        if not args:
+            return
+        if args[0] == "moveto":
+            self._set_top(int(round(float(args[1]) * len(self.items))))
+        elif args[0] == "scroll":
+            step = int(args[1]) * (self.visible_rows() if args[2] == "pages" else 1)
+            self._set_top(self.top + step)
+
+    def _set_top(self, top):
+        self.top = max(0, min(int(top), len(self.items) - self.visible_rows()))
+        self._redraw()
+
+    def _redraw(self):
+        n = len(self.items)
+        rh = self.row_height
+        count = self.canvas.winfo_height() // rh + 1
+        while len(self._text_items) < count:
+            self._text_items.append(self.canvas.create_text(4, 0, anchor=tk.W, font=self.font))
+        for k, item in enumerate(self._text_items):
+            row = self.top + k
+            if k < count and row < n:
+                self.canvas.coords(item, 4, k * rh + rh // 2)
+                self.canvas.itemconfig(item, text=self.items[row], state=tk.NORMAL,
+                                       fill=self.select_fg if row == self.selected else self.fg)
+            else:
+                self.canvas.itemconfig(item, state=tk.HIDDEN)
+
+        if self.selected is not None and self.top <= self.selected < self.top + count:
+            y = (self.selected - self.top) * rh
+            self.canvas.coords(self._select_rect, 0, y, self.canvas.winfo_width(), y + rh)
+            self.canvas.itemconfig(self._select_rect, state=tk.NORMAL)
+        else:
+            self.canvas.itemconfig(self._select_rect, state=tk.HIDDEN)
+
+        if n == 0:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(self.top / n, min(1.0, (self.top + self.visible_rows()) / n))
+
+    def _on_click(self, event):
+        row = self.top + int(event.y // self.row_height)
+        if row < len(self.items):
+            self.selection_set(row)
+            self.event_generate("<<ListboxSelect>>")
+
+    def _on_wheel(self, event):
+        if getattr(event, "num", None) == 4 or getattr(event, "delta", 0) > 0:
+            self._set_top(self.top - 3)
+        else:
+            self._set_top(self.top + 3)
+
+    def find(self, query, start=0, backwards=False):
+        """
+        从 start 行开始 (循环) 查找名称以 query 开头的行，没有时退回包含 query 的行，未找到返回 None
+        所有名称拼接为一个字符串，用 str.find / rfind 在 C 层扫描，再二分定位行号
+        """
+        query = query.strip().lower()
+        if not query or not self.items:
+            return None
+        if self._search_text is None:
+            names = [str(item).lower() for item in self.items]
+            offsets, pos = [], 0
+            for name in names:
+                offsets.append(pos)
+                pos += len(name) + 1
+            self._search_text = "\n" + "\n".join(names) + "\n"
+            self._search_offsets = offsets
+
+        text, offsets = self._search_text, self._search_offsets
+        start = min(max(int(start), 0), len(offsets) - 1)
+        # _search_text 开头多一个换行，第 i 行名称从 offsets[i] + 1 开始，其前一个字符是换行
+        for pattern, shift in (("\n" + query, 1), (query, 0)):
+            if backwards:
+                end = offsets[start + 1] if start + 1 < len(offsets) else len(text)
+                pos = text.rfind(pattern, 0, end)
+                if pos < 0:
+                    pos = text.rfind(pattern)
+            else:
+                pos = text.find(pattern, offsets[start] + 1 - shift)
+                if pos < 0:
+                    pos = text.find(pattern)
+            if pos >= 0:
+                return bisect.bisect_right(offsets, pos + shift - 1) - 1
+        return None
+
+
+class SliceMinimap(tk.Canvas):
+    """
+    切片滑动条旁的热度条：上行为每层标签体素数，下行为 Pred/GT 不一致体素数 (颜色越亮越多)
+    层数多于像素宽度时按区间取最大值合并；每个区间一个矩形图元，更新时只重设颜色变化的区间
+    """
+
+    ROW_HEIGHT = 6
+    BG = "#303030"
+    COLORS = ((0, 230, 0), (255, 60, 60)) # 标签 / 不一致
+
+    def __init__(self, master, on_select=None, **kwargs):
+        super().__init__(master, height=2 * self.ROW_HEIGHT + 1, bg="#f0f0f0", highlightthickness=0, bd=0, **kwargs)
+        self.on_select = on_select
+        self.inset = 0 # 两端留白，与滑动条滑槽对齐
+        self.values = [None, None] # 每行的逐层数值
+        self.scale = [1, 1] # 每行的归一化上限
+        self.edges = np.zeros(1, dtype=np.int64) # 区间 i 覆盖 [edges[i], edges[i + 1]) 层
+        self.colors = [[], []] # 每行每个区间当前的颜色
+        self.items = [[], []]
+        self._geometry = None # (层数, 宽度)，不变时只更新颜色
+        self.bind("<Configure>", lambda e: self._layout())
+        self.bind("<ButtonPress-1>", self._on_click)
+        self.bind("<B1-Motion>", self._on_click)
+
+    def set_data(self, volume, disagree=None):
+        """设置逐层数值 (None 时清空该行)"""
+        self.values = [None if v is None else np.asarray(v, dtype=np.int64).copy() for v in (volume, disagree)]
+        self.scale = [max(1, int(v.max())) if v is not None and len(v) else 1 for v in self.values]
+        self._layout()
+
+    def clear(self):
+        self.set_data(None, None)
+
+    def update_slice(self, z, volume, disagree=None):
+        """第 z 层数值变化后只重绘其所在区间；超出归一化上限时整条重设颜色"""
+        n = self._n_slices()
+        if not 0 <= z < n:
+            return
+        b = int(np.searchsorted(self.edges, z, side="right")) - 1
+        for row, value in enumerate((volume, disagree)):
+            values = self.values[row]
+            if values is None or value is None:
+                continue
+            values[z] = value
+            if value > self.scale[row]:
+                self.scale[row] = int(value)
+                self._recolor(row, range(len(self.edges) - 1))
+            else:
+                self._recolor(row, (b,))
+
+    def _n_slices(self):
+        for values in self.values:
+            if values is not None:
+                return len(values)
+        return 0
+
+    def _layout(self):
+        """宽度或层数变化时重建区间与图元，否则只更新颜色有变化的区间"""
+        n = self._n_slices()
+        width = self.winfo_width() - 2 * self.inset
+        if n == 0 or width <= 1:
+            self.delete("bin")
+            self.items = [[], []]
+            self.colors = [[], []]
+            self._geometry = None
+            return
+        if self._geometry != (n, width):
+            self._geometry = (n, width)
+            n_bins = min(n, width)
+            self.edges = np.linspace(0, n, n_bins + 1).astype(np.int64)
+            if len(self.items[0]) != n_bins:
+                self.delete("bin")
+                self.items = [[self.create_rectangle(0, 0, 0, 0, outline="", tags="bin") for _ in range(n_bins)]
+                              for _ in range(2)]
+                self.colors = [[None] * n_bins for _ in range(2)]
+            xs = self.inset + self.edges * width / n
+            for row in range(2):
+                y0 = row * (self.ROW_HEIGHT + 1)
+                for i, item in enumerate(self.items[row]):
+                    self.coords(item, xs[i], y0, max(xs[i + 1], xs[i] + 1), y0 + self.ROW_HEIGHT)
+        for row in range(2):
+            self._recolor(row, range(len(self.edges) - 1))
+
+    def _recolor(self, row, bins):
+        values = self.values[row]
+        if values is None:
+            levels = np.zeros(len(self.edges) - 1)
+        else:
+            bin_max = np.maximum.reduceat(values, self.edges[:-1])
+            # 平方根映射：少量体素的层也清晰可见
+            levels = np.sqrt(np.minimum(bin_max / self.scale[row], 1.0))
+        bg = np.array([0x30, 0x30, 0x30])
+        fg = np.array(self.COLORS[row])
+        for b in bins:
+            level = levels[b]
+            color = self.BG if level <= 0 else "#%02x%02x%02x" % tuple(int(c) for c in bg + (fg - bg) * (0.25 + 0.75 * level))
+            if self.colors[row][b] != color:
+                self.colors[row][b] = color
+                self.itemconfigure(self.items[row][b], fill=color)
+
+    def _on_click(self, event):
+        n = self._n_slices()
+        width = self.winfo_width() - 2 * self.inset
+        if self.on_select is None or n == 0 or width <= 1:
+            return
+        z = int((event.x - self.inset) / width * n)
+        self.on_select(min(max(z, 0), n - 1))
+
+
+def label_boundaries(labels):
+    """
+    2D 标签图的边界 (4 邻域)：取值非 0 且至少一个邻居取值不同 (图像外视为 0) 的像素保留原值，其余为 0
+    :return: uint8 数组，可直接作为颜色查找表的下标
+    """
+    padded = np.pad(labels, 1)
+    center = padded[1:-1, 1:-1]
+    edge = ((center != padded[:-2, 1:-1]) | (center != padded[2:, 1:-1])
+            | (center != padded[1:-1, :-2]) | (center != padded[1:-1, 2:]))
+    edge &= center != 0
+    return np.where(edge, center, 0).astype(np.uint8)
+
+
+# 轮廓模式的颜色查找表 (RGBA)，下标为 label_boundaries 的输出
+OUTLINE_COLORS = np.zeros((256, 4), dtype=np.uint8)
+OUTLINE_COLORS[1] = [0, 255, 0, 255] # Label 1: 绿
+OUTLINE_COLORS[2] = [255, 255, 0, 255] # Label 2: 黄
+DIFF_OUTLINE_COLORS = np.zeros((256, 4), dtype=np.uint8)
+DIFF_OUTLINE_COLORS[1] = [0, 255, 0, 255] # Label 1 FP: 亮绿
+DIFF_OUTLINE_COLORS[2] = [34, 139, 34, 255] # Label 1 FN: 暗绿
+DIFF_OUTLINE_COLORS[3] = [255, 255, 0, 255] # Label 2 FP: 亮黄
+DIFF_OUTLINE_COLORS[4] = [255, 140, 0, 255] # Label 2 FN: 暗橙
+
+
+class SliceRenderer:
+    """
+    与 Tk 无关的切片渲染: 归一化、视图变换、标签叠加、缩放/平移与 RAS 物理比例重采样
+    NiiViewerApp 继承本类并提供界面状态；基准测试与批量报告可直接实例化本类离屏渲染
+    """
+
+    def __init__(self):
+        self.current_case_data = {} # 'mri', 'pred', 'gt', 'global_min', 'global_max' 等
+        self.rotation_k = 0  # 旋转次数 (k * 90度 逆时针)
+        self.zoom_level = 1.0
+        self.pan_center_x = 0.5  # 相对坐标 (0.0 - 1.0)
+        self.pan_center_y = 0.5
+        self.current_voxel_sizes = (1.0, 1.0, 1.0)  # canonical(RAS)下的(x,y,z) spacing
+        self.axis_layout_cache = {} # (id(data), axis) -> (data, 按视图顺序排列的连续副本)
+        self.gamma = 1.0
+        self.overlay_style = "fill" # "fill" 半透明填充 / "outline" 只画边界
+        self.outline_cache = OrderedDict() # (源数据 id..., 轴, 层, 旋转) -> (源数据, 边界标签图)，LRU
+        self.outline_cache_entries = 128
+        self.profiler = FrameProfiler() # 默认关闭，stage() 近似零开销
+        self.current_disp_size = None
+        self.current_view_geometry = None
+
+    def get_gamma(self):
+        """Gamma 值，界面中由滑动条提供"""
+        return self.gamma
+
+    def get_overlay_style(self):
+        """标签叠加方式 "fill" / "outline"，界面中由复选框提供"""
+        return self.overlay_style
+
+    def slice_cache_key(self, sources, axis, idx):
+        """
+        切片级缓存键：sources 为参与计算的体数据 (按身份校验，避免 id 复用)，其余为轴、层号与旋转
+        任一源为 None (如编辑中的写时复制 Mask) 时不缓存
+        """
+        if any(data is None or isinstance(data, CopyOnWriteMask) for data in sources):
+            return None
+        return tuple(sources), (axis, idx, self.rotation_k)
+
+    def cached_outline(self, cache_key, build_labels):
+        """
+        返回标签图的边界 (label_boundaries)；cache_key 非 None 时按切片 LRU 缓存，
+        轮廓模式下来回滚动或与填充模式互相切换都不重复提取
+        """
+        if cache_key is None:
+            with self.profiler.stage("outline"):
+                return label_boundaries(build_labels())
+        sources, key = cache_key
+        full_key = tuple(id(data) for data in sources) + key
+        entry = self.outline_cache.get(full_key)
+        if entry is not None and all(a is b for a, b in zip(entry[0], sources)):
+            self.outline_cache.move_to_end(full_key)
+            return entry[1]
+        with self.profiler.stage("outline"):
+            edges = label_boundaries(build_labels())
+        self.outline_cache[full_key] = (sources, edges)
+        while len(self.outline_cache) > self.outline_cache_entries:
+            self.outline_cache.popitem(last=False)
+        return edges
+
+    def normalize_mri(self, slice_data):
+        """将MRI切片归一化到 0-255 并进行 Gamma 变换"""
+        if slice_data is None:
+            return None
+            
+        with self.profiler.stage("normalize"):
+            # 使用全局统计量，如果不存在则退化为局部统计量
+            g_min = self.current_case_data.get('global_min', slice_data.min())
+            g_max = self.current_case_data.get('global_max', slice_data.max())
+        
+            # 截断数据到全局范围内
+            slice_data = np.clip(slice_data, g_min, g_max)
+        
+            if g_max == g_min:
+                return np.zeros_like(slice_data, dtype=np.uint8)
+        
+            # 线性归一化到 0-255
+            norm = (slice_data - g_min) / (g_max - g_min) * 255
+        
+            # Gamma 变换
+            gamma = self.get_gamma()
+            # 防止除以0或溢出，先归一化回0-1计算gamma再乘255
+            norm = 255 * np.power(norm / 255, 1.0 / gamma)
+        
+            return norm.astype(np.uint8)
+
+    def get_slice_view(self, data, idx):
+        """提取切片并转换为 Radiological 视图 (Ant-Top, Right-Left)"""
+        if data is None:
+            return None
+        
+        # 原始数据 (RAS): Dim 0 = L->R, Dim 1 = P->A
+        raw_slice = data[:, :, idx]
+        
+        # 转换为 Radiological View:
+        # 目标: Rows = A->P (Top=Ant), Cols = R->L (Left=Right)
+        
+        # 1. Transpose: (X, Y) -> (Y, X) => Rows: P->A, Cols: L->R
+        # 2. Flip Both: Rows: A->P, Cols: R->L
+        slice_radio = raw_slice.T[::-1, ::-1]
+        
+        # 应用用户旋转
+        if self.rotation_k != 0:
+            slice_radio = np.rot90(slice_radio, k=self.rotation_k)
+            
+        return slice_radio
+
+    def get_slice_view_axis(self, data, axis, idx):
+        """按指定轴提取切片并转换为统一视图"""
+        if data is None:
+            return None
+
+        layout = self.axis_layout_cache.get((id(data), axis))
+        if layout is not None and layout[0] is data:
+            # 已按视图顺序排好的连续副本，直接连续读取
+            slice_view = layout[1][idx]
+        else:
+            if axis == "R":
+                raw_slice = data[idx, :, :]
+            elif axis == "A":
+                raw_slice = data[:, idx, :]
+            else:  # "S"
+                raw_slice = data[:, :, idx]
+            slice_view = raw_slice.T[::-1, ::-1]
+
+        if self.rotation_k != 0:
+            slice_view = np.rot90(slice_view, k=self.rotation_k)
+        return slice_view
+
+    def create_overlay(self, mri_slice, mask_slice, color_mask_enabled=True, preview_mask=None, preview_val=1,
+                       cache_key=None):
+        """
+        创建叠加图像
+        :param mri_slice: 2D numpy array (MRI values)
+        :param mask_slice: 2D numpy array (Label values 0, 1, 2)
+        :param color_mask_enabled: bool
+        :param preview_mask: 2D boolean array (Preview mask)
+        :param preview_val: int (Label value for preview)
+        :param cache_key: slice_cache_key()，轮廓模式下用于缓存边界
+        """
+        if mri_slice is None:
+            return None
+            
+        # 1. 准备底图 MRI -> RGBA
+        mri_norm = self.normalize_mri(mri_slice)
+        with self.profiler.stage("composite"):
+            # 将灰度转为 RGBA
+            img_pil = Image.fromarray(mri_norm).convert("RGBA")
+
+            # 2. 准备 Mask 层 (包含已有 Label 和 预览)
+            if (not color_mask_enabled or mask_slice is None) and preview_mask is None:
+                return img_pil
+
+            if color_mask_enabled and mask_slice is not None and self.get_overlay_style() == "outline":
+                # 轮廓模式: 只画边界，不遮挡内部解剖结构
+                rgba_mask = OUTLINE_COLORS[self.cached_outline(cache_key, lambda: mask_slice)]
+            else:
+                rgba_mask = np.zeros((mri_slice.shape[0], mri_slice.shape[1], 4), dtype=np.uint8)
+        
+            # 绘制已有 Label
+            if color_mask_enabled and mask_slice is not None and self.get_overlay_style() != "outline":
+                # Label 1: 透明绿
+                rgba_mask[mask_slice == 1] = [0, 255, 0, 76]
+                # Label 2: 透明黄
+                rgba_mask[mask_slice == 2] = [255, 255, 0, 76] 
+
+            # 绘制预览 Label (覆盖在上面)
+            if preview_mask is not None:
+                 # 设置预览颜色，稍微不透明一点以便区分，或者加个边框效果(这里简单处理)
+                 # Label 1: 亮绿 [0, 255, 0, 150]
+                 # Label 2: 亮黄 [255, 255, 0, 150]
+                 # Eraser (val=0): 红色或者是擦除效果? 
+                 # 如果是橡皮擦，preview_val应为0，我们可以显示红色半透明表示即将被擦除的区域
+             
+                 if preview_val == 1:
+                     color = [0, 255, 0, 160]
+                 elif preview_val == 2:
+                     color = [255, 255, 0, 160]
+                 else: # Eraser / 0
+                     color = [255, 0, 0, 128] # 红色示警
+                 
+                 rgba_mask[preview_mask] = color
+
+            # 转换为 PIL Overlay
+            mask_layer = Image.fromarray(rgba_mask, mode="RGBA")
+
+            # 3. 混合
+            combined = Image.alpha_composite(img_pil, mask_layer)
+            return combined
+
+    def create_diff_overlay(self, mri_slice, pred_slice, gt_slice, cache_key=None):
+        """
+        创建差异分析图
+        Green系: Label 1 (FP=亮绿, FN=暗绿)
+        Yellow系: Label 2 (FP=亮黄, FN=暗橙黄)
+        轮廓模式下画出每类差异区域的边界 (cache_key 见 slice_cache_key)
+        """
+        mri_norm = self.normalize_mri(mri_slice)
+        img_pil = Image.fromarray(mri_norm).convert("RGBA")
+        
+        if pred_slice is None or gt_slice is None:
+            return img_pil
+
+        if self.get_overlay_style() == "outline":
+            def diff_categories():
+                # 与填充模式相同的覆盖顺序: 1=L1 FP, 2=L1 FN, 3=L2 FP, 4=L2 FN
+                categories = np.zeros(pred_slice.shape, dtype=np.uint8)
+                categories[(pred_slice == 1) & (gt_slice != 1)] = 1
+                categories[(pred_slice != 1) & (gt_slice == 1)] = 2
+                categories[(pred_slice == 2) & (gt_slice != 2)] = 3
+                categories[(pred_slice != 2) & (gt_slice == 2)] = 4
+                return categories
+
+            edges = self.cached_outline(cache_key, diff_categories)
+            with self.profiler.stage("composite"):
+                return Image.alpha_composite(img_pil, Image.fromarray(DIFF_OUTLINE_COLORS[edges], mode="RGBA"))
+            
+        with self.profiler.stage("composite"):
+            rgba_mask = np.zeros((mri_slice.shape[0], mri_slice.shape[1], 4), dtype=np.uint8)
+        
+            # --- Label 1 (Green) ---
+            # False Positive (多标): Pred=1, GT!=1 -> 亮绿色
+            # RGBA: [0, 255, 0, 100]
+            mask_fp_1 = (pred_slice == 1) & (gt_slice != 1)
+            rgba_mask[mask_fp_1] = [0, 255, 0, 100]
+        
+            # False Negative (少标/漏标): Pred!=1, GT=1 -> 暗绿色 (ForestGreen)
+            # RGBA: [34, 139, 34, 120]
+            mask_fn_1 = (pred_slice != 1) & (gt_slice == 1)
+            rgba_mask[mask_fn_1] = [34, 139, 34, 120] 
+
+            # --- Label 2 (Yellow) ---
+            # False Positive (多标): Pred=2, GT!=2 -> 亮黄色
+            # RGBA: [255, 255, 0, 100]
+            mask_fp_2 = (pred_slice == 2) & (gt_slice != 2)
+            rgba_mask[mask_fp_2] = [255, 255, 0, 100]
+        
+            # False Negative (少标/漏标): Pred!=2, GT=2 -> 暗橙色 (DarkOrange)
+            # RGBA: [255, 140, 0, 120]
+            mask_fn_2 = (pred_slice != 2) & (gt_slice == 2)
+            rgba_mask[mask_fn_2] = [255, 140, 0, 120]
+        
+            mask_layer = Image.fromarray(rgba_mask, mode="RGBA")
+            return Image.alpha_composite(img_pil, mask_layer)
+
+    def process_zoom_pan(self, img_pil, display_constraints):
+        """
+        应用缩放和平移
+        :param display_constraints: 
+            int: 固定高度模式，值为 height
+            tuple (w, h): 自适应模式，值为容器最大宽高
+        """
+        with self.profiler.stage("resize"):
+            w, h = img_pil.size
+            left, top, fov_w, fov_h, disp_w, disp_h = self.zoom_pan_geometry(w, h, display_constraints)
+
+            # 裁剪
+            crop_box = (left, top, left + fov_w, top + fov_h)
+            img_crop = img_pil.crop(crop_box)
+
+            img_final = img_crop.resize((disp_w, disp_h), Image.Resampling.NEAREST)
+            self.current_disp_size = (disp_w, disp_h)
+            self.current_view_geometry = (left, top, fov_w, fov_h, disp_w, disp_h)
+        
+            return img_final
+
+    def zoom_pan_geometry(self, w, h, display_constraints):
+        """
+        计算缩放/平移的视野与显示尺寸 (并把平移中心限制在图像内)
+        :return: (left, top, fov_w, fov_h, disp_w, disp_h)，视野坐标基于 w x h 的图像
+        """
+        # 确保 zoom_level >= 1.0
+        if self.zoom_level < 1.0:
+            self.zoom_level = 1.0
+            
+        fov_w = w / self.zoom_level
+        fov_h = h / self.zoom_level
+        
+        # 计算左上角位置
+        left = (self.pan_center_x * w) - (fov_w / 2)
+        top = (self.pan_center_y * h) - (fov_h / 2)
+        
+        # 边界限制 clamping
+        # 确保不会超出图像边界
+        if left < 0: left = 0
+        if left + fov_w > w: left = w - fov_w
+        
+        if top < 0: top = 0
+        if top + fov_h > h: top = h - fov_h
+        
+        # 更新实际中心点 (因为可能被Clamp移动了)
+        self.pan_center_x = (left + fov_w / 2) / w
+        self.pan_center_y = (top + fov_h / 2) / h
+        
+        # 计算目标显示尺寸
+        aspect_ratio = w / h
+        
+        if isinstance(display_constraints, int):
+            # 固定高度模式
+            disp_h = display_constraints
+            disp_w = int(disp_h * aspect_ratio)
+        else:
+            # 自适应模式 (max_w, max_h)
+            max_w, max_h = display_constraints
+            
+            # 防止无效尺寸
+            if max_w <= 10: max_w = 400
+            if max_h <= 10: max_h = 400
+            
+            win_ratio = max_w / max_h
+            if aspect_ratio > win_ratio:
+                # 图片更宽，以宽为准 (contain)
+                disp_w = max_w
+                disp_h = int(max_w / aspect_ratio)
+            else:
+                # 图片更高，以高为准
+                disp_h = max_h
+                disp_w = int(max_h * aspect_ratio)
+
+        return left, top, fov_w, fov_h, max(1, disp_w), max(1, disp_h)
+
+    def ras_physical_size(self, w, h, axis):
+        """返回切片按体素间距修正物理长宽比后的尺寸 (w, h)"""
+        sx, sy, sz = self.current_voxel_sizes
+        if axis == "R":
+            row_spacing, col_spacing = sz, sy   # rows=Z, cols=Y
+        elif axis == "A":
+            row_spacing, col_spacing = sz, sx   # rows=Z, cols=X
+        else:  # "S"
+            row_spacing, col_spacing = sy, sx   # rows=Y, cols=X
+
+        if row_spacing <= 0 or col_spacing <= 0:
+            return w, h
+
+        base = min(row_spacing, col_spacing)
+        target_w = max(1, int(round(w * (col_spacing / base))))
+        target_h = max(1, int(round(h * (row_spacing / base))))
+        return target_w, target_h
+
+    def adjust_ras_physical_aspect(self, img_pil, axis):
+        """按体素间距修正 R/A/S 切片的物理长宽比"""
+        if img_pil is None:
+            return img_pil
+
+        w, h = img_pil.size
+        target_w, target_h = self.ras_physical_size(w, h, axis)
+        if target_w == w and target_h == h:
+            return img_pil
+
+        return img_pil.resize((target_w, target_h), Image.Resampling.NEAREST)
+
+    def process_ras_view(self, img_pil, axis, display_constraints, resample=Image.Resampling.NEAREST):
+        """
+        RAS 窗口一次重采样完成: 物理长宽比修正 + 缩放/平移裁剪 + 缩放到显示尺寸
+        等价于 adjust_ras_physical_aspect 后再 process_zoom_pan，但只重采样一次
+        """
+        with self.profiler.stage("resize"):
+            w, h = img_pil.size
+            phys_w, phys_h = self.ras_physical_size(w, h, axis)
+            left, top, fov_w, fov_h, disp_w, disp_h = self.zoom_pan_geometry(phys_w, phys_h, display_constraints)
+
+            # 视野从物理尺寸坐标映射回原始像素坐标
+            scale_x = w / phys_w
+            scale_y = h / phys_h
+            box = (left * scale_x, top * scale_y, (left + fov_w) * scale_x, (top + fov_h) * scale_y)
+            self.current_disp_size = (disp_w, disp_h)
+            return img_pil.resize((disp_w, disp_h), resample, box=box)
+
+    def calculate_metrics(self, pred, gt):
+        """计算 Label 1 和 2 的 Dice 和 IoU"""
+        return overlap_metrics(pred, gt)
+
+    def render_panel(self, request):
+        """
+        按描述渲染一个非编辑面板 (渲染进程使用)
+        :param request: dict 'kind' ('overlay' / 'diff' / 'ras')、'idx'、'axis' (ras)、'mask' ('pred' / 'gt' / None)、
+            'show_mask'、'display_constraints'、'resample' (ras)
+        """
+        data = self.current_case_data
+        idx = request['idx']
+        mask_data = data.get(request['mask']) if request.get('mask') else None
+        if request['kind'] == "ras":
+            axis = request['axis']
+            mri_view = self.get_slice_view_axis(data['mri'], axis, idx)
+            label_view = self.get_slice_view_axis(mask_data, axis, idx)
+            img_pil = self.create_overlay(mri_view, label_view, label_view is not None,
+                                          cache_key=self.slice_cache_key((mask_data,), axis, idx))
+            return self.process_ras_view(img_pil, axis, request['display_constraints'], request['resample'])
+
+        mri_slice = self.get_slice_view(data['mri'], idx)
+        if request['kind'] == "diff":
+            img_pil = self.create_diff_overlay(mri_slice, self.get_slice_view(data['pred'], idx),
+                                               self.get_slice_view(data['gt'], idx),
+                                               self.slice_cache_key((data['pred'], data['gt']), "diff", idx))
+        else:
+            mask_slice = self.get_slice_view(mask_data, idx)
+            img_pil = self.create_overlay(mri_slice, mask_slice, request['show_mask'] and mask_slice is not None,
+                                          cache_key=self.slice_cache_key((mask_data,), "S", idx))
+        return self.process_zoom_pan(img_pil, request['display_constraints'])
+
+
+class SharedVolume:
+    """
+    multiprocessing.shared_memory 中的 3D 数组：渲染进程创建并写入，主进程按名称映射为 numpy 数组 (零拷贝)
+    """
+
+    def __init__(self, shm, shape, dtype, owner):
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = owner # 创建者负责 unlink
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, shape, dtype):
+        nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        return cls(shared_memory.SharedMemory(create=True, size=nbytes), shape, dtype, owner=True)
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False) # Python 3.13+
+        except TypeError:
+            # 旧版本映射时也会登记到 resource_tracker；渲染进程由本进程 spawn，共用同一个 tracker，重复登记无影响
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, shape, dtype, owner=False)
+
+    def spec(self):
+        return self.shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        """释放映射；仍有 numpy 视图引用时抛出 BufferError，由调用方稍后重试"""
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _decode_case_shared(case):
+    """渲染进程中解码病例 (RAS 方向) 到共享内存，返回 (SharedVolume 字典, 元数据)"""
+    img = nib.load(case['mri_path'])
+    ornt, canonical_affine, voxel_sizes = canonical_geometry(img)
+    dataobj = img.dataobj[..., 0] if len(img.shape) == 4 else img.dataobj
+    arrays = {'mri': nib.orientations.apply_orientation(np.asarray(dataobj, dtype=np.float32), ornt)}
+    for key, path_key in (('pred', 'pred_path'), ('gt', 'gt_path')):
+        if case.get(path_key):
+            arrays[key] = load_canonical(case[path_key], np.int8)[0]
+
+    shared = {}
+    for key, data in arrays.items():
+        shared[key] = SharedVolume.create(data.shape, data.dtype)
+        np.copyto(shared[key].array, data)
+    g_min, g_max = intensity_range(shared['mri'].array)
+    meta = {}
+    if 'pred' in arrays and 'gt' in arrays and arrays['pred'].shape == arrays['gt'].shape:
+        meta['metrics'] = tuple(float(v) for v in overlap_metrics(arrays['pred'], arrays['gt']))
+    meta.update({
+        'ref_affine': img.affine,
+        'ref_header': img.header.copy(),
+        'canonical_affine': canonical_affine,
+        'voxel_sizes': voxel_sizes,
+        'global_min': float(g_min),
+        'global_max': float(g_max)
+    })
+    return shared, meta
+
+
+def render_worker_main(requests, results):
+    """
+    渲染进程主循环
+    请求: ('load', token, case) / ('render', token, panel, seq, request) / ('release', token) / ('stop',)
+    结果: ('loaded', token, {key: spec}, meta) / ('frame', token, panel, seq, mode, size, bytes) /
+          ('error', token, panel, seq, message)
+    """
+    cases = {} # token -> (SharedVolume 字典, SliceRenderer)
+    try:
+        while True:
+            msg = requests.get()
+            kind = msg[0]
+            if kind == "stop":
+                break
+            if kind == "release":
+                shared, _ = cases.pop(msg[1], ({}, None))
+                for volume in shared.values():
+                    volume.close()
+                continue
+
+            token = msg[1]
+            panel = msg[2] if kind == "render" else None
+            seq = msg[3] if kind == "render" else None
+            try:
+                if kind == "load":
+                    shared, meta = _decode_case_shared(msg[2])
+                    renderer = SliceRenderer()
+                    renderer.current_case_data = {key: volume.array for key, volume in shared.items()}
+                    renderer.current_case_data['global_min'] = meta['global_min']
+                    renderer.current_case_data['global_max'] = meta['global_max']
+                    renderer.current_voxel_sizes = meta['voxel_sizes']
+                    cases[token] = (shared, renderer)
+                    results.put(("loaded", token, {key: volume.spec() for key, volume in shared.items()}, meta))
+                elif kind == "render":
+                    if token not in cases:
+                        continue # 病例已释放，请求过期
+                    request = msg[4]
+                    renderer = cases[token][1]
+                    for attr in ("rotation_k", "zoom_level", "pan_center_x", "pan_center_y", "gamma", "overlay_style"):
+                        setattr(renderer, attr, request[attr])
+                    img = renderer.render_panel(request)
+                    results.put(("frame", token, panel, seq, img.mode, img.size, img.tobytes()))
+            except Exception as e:
+                results.put(("error", token, panel, seq, f"{type(e).__name__}: {e}"))
+    finally:
+        for shared, _ in cases.values():
+            for volume in shared.values():
+                volume.close()
+
+
+class RenderWorker:
+    """
+    解码/渲染进程的主进程侧代理
+    每个面板同一时刻最多一个渲染请求在途，新请求只覆盖待发送的那一个 (最新优先)，
+    结果按 (token, seq) 校验，过期的直接丢弃；主进程只在 poll() 中非阻塞地取结果
+    """
+
+    def __init__(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=render_worker_main, args=(self.requests, self.results), daemon=True)
+        self.process.start()
+        self.loading = None # 正在解码的 token
+        self.inflight = {} # panel -> (token, seq, t_start)
+        self.pending = {} # panel -> (token, seq, request, t_start)
+        self.shown_seq = {} # panel -> 最近显示的 seq
+        self.shared = {} # token -> {key: SharedVolume} (主进程映射)
+        self._retired = [] # 待关闭的映射 (仍被引用时稍后重试)
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def busy(self):
+        return self.loading is not None or bool(self.inflight)
+
+    def load_case(self, token, case):
+        self.loading = token
+        self.requests.put(("load", token, case))
+
+    def render(self, token, panel, seq, request, t_start):
+        if panel in self.inflight:
+            self.pending[panel] = (token, seq, request, t_start)
+            return
+        self.inflight[panel] = (token, seq, t_start)
+        self.requests.put(("render", token, panel, seq, request))
+
+    def attach(self, token, specs):
+        self.shared[token] = {key: SharedVolume.attach(spec) for key, spec in specs.items()}
+        return {key: volume.array for key, volume in self.shared[token].items()}
+
+    def release(self, token):
+        """丢弃病例：渲染进程立即 unlink，主进程映射在不再被引用后关闭"""
+        if token in self.shared:
+            self._retired.extend(self.shared.pop(token).values())
+        self.requests.put(("release", token))
+        self.close_retired()
+
+    def close_retired(self):
+        remaining = []
+        for volume in self._retired:
+            try:
+                volume.close()
+            except BufferError:
+                remaining.append(volume)
+        self._retired = remaining
+
+    def poll(self):
+        """
+        非阻塞取回结果
+        :return: 消息列表；'frame' 消息附带 t_start 并已转换为 PIL 图像，过期帧不返回
+        """
+        messages = []
+        while True:
+            try:
+                msg = self.results.get_nowait()
+            except queue.Empty:
+                break
+            kind = msg[0]
+            if kind == "loaded" or (kind == "error" and msg[2] is None):
+                if msg[1] == self.loading:
+                    self.loading = None
+                messages.append(msg)
+                continue
+
+            _, token, panel, seq = msg[:4]
+            t_start = self.inflight.pop(panel, (None, None, None))[2]
+            pending = self.pending.pop(panel, None)
+            if pending is not None:
+                self.render(pending[0], panel, pending[1], pending[2], pending[3])
+            if kind == "frame" and seq > self.shown_seq.get(panel, -1):
+                self.shown_seq[panel] = seq
+                mode, size, data = msg[4:]
+                messages.append(("frame", token, panel, seq, Image.frombuffer(mode, size, data, "raw", mode, 0, 1), t_start))
+            elif kind == "error":
+                messages.append(msg)
+        return messages
+
+    def stop(self):
+        try:
+            self.requests.put(("stop",))
+            self.process.join(timeout=1.0)
+        finally:
+            if self.process.is_alive():
+                self.process.terminate()
+            for token in list(self.shared):
+                self._retired.extend(self.shared.pop(token).values())
+            self.close_retired()
+
+
+class NiiViewerApp(SliceRenderer):
     def __init__(self, root):
+        super().__init__() # 渲染状态: current_case_data / 缩放平移 / 旋转 / spacing 等
         self.root = root
         self.root.title("NIfTI Viewer - MRI & Segmentation Comparator")
         self.root.geometry("1400x800")
@@ -15,10 +2640,20 @@ class NiiViewerApp:
         self.current_slice_index = 0
         self.total_slices = 0
         self.root_dir = ""
-        self.valid_cases = [] # 存储字典: {'name': str, 'mri_path': str, 'pred_path': str, 'gt_path': str or None}
-        self.current_case_data = {} # 存储加载后的numpy数组: 'mri', 'pred', 'gt'
+        self.valid_cases = [] # 存储字典: {'name': str, 'mri_path': str, 'channel_paths': list, 'pred_path': str, 'gt_path': str or None}
         self.has_pred_folder = False
         self.has_gt_folder = False
+
+        # 病例列表排序/筛选：值来自缓存的病例指标表，不在切换时读取文件
+        self.metric_table = None # CaseMetricTable，扫描后在后台进程池中补算过期记录
+        self.case_view = np.zeros(0, dtype=np.int64) # 列表中各行对应的 valid_cases 下标
+        self._case_columns = {} # 排序/筛选用的列 (长度同 valid_cases)，指标表更新时重建
+        self.current_case_index = None # 当前加载病例在 valid_cases 中的下标
+        self.case_sort_key = tk.StringVar(value="名称")
+        self.case_sort_desc = tk.BooleanVar(value=False)
+        self.case_filter = tk.StringVar(value="全部")
+        self.case_filter_threshold = tk.DoubleVar(value=0.8)
+        self.case_search_text = tk.StringVar(value="")
         
         # 显示设置变量
         self.status_msg = tk.StringVar(value="请选择根文件夹 (需包含 imagesTr [必须], predictsTr [可选], labelsTr [可选])")
@@ -26,6 +2661,7 @@ class NiiViewerApp:
         self.status_metrics_msg = tk.StringVar(value="") # 状态栏的指标信息
         self.gamma_val = tk.DoubleVar(value=1.0)
         self.show_pred = tk.BooleanVar(value=True)
+        self.outline_mode = tk.BooleanVar(value=False) # 标签只画轮廓
         self.show_gt = tk.BooleanVar(value=True)
         self.auto_fit_window = tk.BooleanVar(value=True) # 新增自适应变量
         self.layout_mode = tk.StringVar(value="dual") # dual, left, right, diff, ras
@@ -33,11 +2669,7 @@ class NiiViewerApp:
         self.metrics_text = tk.StringVar(value="")
         self.case_list_title = tk.StringVar(value="病例列表 (0):")
 
-        # 缩放和平移状态
-        self.rotation_k = 0  # 旋转次数 (k * 90度 逆时针)
-        self.zoom_level = 1.0
-        self.pan_center_x = 0.5  # 相对坐标 (0.0 - 1.0)
-        self.pan_center_y = 0.5
+        # 平移拖拽起点 (缩放/平移状态见 SliceRenderer)
         self.drag_start_x = 0
         self.drag_start_y = 0
 
@@ -47,10 +2679,15 @@ class NiiViewerApp:
         self.edit_label_val = tk.IntVar(value=1) # 1 or 2
         self.brush_size = tk.IntVar(value=1)
         self.wand_tolerance = tk.IntVar(value=5)
-        self.undo_stack = [] # List[Tuple(slice_idx, slice_data_copy)]
+        self.volume_tool_mode = tk.BooleanVar(value=False) # 魔棒/填充作用于整个 3D 体
+        self.volume_connectivity = tk.IntVar(value=6) # 6 或 26 邻域
+        self.undo_stack = [] # List[Tuple('slice', slice_idx, slice_data_copy) | Tuple('slices', [(slice_idx, slice_data_copy), ...])]
         self.last_export_dir = os.path.expanduser("~")
-        self.editable_mask = None # 3D numpy array
+        self.editable_mask = None # CopyOnWriteMask (RAS)，仅保存修改过的切片
+        self.label_index = None # LabelSliceIndex，加载后在后台计算，编辑时按层增量更新
+        self._minimap_source = None # 热度条当前显示的标签来源 ('pred' / 'gt' / 'edit')
         self.edit_source = None # 'gt', 'pred', 'blank'
+        self.edit_journal = None # EditJournal，当前病例的崩溃恢复日志
         self.is_drawing = False
         self.last_img_coords = None # (x, y) image coordinates for interpolation
         self.preview_cursor_pos = None # (x, y) internal image coordinates
@@ -59,17 +2696,89 @@ class NiiViewerApp:
         self.ras_index_r = 0
         self.ras_index_a = 0
         self.ras_index_s = 0
-        self.current_voxel_sizes = (1.0, 1.0, 1.0)  # canonical(RAS)下的(x,y,z) spacing
-
-        # 防止图片被垃圾回收
-        self.tk_img_left = None
-        self.tk_img_right = None
-        self.tk_img_ras_r = None
-        self.tk_img_ras_a = None
-        self.tk_img_ras_s = None
+        self.export_compress_level = tk.IntVar(value=1) # 导出 gzip 压缩级别 (1-9)
+
+        # 后台任务: name -> {'on_done': callable, 'token': int}
+        self.case_token = 0 # 每次切换病例/根目录递增，用于丢弃过期的后台结果
+        self._bg_tasks = {}
+        self._bg_queue = queue.Queue()
+
+        # RAS 轴向连续缓存 (缓存字典 axis_layout_cache 见 SliceRenderer)
+        self.axis_layout_enabled = tk.BooleanVar(value=False)
+        self.axis_layout_info = tk.StringVar(value="")
+
+        # 大体数据多分辨率金字塔: id(data) -> (data, {2: 2倍下采样, 4: ..., 8: ...})
+        self.pyramid_enabled = tk.BooleanVar(value=True)
+        self.pyramid_disk_cache = tk.BooleanVar(value=False)
+        self.pyramid_cache = {}
+        self.pyramid_factors = (2, 4, 8)
+        self.pyramid_min_voxels = 512 * 512 * 256 # 小于该体素数的体数据直接按原分辨率渲染
+        self.pyramid_info = tk.StringVar(value="")
+
+        # RAS 窗口重采样质量：交互时最近邻，停止滚动 ras_hq_delay_ms 后用高质量滤波重绘
+        self.ras_hq_filter = tk.StringVar(value="bilinear") # nearest, bilinear, lanczos
+        # RAS 三窗投影: slice 切片 / mip 最大强度投影 / minip 最小强度投影；厚度 0 表示整个体积
+        self.ras_projection = tk.StringVar(value="slice")
+        self.slab_thickness = tk.IntVar(value=0)
+        self.full_projections = None # (mri, 标签, {(方向, op): 2D})，整卷投影每个病例只算一次
+        self.slab_projectors = {} # (id(data), 方向, op, 厚度) -> SlabProjector
+        self._ras_titles = {}
+        self.ras_hq_delay_ms = 200
+        self._ras_hq_pass = False
+        self._ras_hq_after_id = None
+
+        self._pending_channel = None # 等待后台解码完成后切换的通道
+
+        # 独立渲染进程 (可选): 病例解码到共享内存，非编辑面板在渲染进程中合成，主进程只显示位图
+        self.render_process_enabled = tk.BooleanVar(value=False)
+        self.render_worker = None # RenderWorker
+        self._pending_worker_case = None
+        self._render_seq = 0
+        self._render_poll_after_id = None
+
+        # 4D 序列: 时间轴惰性读取 + 电影回放 (cine)
+        self.time_series = None # TimeSeriesVolume，仅 4D 病例存在
+        self.time_index = 0
+        self.time_info_text = tk.StringVar(value="")
+        self.cine_playing = False
+        self.cine_fps = tk.IntVar(value=15)
+        self.cine_prefetch = 16 # 预取后续时间点数量，缓存容量为其 3 倍
+        self._cine_after_id = None
+        self._cine_deadline = 0.0
+        self._cine_last_shown = None
+        self._cine_measured_fps = 0.0
+        self._time_wait_after_id = None
+
+        # 显示面板为 ImagePanel，各自持有并复用 PhotoImage；这里只记录当前已 pack 的布局，避免每帧重排
+        self._packed_layout = None
+        self.frame_time_info = tk.StringVar(value="")
+
+        # 分阶段性能分析 (self.profiler 见 SliceRenderer): 状态栏 HUD，最多每 hud_interval 秒刷新一次
+        self.profiler_enabled = tk.BooleanVar(value=False)
+        self.profiler_hud = tk.StringVar(value="")
+        self.hud_interval = 0.25
+        self._hud_last_update = 0.0
+
+        # 内存占用统计: 各数据/缓存登记到 memory_registry；RSS 超过高水位 (MB，0 为关闭) 时按优先级回收缓存
+        self.memory_registry = MemoryRegistry()
+        phys_mb = physical_memory_bytes() // 1024 ** 2
+        self.memory_high_water_mb = tk.IntVar(value=int(phys_mb * 0.8))
+        self.memory_check_interval_ms = 2000
+        self.memory_pressure = False # 当前病例触发过高水位回收后，不再自动重建可选缓存
+        self.memory_window = None
+        self._memory_tree = None
+        self._memory_rss_text = tk.StringVar(value="")
 
         # --- UI 布局 ---
         self._setup_ui()
+        self.register_memory_consumers()
+        self.root.after(self.memory_check_interval_ms, self.check_memory_high_water)
+
+    def get_gamma(self):
+        return self.gamma_val.get()
+
+    def get_overlay_style(self):
+        return "outline" if self.outline_mode.get() else "fill"
 
     def _create_collapsible_panel(self, parent, title, is_collapsed=True):
         """Helper to create a collapsible LabelFrame-like structure"""
@@ -136,6 +2845,11 @@ class NiiViewerApp:
 
         rb_fill = tk.Radiobutton(self.tool_frame, text="填充", variable=self.current_tool, value="fill", bg="#e0e0e0", fg="black")
         rb_fill.pack(side=tk.LEFT)
+
+        # 3D 模式 (魔棒/填充作用于整个体数据)
+        tk.Checkbutton(self.tool_frame, text="3D", variable=self.volume_tool_mode, bg="#e0e0e0", fg="black").pack(side=tk.LEFT, padx=(5, 0))
+        tk.Radiobutton(self.tool_frame, text="6邻域", variable=self.volume_connectivity, value=6, bg="#e0e0e0", fg="black").pack(side=tk.LEFT)
+        tk.Radiobutton(self.tool_frame, text="26邻域", variable=self.volume_connectivity, value=26, bg="#e0e0e0", fg="black").pack(side=tk.LEFT)
         
         # Label Value
         tk.Label(self.tool_frame, text="| 标签值:", bg="#e0e0e0", fg="black").pack(side=tk.LEFT, padx=5)
@@ -157,7 +2871,10 @@ class NiiViewerApp:
         ttk.Button(self.tool_frame, text="撤销 (Ctrl+Z)", command=self.undo_action).pack(side=tk.LEFT, padx=(20, 5))
         ttk.Button(self.tool_frame, text="反转 1↔2", command=self.invert_current_slice_labels).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.tool_frame, text="反转序列", command=self.reverse_label_sequence).pack(side=tk.LEFT, padx=5)
+        ttk.Button(self.tool_frame, text="层间插值", command=self.interpolate_label_slices).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.tool_frame, text="导出 Label", command=self.export_label).pack(side=tk.LEFT, padx=5)
+        tk.Label(self.tool_frame, text="压缩级别:", bg="#e0e0e0", fg="black").pack(side=tk.LEFT, padx=(5, 2))
+        ttk.Spinbox(self.tool_frame, from_=1, to=9, textvariable=self.export_compress_level, width=2).pack(side=tk.LEFT)
 
         # 0. 底部状态栏 (提示栏)
         # 增大高度：使用 Frame + height / padding
@@ -176,6 +2893,13 @@ class NiiViewerApp:
                                            fg="blue", bg="#f8f8f8", font=("Arial", 11, "bold"))
         self.lbl_metrics_bottom.pack(side=tk.LEFT, padx=(30, 0))
 
+        # 右侧：性能分析 HUD (仅在开启性能分析时有内容)
+        tk.Label(status_frame, textvariable=self.profiler_hud, fg="#805000", bg="#f8f8f8",
+                 font=("Courier", 10)).pack(side=tk.RIGHT, padx=(0, 20))
+
+        # 右侧：后台任务进度 (仅在任务运行时显示)
+        self.progress_bar = ttk.Progressbar(status_frame, orient=tk.HORIZONTAL, length=160, mode="determinate")
+
         # 动态绑定颜色 (针对状态消息)
         self.root.bind_all("<<UpdateStatusColor>>", lambda e: self.lbl_status.config(fg=self.status_color.get()))
 
@@ -192,10 +2916,46 @@ class NiiViewerApp:
         # 文件夹列表
         lbl_list = tk.Label(sidebar, textvariable=self.case_list_title, bg="#f0f0f0", fg="black", anchor="w")
         lbl_list.pack(fill=tk.X)
-        self.case_listbox = tk.Listbox(sidebar, selectmode=tk.SINGLE, fg="black", bg="white")
+
+        sort_row = tk.Frame(sidebar, bg="#f0f0f0")
+        sort_row.pack(fill=tk.X, pady=(2, 0))
+        tk.Label(sort_row, text="排序:", bg="#f0f0f0", fg="black").pack(side=tk.LEFT)
+        cb_sort = ttk.Combobox(sort_row, textvariable=self.case_sort_key, values=list(CASE_SORT_FIELDS),
+                               state="readonly", width=14)
+        cb_sort.pack(side=tk.LEFT, padx=2)
+        cb_sort.bind("<<ComboboxSelected>>", lambda e: self.refresh_case_list())
+        tk.Checkbutton(sort_row, text="降序", variable=self.case_sort_desc, command=self.refresh_case_list,
+                       bg="#f0f0f0", fg="black").pack(side=tk.LEFT)
+
+        filter_row = tk.Frame(sidebar, bg="#f0f0f0")
+        filter_row.pack(fill=tk.X, pady=(2, 0))
+        tk.Label(filter_row, text="筛选:", bg="#f0f0f0", fg="black").pack(side=tk.LEFT)
+        cb_filter = ttk.Combobox(filter_row, textvariable=self.case_filter, values=CASE_FILTERS,
+                                 state="readonly", width=14)
+        cb_filter.pack(side=tk.LEFT, padx=2)
+        cb_filter.bind("<<ComboboxSelected>>", lambda e: self.refresh_case_list())
+        ttk.Spinbox(filter_row, from_=0.0, to=1.0, increment=0.05, width=4, textvariable=self.case_filter_threshold,
+                    command=self.refresh_case_list).pack(side=tk.LEFT)
+
+        search_row = tk.Frame(sidebar, bg="#f0f0f0")
+        search_row.pack(fill=tk.X, pady=(2, 0))
+        tk.Label(search_row, text="搜索:", bg="#f0f0f0", fg="black").pack(side=tk.LEFT)
+        entry_search = ttk.Entry(search_row, textvariable=self.case_search_text)
+        entry_search.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
+        # 不经过根窗口的快捷键绑定 (w/s/a/d/c/p 等)，输入框内可正常输入
+        entry_search.bindtags((str(entry_search), "TEntry", "all"))
+        entry_search.bind("<Return>", lambda e: self.open_searched_case())
+        entry_search.bind("<Down>", lambda e: self.search_case(step=1))
+        entry_search.bind("<Up>", lambda e: self.search_case(step=-1))
+        entry_search.bind("<Escape>", lambda e: (self.case_search_text.set(""), self.root.focus_set()))
+        self.case_search_text.trace_add("write", lambda *args: self.search_case())
+
+        # 虚拟化列表：只绘制可见行，数万个病例也能即时刷新
+        self.case_listbox = VirtualListbox(sidebar, fg="black", bg="white")
         self.case_listbox.pack(fill=tk.BOTH, expand=True, pady=5)
         self.case_listbox.bind('<<ListboxSelect>>', self.load_selected_case)
-        ttk.Button(sidebar, text="查看数据统计", command=self.show_dataset_statistics).pack(fill=tk.X, pady=(0, 10))
+        ttk.Button(sidebar, text="查看数据统计", command=self.show_dataset_statistics).pack(fill=tk.X, pady=(0, 5))
+        ttk.Button(sidebar, text="内存占用", command=self.show_memory_panel).pack(fill=tk.X, pady=(0, 10))
 
         # 控制区 (Changed to collapsible)
         ctrl_frame = self._create_collapsible_panel(sidebar, "显示控制", is_collapsed=True)
@@ -215,11 +2975,27 @@ class NiiViewerApp:
         self.chk_gt = tk.Checkbutton(ctrl_frame, text="显示真值 (GT)", variable=self.show_gt, 
                                 bg="#f0f0f0", fg="black", command=self.update_display)
         self.chk_gt.pack(anchor="w")
+        tk.Checkbutton(ctrl_frame, text="轮廓显示 (只画标签边界)", variable=self.outline_mode,
+                       bg="#f0f0f0", fg="black", command=self.update_display).pack(anchor="w")
 
         # 旋转按钮
         btn_rot = ttk.Button(ctrl_frame, text="旋转 90°", command=self.rotate_image)
         btn_rot.pack(fill=tk.X, pady=(5, 0))
 
+        # RAS 轴向连续缓存 (以内存换取 R/A 平面的连续读取)
+        tk.Checkbutton(ctrl_frame, text="RAS 轴向连续缓存", variable=self.axis_layout_enabled,
+                       bg="#f0f0f0", fg="black", command=self.on_axis_layout_toggle).pack(anchor="w", pady=(5, 0))
+        tk.Label(ctrl_frame, textvariable=self.axis_layout_info, bg="#f0f0f0", fg="gray").pack(anchor="w")
+
+        # 大体数据多分辨率金字塔 (缩小显示时从低分辨率层取切片)
+        tk.Checkbutton(ctrl_frame, text="大体数据多分辨率金字塔", variable=self.pyramid_enabled,
+                       bg="#f0f0f0", fg="black", command=self.on_pyramid_toggle).pack(anchor="w")
+        tk.Checkbutton(ctrl_frame, text="金字塔写入磁盘缓存", variable=self.pyramid_disk_cache,
+                       bg="#f0f0f0", fg="black").pack(anchor="w")
+        tk.Label(ctrl_frame, textvariable=self.pyramid_info, bg="#f0f0f0", fg="gray").pack(anchor="w")
+        tk.Checkbutton(ctrl_frame, text="独立渲染进程 (解码/合成)", variable=self.render_process_enabled,
+                       bg="#f0f0f0", fg="black", command=self.on_render_process_toggle).pack(anchor="w")
+
         # 布局控制 (Changed to collapsible)
         layout_frame = self._create_collapsible_panel(sidebar, "窗口布局", is_collapsed=True)
         
@@ -241,6 +3017,34 @@ class NiiViewerApp:
         tk.Radiobutton(layout_frame, text="RAS 三窗 (R/A/S)", variable=self.layout_mode, value="ras",
                        bg="#f0f0f0", fg="black", command=self.update_display).pack(anchor="w")
 
+        tk.Label(layout_frame, text="RAS 静止后重采样:", bg="#f0f0f0", fg="black").pack(anchor="w", pady=(5, 0))
+        ras_filter_frame = tk.Frame(layout_frame, bg="#f0f0f0")
+        ras_filter_frame.pack(anchor="w")
+        for text, value in (("最近邻", "nearest"), ("双线性", "bilinear"), ("Lanczos", "lanczos")):
+            tk.Radiobutton(ras_filter_frame, text=text, variable=self.ras_hq_filter, value=value,
+                           bg="#f0f0f0", fg="black", command=self.update_display).pack(side=tk.LEFT)
+        tk.Label(layout_frame, text="RAS 三窗显示:", bg="#f0f0f0", fg="black").pack(anchor="w", pady=(5, 0))
+        projection_frame = tk.Frame(layout_frame, bg="#f0f0f0")
+        projection_frame.pack(anchor="w")
+        for text, value in (("切片", "slice"), ("MIP", "mip"), ("MinIP", "minip")):
+            tk.Radiobutton(projection_frame, text=text, variable=self.ras_projection, value=value,
+                           bg="#f0f0f0", fg="black", command=self.update_display).pack(side=tk.LEFT)
+        slab_frame = tk.Frame(layout_frame, bg="#f0f0f0")
+        slab_frame.pack(anchor="w")
+        tk.Label(slab_frame, text="投影厚度 (层，0=整卷):", bg="#f0f0f0", fg="black").pack(side=tk.LEFT)
+        slab_spin = tk.Spinbox(slab_frame, from_=0, to=1024, width=5, textvariable=self.slab_thickness,
+                               command=self.update_display)
+        slab_spin.pack(side=tk.LEFT)
+        slab_spin.bind("<Return>", lambda e: self.update_display())
+        tk.Label(layout_frame, textvariable=self.frame_time_info, bg="#f0f0f0", fg="gray").pack(anchor="w")
+
+        # 分阶段性能分析: 状态栏显示 FPS/各阶段耗时，可导出 Chrome trace
+        profiler_frame = tk.Frame(layout_frame, bg="#f0f0f0")
+        profiler_frame.pack(anchor="w", fill=tk.X, pady=(5, 0))
+        tk.Checkbutton(profiler_frame, text="性能分析 HUD", variable=self.profiler_enabled,
+                       bg="#f0f0f0", fg="black", command=self.on_profiler_toggle).pack(side=tk.LEFT)
+        ttk.Button(profiler_frame, text="导出 Trace", command=self.export_profile_trace).pack(side=tk.LEFT, padx=(5, 0))
+
         # 自适应窗口开关
         chk_autofit = tk.Checkbutton(layout_frame, text="自适应窗口大小", variable=self.auto_fit_window, 
                                      bg="#f0f0f0", fg="black", command=self.update_display)
@@ -249,6 +3053,7 @@ class NiiViewerApp:
         # 切片控制
         slice_frame = tk.Frame(sidebar, bg="#f0f0f0")
         slice_frame.pack(fill=tk.X, pady=(20, 10))
+        self.slice_frame = slice_frame
         
         tk.Label(slice_frame, text="Slice Navigation:", bg="#f0f0f0", fg="black").pack(anchor="w")
         
@@ -256,10 +3061,31 @@ class NiiViewerApp:
                                     bg="#f0f0f0", fg="black", highlightthickness=0,
                                     command=self.on_slider_change)
         self.slice_scale.pack(fill=tk.X)
+        # 热度条：每层标签体素数 / Pred-GT 不一致数，点击或拖动跳层
+        self.slice_minimap = SliceMinimap(slice_frame, on_select=self.goto_slice)
+        self.slice_minimap.inset = (int(self.slice_scale.cget("sliderlength")) // 2
+                                    + int(self.slice_scale.cget("borderwidth"))
+                                    + int(self.slice_scale.cget("highlightthickness")))
+        self.slice_minimap.pack(fill=tk.X)
         
         self.lbl_slice_info = tk.Label(slice_frame, textvariable=self.slice_info_text, bg="#f0f0f0", fg="black", font=("Arial", 12, "bold"))
         self.lbl_slice_info.pack(anchor="c")
 
+        # 时间轴控制 (仅 4D 病例显示)
+        self.time_frame = tk.Frame(sidebar, bg="#f0f0f0")
+        tk.Label(self.time_frame, text="Time Navigation:", bg="#f0f0f0", fg="black").pack(anchor="w")
+        self.time_scale = tk.Scale(self.time_frame, from_=0, to=0, orient=tk.HORIZONTAL,
+                                   bg="#f0f0f0", fg="black", highlightthickness=0,
+                                   command=self.on_time_slider_change)
+        self.time_scale.pack(fill=tk.X)
+        cine_row = tk.Frame(self.time_frame, bg="#f0f0f0")
+        cine_row.pack(fill=tk.X)
+        self.btn_cine = ttk.Button(cine_row, text="▶ 播放", width=8, command=self.toggle_cine)
+        self.btn_cine.pack(side=tk.LEFT)
+        tk.Label(cine_row, text="FPS:", bg="#f0f0f0", fg="black").pack(side=tk.LEFT, padx=(8, 0))
+        tk.Spinbox(cine_row, from_=1, to=60, width=4, textvariable=self.cine_fps).pack(side=tk.LEFT)
+        tk.Label(self.time_frame, textvariable=self.time_info_text, bg="#f0f0f0", fg="black").pack(anchor="c")
+
         # 评估指标
         lbl_metrics = tk.Label(sidebar, textvariable=self.metrics_text, bg="#f0f0f0", fg="black", justify=tk.LEFT, font=("Courier", 14, "bold"))
         lbl_metrics.pack(pady=10, fill=tk.X)
@@ -271,14 +3097,14 @@ class NiiViewerApp:
         self.main_panel.bind("<Configure>", self.on_resize)
 
         # 分为左右两块
-        self.panel_left = tk.Label(self.main_panel, bg="#e0e0e0", text="MRI + Prediction", fg="black")
+        self.panel_left = ImagePanel(self.main_panel, text="MRI + Prediction")
         self.panel_left.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
         
-        self.panel_right = tk.Label(self.main_panel, bg="#e0e0e0", text="MRI + Ground Truth", fg="black")
+        self.panel_right = ImagePanel(self.main_panel, text="MRI + Ground Truth")
         self.panel_right.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=2)
-        self.panel_ras_r = tk.Label(self.main_panel, bg="#e0e0e0", text="R", fg="black", font=("Arial", 12, "bold"))
-        self.panel_ras_a = tk.Label(self.main_panel, bg="#e0e0e0", text="A", fg="black", font=("Arial", 12, "bold"))
-        self.panel_ras_s = tk.Label(self.main_panel, bg="#e0e0e0", text="S", fg="black", font=("Arial", 12, "bold"))
+        self.panel_ras_r = ImagePanel(self.main_panel, text="R", title="R")
+        self.panel_ras_a = ImagePanel(self.main_panel, text="A", title="A")
+        self.panel_ras_s = ImagePanel(self.main_panel, text="S", title="S")
 
         # 绑定鼠标滚轮事件 (Windows/Linux/Mac兼容)
         # Note: Linux 使用 Button-4/5, Windows/Mac 使用 MouseWheel
@@ -334,10 +3160,32 @@ class NiiViewerApp:
         self.root.bind("<Down>", lambda e: self.move_case(1))
         self.root.bind("w", lambda e: self.move_case(-1))
         self.root.bind("s", lambda e: self.move_case(1))
+        # 4D 序列: p 播放/暂停，逗号/句号逐帧
+        self.root.bind("p", lambda e: self.toggle_cine())
+        # 多通道病例: c / Shift+c 切换通道
+        self.root.bind("c", lambda e: self.cycle_channel(1))
+        self.root.bind("C", lambda e: self.cycle_channel(-1))
+        self.root.bind("<comma>", lambda e: self.move_time(-1))
+        self.root.bind("<period>", lambda e: self.move_time(1))
+        # 标签导航: ] / [ 下一个/上一个含标签的层，} / { 下一个/上一个 Pred/GT 不一致的层
+        self.root.bind("<bracketright>", lambda e: self.jump_label_slice(1))
+        self.root.bind("<bracketleft>", lambda e: self.jump_label_slice(-1))
+        self.root.bind("<braceright>", lambda e: self.jump_label_slice(1, disagreement=True))
+        self.root.bind("<braceleft>", lambda e: self.jump_label_slice(-1, disagreement=True))
+
+        # 关闭窗口前把编辑日志落盘
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
         # 初始化工具栏状态 (必须在 UI 元素创建完成后调用)
         self.toggle_edit_mode()
 
+    def on_close(self):
+        """关闭窗口"""
+        self.close_edit_journal()
+        self.close_time_series()
+        self.stop_render_worker()
+        self.root.destroy()
+
     def toggle_edit_mode(self):
         """切换编辑模式状态"""
         is_editing = self.edit_mode.get()
@@ -359,18 +3207,7 @@ class NiiViewerApp:
             
             # 如果editable_mask未初始化，则根据优先级设置
             if self.editable_mask is None and self.current_case_data:
-                gt_data = self.current_case_data.get('gt')
-                pred_data = self.current_case_data.get('pred')
-                mri_data = self.current_case_data['mri']
-                if gt_data is not None:
-                    self.editable_mask = gt_data.copy()
-                    self.edit_source = 'gt'
-                elif pred_data is not None:
-                    self.editable_mask = pred_data.copy()
-                    self.edit_source = 'pred'
-                else:
-                    self.editable_mask = np.zeros_like(mri_data, dtype=np.int8)
-                    self.edit_source = 'blank'
+                self.init_editable_mask()
             else:
                 # editable_mask已存在，使用已记录的来源
                 pass
@@ -402,6 +3239,7 @@ class NiiViewerApp:
             self.status_metrics_msg.set("")
             self.lbl_metrics_bottom.config(fg="gray")
             
+        self.refresh_slice_minimap()
         self.update_display()
 
 
@@ -412,6 +3250,84 @@ class NiiViewerApp:
         self.rotation_k = (self.rotation_k - 1) % 4
         self.update_display()
 
+    def run_background_task(self, name, worker, on_done=None, case_bound=True, on_error=None):
+        """
+        在后台线程执行耗时任务
+        :param worker: worker(progress) -> result, progress(fraction, text) 可在后台线程中调用
+        :param on_done: on_done(result), 在 UI 线程中执行
+        :param case_bound: True 时若期间切换了病例，结果被丢弃
+        :param on_error: on_error(exception), 在 UI 线程中执行，默认弹窗提示
+        :return: 同名任务已在运行时返回 False
+        """
+        if name in self._bg_tasks:
+            return False
+
+        def progress(fraction=None, text=None):
+            self._bg_queue.put(("progress", name, fraction, text))
+
+        def run():
+            try:
+                result = worker(progress)
+            except Exception as e:
+                self._bg_queue.put(("error", name, e, None))
+            else:
+                self._bg_queue.put(("done", name, result, None))
+
+        self._bg_tasks[name] = {
+            'on_done': on_done,
+            'on_error': on_error,
+            'token': self.case_token if case_bound else None
+        }
+        if not self.progress_bar.winfo_ismapped():
+            self.progress_bar.pack(side=tk.RIGHT, padx=(0, 20))
+        threading.Thread(target=run, daemon=True).start()
+        if len(self._bg_tasks) == 1:
+            self.root.after(50, self._poll_background_tasks)
+        return True
+
+    def is_task_running(self, name):
+        return name in self._bg_tasks
+
+    def _poll_background_tasks(self):
+        """在 UI 线程中消费后台任务消息"""
+        while True:
+            try:
+                kind, name, payload, text = self._bg_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind == "progress":
+                if payload is None:
+                    if self.progress_bar.cget("mode") != "indeterminate":
+                        self.progress_bar.config(mode="indeterminate")
+                        self.progress_bar.start(15)
+                else:
+                    self.progress_bar.stop()
+                    self.progress_bar.config(mode="determinate", value=payload * 100)
+                if text:
+                    self.status_msg.set(text)
+                continue
+
+            task = self._bg_tasks.pop(name, None)
+            if task is None:
+                continue
+            if task['token'] is not None and task['token'] != self.case_token:
+                continue # 病例已切换，结果过期
+            if kind == "error":
+                if task['on_error'] is not None:
+                    task['on_error'](payload)
+                else:
+                    messagebox.showerror("后台任务失败", f"{name}: {payload}")
+            elif task['on_done'] is not None:
+                task['on_done'](payload)
+
+        if self._bg_tasks:
+            self.root.after(50, self._poll_background_tasks)
+        else:
+            self.progress_bar.stop()
+            self.progress_bar.config(mode="determinate", value=0)
+            self.progress_bar.pack_forget()
+
     def select_root_folder(self):
         """选择根目录并扫描子文件夹"""
         default_dir = "/Volumes/Sandisk/WAIYUAN_DATA"
@@ -431,7 +3347,18 @@ class NiiViewerApp:
             return
 
         # --- 重置状态: 退出编辑，默认双窗，清空显示 ---
+        self.release_worker_case()
         self.current_case_data = {}
+        self.case_token += 1
+        self.close_edit_journal()
+        self.close_time_series()
+        self.editable_mask = None
+        self.label_index = None
+        self.slice_minimap.clear()
+        self.clear_axis_layouts()
+        self.clear_pyramids()
+        self.outline_cache.clear()
+        self.clear_projections()
         
         if self.edit_mode.get():
             self.edit_mode.set(False)
@@ -440,19 +3367,12 @@ class NiiViewerApp:
         self.layout_mode.set("dual")
         
         # 清空图像和文本
-        self.tk_img_left = None
-        self.tk_img_right = None
-        self.panel_left.config(image='', text="MRI + Prediction")
-        self.panel_right.config(image='', text="MRI + Ground Truth")
+        self.panel_left.show_text("MRI + Prediction")
+        self.panel_right.show_text("MRI + Ground Truth")
         
         # 恢复默认双窗布局
-        self.panel_left.pack_forget()
-        self.panel_right.pack_forget()
-        self.panel_ras_r.pack_forget()
-        self.panel_ras_a.pack_forget()
-        self.panel_ras_s.pack_forget()
-        self.panel_left.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
-        self.panel_right.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=2)
+        self.pack_panels("dual")
+        self.frame_time_info.set("")
         
         # 清空指标和Info
         self.metrics_text.set("")
@@ -481,70 +3401,25 @@ class NiiViewerApp:
         self.scan_directories()
 
     def scan_directories(self):
-        """扫描逻辑：基于 {name}_0000.nii.gz 规则查找"""
+        """扫描逻辑：基于 {name}_0000.nii.gz (及 _0001 等其他通道) 规则查找"""
         self.valid_cases = []
-        self.case_listbox.delete(0, tk.END)
+        self.current_case_index = None
+        self.case_listbox.set_items([])
         
-        images_dir = os.path.join(self.root_dir, "imagesTr")
-        
-        # 遍历 imagesTr
         try:
-            for root, _, files in os.walk(images_dir):
-                for f in files:
-                    # 规则：必须以 _0000.nii.gz 结尾
-                    if not f.endswith('_0000.nii.gz') or f.startswith('._'):
-                        continue
-                        
-                    # 提取 Case Name
-                    # 例如: Case10_0000.nii.gz -> Case10
-                    case_name = f[:-12] 
-                    if not case_name: # 避免空名
-                        continue
-                        
-                    mri_path = os.path.join(root, f)
-                    
-                    # 查找 Pred
-                    pred_path = None
-                    if self.has_pred_folder:
-                        # 预测文件应该是 {name}.nii.gz
-                        p_name = f"{case_name}.nii.gz"
-                        p_path = os.path.join(self.root_dir, "predictsTr", p_name)
-                        if os.path.exists(p_path):
-                            pred_path = p_path
-                            
-                    # 查找 GT
-                    gt_path = None
-                    if self.has_gt_folder:
-                        # GT文件应该是 {name}.nii.gz
-                        g_name = f"{case_name}.nii.gz"
-                        g_path = os.path.join(self.root_dir, "labelsTr", g_name)
-                        if os.path.exists(g_path):
-                            gt_path = g_path
-                            
-                    case_info = {
-                        'name': case_name,
-                        'mri_path': mri_path,
-                        'pred_path': pred_path,
-                        'gt_path': gt_path
-                    }
-                    self.valid_cases.append(case_info)
-
+            self.valid_cases = scan_dataset(self.root_dir, self.has_pred_folder, self.has_gt_folder)
         except Exception as e:
             messagebox.showerror("扫描错误", f"扫描过程中发生错误: {e}")
             return
 
-        # 按名称排序 (自然排序可能更好，但这里先用字典序)
-        self.valid_cases.sort(key=lambda x: x['name'])
-        
-        # 更新数量显示
-        self.case_list_title.set(f"病例列表 ({len(self.valid_cases)}):")
-        
-        # 添加到列表框
-        for case in self.valid_cases:
-            self.case_listbox.insert(tk.END, case['name'])
+        # 先用已缓存的指标排序显示，过期/缺失的记录在后台补算后再刷新
+        self.metric_table = CaseMetricTable(self.root_dir)
+        self.rebuild_case_columns()
+        self.refresh_case_list()
+        self.update_metric_table()
 
         if not self.valid_cases:
-            messagebox.showinfo("提示", "在 imagesTr 中未找到符合 *_0000.nii.gz 规则的文件。")
+            messagebox.showinfo("提示", "在 imagesTr 中未找到符合 *_0000.nii.gz (或 *_XXXX.nii.gz) 规则的文件。")
             self.status_msg.set("未找到符合规则的图像文件")
             self.status_color.set("red")
         else:
@@ -559,48 +3434,135 @@ class NiiViewerApp:
         self.precompute_dataset_statistics()
         self.root.event_generate("<<UpdateStatusColor>>")
 
-    def _format_orientation(self, affine):
-        """根据 affine 返回方向字符串，如 RAS/PSI"""
-        try:
-            codes = nib.aff2axcodes(affine)
-            return ''.join(codes)
-        except Exception:
-            return "UNKNOWN"
-
-    def _format_mask_values(self, values):
-        """格式化 mask 值，优先按整数展示"""
-        formatted = []
-        for v in values:
-            fv = float(v)
-            if abs(fv - round(fv)) < 1e-6:
-                formatted.append(int(round(fv)))
-            else:
-                formatted.append(round(fv, 6))
-        return sorted(set(formatted))
+    def update_metric_table(self):
+        """在后台进程池中补算过期/缺失的病例指标，完成后刷新列表排序与统计文本"""
+        table = self.metric_table
+        cases = list(self.valid_cases)
+
+        def worker(progress):
+            progress(None, "检查病例指标缓存...")
+            return table.update(cases, progress)
+
+        def on_done(count):
+            if table is not self.metric_table:
+                return # 期间切换了根目录
+            if count:
+                self.rebuild_case_columns()
+                self.refresh_case_list()
+                self.precompute_dataset_statistics()
+                self.status_msg.set(f"病例指标已更新 ({count} 例)")
+
+        def on_error(e):
+            self.status_msg.set(f"病例指标计算失败: {e}")
+            self.status_color.set("red")
+            self.root.event_generate("<<UpdateStatusColor>>")
 
-    def _collect_case_file_info(self, file_path, include_mask_values=False):
-        """收集单个 NIfTI 文件信息"""
-        if not file_path:
-            return {"exists": False, "error": "MISSING"}
+        self.run_background_task(f"case_metrics:{table.path}", worker, on_done, case_bound=False, on_error=on_error)
+
+    def rebuild_case_columns(self):
+        """把指标记录整理为按 valid_cases 顺序排列的数组，排序/筛选只做向量化运算"""
+        records = [self.metric_table.get(case) if self.metric_table else None for case in self.valid_cases]
+        columns = {}
+        def lookup(record, path):
+            for key in path:
+                record = (record or {}).get(key)
+            return np.nan if record is None else record
+
+        for label, field in CASE_SORT_FIELDS.items():
+            if field is None:
+                continue
+            columns[label] = np.array([lookup(r, field) for r in records], dtype=np.float64)
+        columns['computed'] = np.array([r is not None for r in records], dtype=bool)
+        columns['mismatch'] = np.array([bool(r and (r.get('orientation_mismatch') or r.get('shape_mismatch')))
+                                        for r in records], dtype=bool)
+        columns['error'] = np.array([bool(r and any(info.get('error') not in (None, "MISSING")
+                                                    for info in r['files'].values())) for r in records], dtype=bool)
+        columns['missing'] = np.array([(self.has_pred_folder and not case.get('pred_path')) or
+                                       (self.has_gt_folder and not case.get('gt_path'))
+                                       for case in self.valid_cases], dtype=bool)
+        self._case_columns = columns
+
+    def compute_case_view(self):
+        """按当前筛选与排序返回列表各行对应的 valid_cases 下标 (未计算的值排在最后)"""
+        columns = self._case_columns
+        n = len(self.valid_cases)
+        if not columns or n == 0:
+            return np.arange(n)
+
+        mode = self.case_filter.get()
+        if mode == "最小 Dice < 阈值":
+            try:
+                threshold = float(self.case_filter_threshold.get())
+            except (tk.TclError, ValueError):
+                threshold = 1.0
+            mask = columns["最小 Dice"] < threshold # NaN 比较为 False
+        elif mode == "缺失 Pred/GT":
+            mask = columns['missing']
+        elif mode == "方向/维度不一致":
+            mask = columns['mismatch']
+        elif mode == "读取错误":
+            mask = columns['error']
+        elif mode == "指标未计算":
+            mask = ~columns['computed']
+        else:
+            mask = np.ones(n, dtype=bool)
+        index = np.flatnonzero(mask)
+
+        key = self.case_sort_key.get()
+        desc = self.case_sort_desc.get()
+        if CASE_SORT_FIELDS.get(key) is None:
+            # valid_cases 本身已按名称自然排序
+            return index[::-1] if desc else index
+        values = columns[key][index]
+        # lexsort 以最后一个键为主键：先把 NaN 放到最后，再按值排序，同值按名称
+        order = np.lexsort((index, -values if desc else values, np.isnan(values)))
+        return index[order]
+
+    def refresh_case_list(self):
+        """按当前排序/筛选重建列表 (一次性插入全部名称)，并保持当前病例的选中状态"""
+        view = self.compute_case_view()
+        self.case_view = view
+        self.case_listbox.set_items([self.valid_cases[i]['name'] for i in view])
 
-        try:
-            img = nib.load(file_path)
-            info = {
-                "exists": True,
-                "orientation": self._format_orientation(img.affine),
-                "error": None
-            }
+        total = len(self.valid_cases)
+        shown = f"{len(view)}/{total}" if len(view) != total else f"{total}"
+        rows = np.flatnonzero(view == self.current_case_index) if self.current_case_index is not None else []
+        if len(rows):
+            row = int(rows[0])
+            self.case_listbox.selection_set(row)
+            self.case_listbox.see(row)
+            self.case_list_title.set(f"病例列表 ({row + 1}/{shown}):")
+        else:
+            self.case_list_title.set(f"病例列表 ({shown}):")
+
+    def search_case(self, step=0):
+        """
+        增量查找：输入时从当前高亮行开始定位第一个匹配的病例 (前缀优先，其次包含)，
+        ↑/↓ 跳到上一个/下一个匹配；只高亮不加载，回车加载
+        """
+        query = self.case_search_text.get()
+        if not query.strip():
+            return
+        selection = self.case_listbox.curselection()
+        current = selection[0] if selection else 0
+        row = self.case_listbox.find(query, start=(current + step) % max(self.case_listbox.size(), 1),
+                                     backwards=step < 0)
+        if row is None:
+            self.status_msg.set(f"未找到匹配 \"{query.strip()}\" 的病例")
+            return
+        self.case_listbox.selection_set(row)
+        self.case_listbox.see(row)
 
-            if include_mask_values:
-                data = np.asarray(img.dataobj)
-                unique_vals = self._format_mask_values(np.unique(data))
-                fg_vals = [v for v in unique_vals if v != 0]
-                info["mask_values"] = unique_vals
-                info["fg_mask_values"] = fg_vals
+    def open_searched_case(self):
+        if self.case_listbox.curselection():
+            self.load_selected_case(None)
 
-            return info
-        except Exception as e:
-            return {"exists": True, "error": str(e)}
+    def _selected_case_index(self):
+        """列表选中行对应的 valid_cases 下标，未选中时返回 None"""
+        selection = self.case_listbox.curselection()
+        if not selection or selection[0] >= len(self.case_view):
+            return None
+        return int(self.case_view[selection[0]])
 
     def _join_case_names(self, names):
         return ", ".join(names) if names else "无"
@@ -618,6 +3580,10 @@ class NiiViewerApp:
         pred_empty_fg_cases = []
         gt_empty_fg_cases = []
         load_error_cases = []
+        shape_mismatch_cases = []
+        pending_cases = []
+        pred_fragmented_cases = []
+        gt_fragmented_cases = []
 
         lines.append("=== 数据逐例信息 ===")
         lines.append("")
@@ -626,9 +3592,20 @@ class NiiViewerApp:
             case_name = case['name']
             lines.append(f"[{idx:03d}] {case_name}")
 
-            mri_info = self._collect_case_file_info(case['mri_path'], include_mask_values=False)
-            pred_info = self._collect_case_file_info(case.get('pred_path'), include_mask_values=True)
-            gt_info = self._collect_case_file_info(case.get('gt_path'), include_mask_values=True)
+            # 逐例信息来自缓存的病例指标表 (后台进程池计算)，这里不再读取文件
+            record = self.metric_table.get(case) if self.metric_table else None
+            if record is None:
+                lines.append("  (统计计算中)")
+                lines.append("")
+                pending_cases.append(case_name)
+                if not case.get('pred_path'):
+                    missing_pred_cases.append(case_name)
+                if not case.get('gt_path'):
+                    missing_gt_cases.append(case_name)
+                continue
+            mri_info = record['files']['mri']
+            pred_info = record['files']['pred']
+            gt_info = record['files']['gt']
 
             # 方向信息
             mri_ori = mri_info.get("orientation", "ERROR")
@@ -664,16 +3641,37 @@ class NiiViewerApp:
                 lines.append(f"  images   读取错误   : {mri_info.get('error')}")
                 load_error_cases.append(f"{case_name}(images)")
 
-            # 汇总：方向是否一致（仅针对成功加载且存在的模态）
-            available_orientations = []
-            if not mri_info.get("error") and mri_info.get("orientation"):
-                available_orientations.append(mri_info["orientation"])
-            if case.get('pred_path') and not pred_info.get("error") and pred_info.get("orientation"):
-                available_orientations.append(pred_info["orientation"])
-            if case.get('gt_path') and not gt_info.get("error") and gt_info.get("orientation"):
-                available_orientations.append(gt_info["orientation"])
-            if len(set(available_orientations)) > 1:
+            metrics = record.get('metrics')
+            if metrics:
+                lines.append(f"  Dice1/IoU1          : {metrics['dice1']:.4f} / {metrics['iou1']:.4f}")
+                lines.append(f"  Dice2/IoU2          : {metrics['dice2']:.4f} / {metrics['iou2']:.4f}")
+                for label in (1, 2):
+                    if f"hd95_{label}" in metrics:
+                        lines.append(f"  HD95/ASSD/NSD{label}      : {format_metric(metrics[f'hd95_{label}'], '.2f')} / "
+                                     f"{format_metric(metrics[f'assd_{label}'], '.2f', ' mm')} / "
+                                     f"{format_metric(metrics[f'nsd_{label}'], '.4f')}")
+            volumes = record.get('volume_ml', {})
+            if volumes:
+                lines.append("  标签体积 (mL)       : " + ", ".join(f"{k}={v:.2f}" for k, v in sorted(volumes.items())))
+            components = record.get('components', {})
+            for key, title in (('pred', "predicts"), ('gt', "labels  ")):
+                entries = sorted(((int(name[len(key):]), stats) for name, stats in components.items()
+                                  if name.startswith(key) and name[len(key):].isdigit()), key=lambda e: e[0])
+                if not entries:
+                    continue
+                lines.append(f"  {title} 连通域     : " + "; ".join(
+                    f"L{label} {stats['ml']:.2f}mL {stats['n']}个 最大占比{stats['largest_frac']:.1%}"
+                    for label, stats in entries))
+                fragmented = [f"L{label}×{stats['n']}" for label, stats in entries if stats['n'] > 1]
+                if fragmented:
+                    (pred_fragmented_cases if key == 'pred' else gt_fragmented_cases).append(
+                        f"{case_name}({','.join(fragmented)})")
+
+            # 汇总：方向/维度是否一致（仅针对成功加载且存在的模态）
+            if record.get('orientation_mismatch'):
                 orientation_mismatch_cases.append(case_name)
+            if record.get('shape_mismatch'):
+                shape_mismatch_cases.append(case_name)
 
             # 汇总：单一前景 mask / 无前景
             if case.get('pred_path') and not pred_info.get("error"):
@@ -697,19 +3695,29 @@ class NiiViewerApp:
         lines.append(f"缺少 predicts 的病例数: {len(missing_pred_cases)}")
         lines.append(f"缺少 labels 的病例数: {len(missing_gt_cases)}")
         lines.append(f"images/predicts/labels 方向不一致病例数: {len(orientation_mismatch_cases)}")
+        lines.append(f"images/predicts/labels 维度不一致病例数: {len(shape_mismatch_cases)}")
         lines.append(f"predicts 仅单一前景mask病例数: {len(pred_single_mask_cases)}")
         lines.append(f"labels 仅单一前景mask病例数: {len(gt_single_mask_cases)}")
         lines.append(f"predicts 无前景mask病例数: {len(pred_empty_fg_cases)}")
         lines.append(f"labels 无前景mask病例数: {len(gt_empty_fg_cases)}")
+        lines.append(f"predicts 存在多个连通域病例数: {len(pred_fragmented_cases)}")
+        lines.append(f"labels 存在多个连通域病例数: {len(gt_fragmented_cases)}")
         lines.append(f"读取错误病例数: {len(load_error_cases)}")
+        if pending_cases:
+            lines.append(f"统计尚未完成病例数: {len(pending_cases)}")
         lines.append("")
         lines.append(f"方向不一致病例: {self._join_case_names(orientation_mismatch_cases)}")
+        lines.append(f"维度不一致病例: {self._join_case_names(shape_mismatch_cases)}")
         lines.append(f"predicts 单一前景mask病例: {self._join_case_names(pred_single_mask_cases)}")
         lines.append(f"labels 单一前景mask病例: {self._join_case_names(gt_single_mask_cases)}")
         lines.append(f"predicts 无前景mask病例: {self._join_case_names(pred_empty_fg_cases)}")
         lines.append(f"labels 无前景mask病例: {self._join_case_names(gt_empty_fg_cases)}")
         lines.append(f"缺少 predicts 病例: {self._join_case_names(missing_pred_cases)}")
         lines.append(f"缺少 labels 病例: {self._join_case_names(missing_gt_cases)}")
+        lines.append(f"predicts 多连通域病例 ({COMPONENT_CONNECTIVITY} 邻域): "
+                     f"{self._join_case_names(pred_fragmented_cases)}")
+        lines.append(f"labels 多连通域病例 ({COMPONENT_CONNECTIVITY} 邻域): "
+                     f"{self._join_case_names(gt_fragmented_cases)}")
         lines.append(f"读取错误病例: {self._join_case_names(load_error_cases)}")
         return "\n".join(lines)
 
@@ -751,19 +3759,196 @@ class NiiViewerApp:
         stats_text.insert("1.0", self.dataset_stats_text)
         stats_text.config(state=tk.DISABLED)
 
+    def register_memory_consumers(self):
+        """
+        登记内存消费者 (priority 越小越先回收)
+        原始体数据与编辑掩码不可回收；撤销历史不参与自动回收，只能在内存面板中确认后手动裁剪
+        """
+        reg = self.memory_registry
+
+        def volume_nbytes(key):
+            data = self.current_case_data.get(key) if self.current_case_data else None
+            return data.nbytes if data is not None else 0
+
+        def mri_nbytes():
+            data = self.current_case_data
+            if not data:
+                return 0
+            arrays = {id(data['mri']): data['mri']}
+            for entry in data.get('channels', {}).values():
+                arrays[id(entry[0])] = entry[0]
+            return sum(a.nbytes for a in arrays.values())
+
+        def evict_channels():
+            data = self.current_case_data
+            current = data.get('channel')
+            # 后台线程正在向 channels 写入其余通道时不回收，避免与写入竞争
+            if self.is_task_running(f"channel_load:{self.case_token}"):
+                return
+            for c in [c for c in data.get('channels', {}) if c != current]:
+                del data['channels'][c]
+
+        def evict_time_frames():
+            if self.time_series is not None:
+                # 同时减半缓存容量，避免预取马上把内存占回去
+                self.time_series.cache_frames = max(2, self.time_series.cache_frames // 2)
+                self.time_series.evict_cache(keep=(self.time_index,))
+
+        reg.register("RAS 轴向连续缓存", lambda: sum(entry[1].nbytes for entry in self.axis_layout_cache.values()),
+                     self.clear_axis_layouts, priority=10)
+        reg.register("MIP/MinIP 投影", self.projection_nbytes, self.clear_projections, priority=12)
+        reg.register("轮廓缓存", lambda: sum(entry[1].nbytes for entry in self.outline_cache.values()),
+                     self.outline_cache.clear, priority=15)
+        reg.register("多分辨率金字塔", lambda: sum(level.nbytes for _, levels in self.pyramid_cache.values()
+                                              for level in levels.values() if not isinstance(level, np.memmap)),
+                     self.clear_pyramids, priority=20)
+        reg.register("4D 帧缓存 / 预取", lambda: self.time_series.cached_nbytes() if self.time_series else 0,
+                     evict_time_frames, priority=30)
+        reg.register("MRI (含其余通道)", mri_nbytes, evict_channels, priority=40)
+        reg.register("Prediction", lambda: volume_nbytes('pred'))
+        reg.register("Ground Truth", lambda: volume_nbytes('gt'))
+        reg.register("编辑掩码 (已修改切片)", lambda: self.editable_mask.overlay_nbytes() if self.editable_mask else 0)
+        reg.register("编辑日志待写入", lambda: self.edit_journal.pending_nbytes() if self.edit_journal else 0)
+        reg.register("显示面板图像缓冲", lambda: sum(p.image_size[0] * p.image_size[1] * 4 for p in
+                                             (self.panel_left, self.panel_right, self.panel_ras_r,
+                                              self.panel_ras_a, self.panel_ras_s) if p.image_size))
+        reg.register("撤销历史", self.undo_nbytes, self.trim_undo_stack, priority=90)
+
+    def undo_nbytes(self):
+        total = 0
+        for entry in self.undo_stack:
+            if entry[0] == 'slice':
+                total += entry[2].nbytes
+            else:
+                total += sum(slice_data.nbytes for _, slice_data in entry[1])
+        return total
+
+    def trim_undo_stack(self):
+        """丢弃较早的一半撤销记录"""
+        del self.undo_stack[:(len(self.undo_stack) + 1) // 2]
+
+    def confirm_trim_undo_stack(self, parent=None):
+        """确认后裁剪较早的一半撤销记录"""
+        if not self.undo_stack:
+            return False
+        freed = self.undo_nbytes() / 1024 ** 2
+        if not messagebox.askyesno("裁剪撤销历史",
+                                   f"将丢弃较早的 {(len(self.undo_stack) + 1) // 2} 条撤销记录 (共 {len(self.undo_stack)} 条，"
+                                   f"约 {freed:.1f} MB)，丢弃后无法再撤销到这些步骤。是否继续？", parent=parent):
+            return False
+        self.trim_undo_stack()
+        self.status_msg.set(f"已裁剪撤销历史，剩余 {len(self.undo_stack)} 条")
+        return True
+
+    def evict_memory(self, high_water_bytes=None):
+        """
+        回收可重建的缓存 (不动撤销历史)：给定高水位时回收到 RSS 低于高水位的 90% 为止，否则全部回收
+        """
+        if high_water_bytes is None:
+            evicted = self.memory_registry.evict(max_priority=REBUILDABLE_MAX_PRIORITY)
+        else:
+            low_water = high_water_bytes * 0.9
+            evicted = self.memory_registry.evict(stop=lambda: process_rss_bytes()[0] < low_water,
+                                                 max_priority=REBUILDABLE_MAX_PRIORITY)
+        if evicted:
+            freed = sum(nbytes for _, nbytes in evicted) / 1024 ** 2
+            names = "、".join(name for name, _ in evicted)
+            self.status_msg.set(f"已回收 {names}，约 {freed:.1f} MB")
+        return evicted
+
+    def check_memory_high_water(self):
+        """定时检查 RSS，超过高水位时回收缓存"""
+        try:
+            high_water_mb = int(self.memory_high_water_mb.get())
+        except (tk.TclError, ValueError):
+            high_water_mb = 0
+        rss, is_peak = process_rss_bytes()
+        # 只有峰值 RSS 时无法判断回收效果，不自动回收
+        if high_water_mb > 0 and not is_peak and rss > high_water_mb * 1024 ** 2:
+            self.memory_pressure = True
+            if self.evict_memory(high_water_mb * 1024 ** 2):
+                self.status_color.set("orange")
+                self.root.event_generate("<<UpdateStatusColor>>")
+        self.root.after(self.memory_check_interval_ms, self.check_memory_high_water)
+
+    def show_memory_panel(self):
+        """弹窗展示各数据/缓存的内存占用，打开期间每秒刷新"""
+        if self.memory_window is not None and self.memory_window.winfo_exists():
+            self.memory_window.lift()
+            return
+
+        win = tk.Toplevel(self.root)
+        win.title("内存占用")
+        win.geometry("520x420")
+        self.memory_window = win
+
+        tree = ttk.Treeview(win, columns=("size", "evictable"), height=12)
+        tree.heading("#0", text="项目")
+        tree.heading("size", text="大小 (MB)")
+        tree.heading("evictable", text="可回收")
+        tree.column("#0", width=260)
+        tree.column("size", width=110, anchor=tk.E)
+        tree.column("evictable", width=80, anchor=tk.CENTER)
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+        self._memory_tree = tree
+
+        tk.Label(win, textvariable=self._memory_rss_text, anchor="w", justify=tk.LEFT).pack(fill=tk.X, padx=10)
+
+        ctrl = tk.Frame(win)
+        ctrl.pack(fill=tk.X, padx=10, pady=10)
+        tk.Label(ctrl, text="高水位 (MB, 0=关闭):").pack(side=tk.LEFT)
+        tk.Spinbox(ctrl, from_=0, to=1024 * 1024, increment=256, width=8,
+                   textvariable=self.memory_high_water_mb).pack(side=tk.LEFT, padx=5)
+        ttk.Button(ctrl, text="立即回收缓存", command=lambda: (self.evict_memory(), self.refresh_memory_panel())).pack(side=tk.RIGHT)
+        ttk.Button(ctrl, text="裁剪撤销历史",
+                   command=lambda: (self.confirm_trim_undo_stack(parent=win), self.refresh_memory_panel())).pack(side=tk.RIGHT, padx=5)
+
+        self.refresh_memory_panel(schedule=True)
+
+    def refresh_memory_panel(self, schedule=False):
+        win = self.memory_window
+        if win is None or not win.winfo_exists():
+            self.memory_window = None
+            return
+        tree = self._memory_tree
+        tree.delete(*tree.get_children())
+        rows = self.memory_registry.snapshot()
+        for name, nbytes, evictable in rows:
+            tree.insert("", tk.END, text=name, values=(f"{nbytes / 1024 ** 2:.1f}", "是" if evictable else ""))
+
+        accounted = sum(nbytes for _, nbytes, _ in rows)
+        rss, is_peak = process_rss_bytes()
+        rss_label = "进程峰值 RSS" if is_peak else "进程 RSS"
+        text = f"已统计合计: {accounted / 1024 ** 2:.1f} MB    {rss_label}: {rss / 1024 ** 2:.1f} MB"
+        if rss and not is_peak:
+            text += f"\n其他 (解释器、库、分配器碎片等): {max(rss - accounted, 0) / 1024 ** 2:.1f} MB"
+        self._memory_rss_text.set(text)
+        if schedule:
+            win.after(1000, lambda: self.refresh_memory_panel(schedule=True))
+
     def load_selected_case(self, event):
         """加载选中的病例数据"""
-        selection = self.case_listbox.curselection()
-        if not selection:
+        index = self._selected_case_index()
+        if index is None:
             return
 
-        index = selection[0]
         case = self.valid_cases[index]
+        self.current_case_index = index
+        self.case_token += 1
+        self.close_edit_journal() # 切换病例前把上一个病例的编辑落盘
+        self.close_time_series()
+        self.clear_axis_layouts()
+        self.clear_pyramids()
+        self.outline_cache.clear()
+        self.clear_projections()
+        self.memory_pressure = False
         
-        # 更新列表标题显示当前索引/总数
+        # 更新列表标题显示当前行号/列表行数 (按当前排序与筛选)
+        row = self.case_listbox.curselection()[0]
         total_cases = len(self.valid_cases)
-        # index 是从0开始，显示为从1开始
-        self.case_list_title.set(f"病例列表 ({index + 1}/{total_cases}):")
+        shown = f"{len(self.case_view)}/{total_cases}" if len(self.case_view) != total_cases else f"{total_cases}"
+        # row 是从0开始，显示为从1开始
+        self.case_list_title.set(f"病例列表 ({row + 1}/{shown}):")
 
         # --- 检查并提示缺失文件 ---
         missing_files = []
@@ -781,441 +3966,936 @@ class NiiViewerApp:
             self.status_color.set("green") # 使用深绿色看起来更舒适，或者默认绿色
         self.root.event_generate("<<UpdateStatusColor>>")
 
+        self.release_worker_case()
+        stage = self.profiler.stage
         try:
             # 加载 MRI
-            mri_img = nib.load(case['mri_path'])
-            # 转换为 RAS 标准方向，确保切片顺序 (Inferior -> Superior) 与 Slicer 等软件一致
-            mri_img = nib.as_closest_canonical(mri_img)
-            mri_data = mri_img.get_fdata()
-            self.current_voxel_sizes = tuple(float(v) for v in mri_img.header.get_zooms()[:3])
-            
-            # 处理 3D vs 4D 数据
-            if mri_data.ndim == 4:
-                mri_data = mri_data[..., 0] 
+            mri_img_raw = nib.load(case['mri_path'])
+            is_series = len(mri_img_raw.shape) == 4 and mri_img_raw.shape[3] > 1
+            if self.render_worker is not None and not is_series:
+                # 渲染进程模式：解码在渲染进程中完成 (写入共享内存)，界面线程不等待
+                self.start_worker_case_load(case)
+                return
+            if is_series:
+                # 4D 序列：保持文件句柄打开，按时间点惰性读取 (不解码整个序列)
+                mri_img_raw = nib.load(case['mri_path'], keep_file_open=True)
+                series = self.time_series = TimeSeriesVolume(mri_img_raw, cache_frames=3 * self.cine_prefetch)
+                canonical_affine = series.affine
+                mri_data = series.frame(0)
+                self.current_voxel_sizes = series.voxel_sizes
+            else:
+                series = None
+                # 与渲染进程解码相同：按 float32 读取并转换为 RAS 标准方向 (单时间点的 4D 取第 0 帧)，
+                # 两条路径的窗宽窗位与统计一致；RAS 保证切片顺序 (Inferior -> Superior) 与 Slicer 等软件一致
+                with stage("decode", "load"):
+                    mri_data, canonical_affine, self.current_voxel_sizes = load_canonical(case['mri_path'])
+            # 记录 canonical -> 原始方向的变换，导出时直接复用，无需重新读取原图
+            canonical_to_raw = nib.orientations.ornt_transform(
+                nib.orientations.io_orientation(canonical_affine),
+                nib.orientations.io_orientation(mri_img_raw.affine))
             
             # 加载 Pred (可能不存在)
             pred_data = None
             if case['pred_path']:
-                pred_img = nib.load(case['pred_path'])
-                pred_img = nib.as_closest_canonical(pred_img)
-                pred_data = pred_img.get_fdata().astype(np.int8)
+                with stage("decode_pred", "load"):
+                    pred_data = load_canonical(case['pred_path'], np.int8)[0]
 
             # 加载 GT (如果存在)
             gt_data = None
             if case['gt_path']:
-                gt_img = nib.load(case['gt_path'])
-                gt_img = nib.as_closest_canonical(gt_img)
-                gt_data = gt_img.get_fdata().astype(np.int8)
-
-            # 检查维度一致性
-            if pred_data is not None and mri_data.shape != pred_data.shape:
-                raise ValueError(f"MRI维度 {mri_data.shape} 与 Pred维度 {pred_data.shape} 不匹配")
-            
-            if gt_data is not None and mri_data.shape != gt_data.shape:
-                raise ValueError(f"MRI维度 {mri_data.shape} 与 GT维度 {gt_data.shape} 不匹配")
+                with stage("decode_gt", "load"):
+                    gt_data = load_canonical(case['gt_path'], np.int8)[0]
+
+            self._finish_case_load(case, mri_data, pred_data, gt_data, {
+                'ref_affine': mri_img_raw.affine,
+                'ref_header': mri_img_raw.header.copy(),
+                'canonical_to_raw': canonical_to_raw
+            })
+        except Exception as e:
+            self._on_case_load_error(e)
 
-            # --- 计算全局归一化参数 ---
-            # 使用全局统计量进行归一化，避免不同 Slice 亮度跳变
-            # 简单下采样以加速统计
-            try:
-                sample_data = mri_data[::2, ::2, ::2]
-                g_min = np.percentile(sample_data, 0.5) 
-                g_max = np.percentile(sample_data, 99.5)
-            except Exception:
-                g_min = np.min(mri_data)
-                g_max = np.max(mri_data)
-
-            if g_max <= g_min:
-                g_max = g_min + 1
-
-            # 存储数据
-            self.current_case_data = {
-                'mri': mri_data,
-                'pred': pred_data,
-                'gt': gt_data,
-                'global_min': g_min,
-                'global_max': g_max
-            }
+    def _finish_case_load(self, case, mri_data, pred_data, gt_data, meta):
+        """
+        解码完成后的公共部分 (本进程解码与渲染进程解码共用): 维度检查、归一化参数、指标、编辑 Mask 与界面状态
+        :param meta: 'ref_affine', 'ref_header', 'canonical_to_raw', 可选 'shared_token'
+        """
+        stage = self.profiler.stage
+        # 检查维度一致性
+        if pred_data is not None and mri_data.shape != pred_data.shape:
+            raise ValueError(f"MRI维度 {mri_data.shape} 与 Pred维度 {pred_data.shape} 不匹配")
+        
+        if gt_data is not None and mri_data.shape != gt_data.shape:
+            raise ValueError(f"MRI维度 {mri_data.shape} 与 GT维度 {gt_data.shape} 不匹配")
 
-            # 计算指标 & UI状态
-            if pred_data is not None and gt_data is not None:
-                d1, i1, d2, i2 = self.calculate_metrics(pred_data, gt_data)
-                
-                # 更新侧边栏 (详细)
-                msg_full = (f"Label 1:\n  Dice: {d1:.4f}\n  IoU : {i1:.4f}\n\n"
-                            f"Label 2:\n  Dice: {d2:.4f}\n  IoU : {i2:.4f}")
-                self.metrics_text.set(msg_full)
-                
-                # 更新底部状态栏 (简略)
-                msg_short = f"Dice1:{d1:.3f} Dice2:{d2:.3f} | IoU1:{i1:.3f} IoU2:{i2:.3f}"
-                self.status_metrics_msg.set(msg_short)
-                self.lbl_metrics_bottom.config(fg="blue") # 设置为蓝色区分
-                
-                # 功能全开
-                self.rb_diff.config(state=tk.NORMAL)
-                self.rb_right.config(state=tk.NORMAL)
-                self.chk_gt.config(state=tk.NORMAL)
+        # --- 计算全局归一化参数 (4D 序列按第 0 帧统计，回放时亮度不跳变；渲染进程已算好时直接使用) ---
+        if 'global_min' in meta:
+            g_min, g_max = meta['global_min'], meta['global_max']
+        else:
+            with stage("percentile", "load"):
+                g_min, g_max = intensity_range(mri_data)
+
+        # 存储数据
+        self.current_case_data = {
+            'mri': mri_data,
+            'pred': pred_data,
+            'gt': gt_data,
+            'global_min': g_min,
+            'global_max': g_max,
+            'ref_affine': meta['ref_affine'],
+            'ref_header': meta['ref_header'],
+            'canonical_to_raw': meta['canonical_to_raw'],
+            'shared_token': meta.get('shared_token'), # 渲染进程中的共享内存病例，None 表示在本进程解码
+            # 多通道 (_0000, _0001, ...): 通道序号 -> (数据, global_min, global_max)，其余通道在后台解码
+            'pred_path': case['pred_path'],
+            'gt_path': case['gt_path'],
+            'channel': 0,
+            'channel_paths': case.get('channel_paths') or [case['mri_path']],
+            'channels': {0: (mri_data, g_min, g_max)}
+        }
+
+        # 计算指标 & UI状态
+        if pred_data is not None and gt_data is not None:
+            if 'metrics' in meta:
+                d1, i1, d2, i2 = meta['metrics']
             else:
-                # 缺失 Pred 或 GT，部分功能禁用
-                if pred_data is None:
-                    self.metrics_text.set("No Prediction Data")
-                    self.status_metrics_msg.set("No Pred")
-                else:
-                    self.metrics_text.set("No Ground Truth")
-                    self.status_metrics_msg.set("No GT")
-                
-                self.lbl_metrics_bottom.config(fg="gray") # 灰色表示无效
-                
-                # 禁用差异分析
-                self.rb_diff.config(state=tk.DISABLED)
-                
-                # 如果没有GT，禁用GT查看; 否则启用
-                if gt_data is None:
-                    # [Fix] 如果在编辑模式，右屏作为编辑器需要保持启用
-                    if not self.edit_mode.get():
-                        self.rb_right.config(state=tk.DISABLED)
-                    self.chk_gt.config(state=tk.DISABLED)
-                else:
-                    self.rb_right.config(state=tk.NORMAL)
-                    self.chk_gt.config(state=tk.NORMAL)
-                
-                # 如果当前处于不可用模式(例如Diff)，强制切回左图
-                if self.layout_mode.get() == "diff":
-                    self.layout_mode.set("left")
-                elif self.layout_mode.get() == "right" and gt_data is None:
-                    # [Fix] 如果在编辑模式，允许停留在 right
-                    if not self.edit_mode.get():
-                        self.layout_mode.set("left")
-
-            # --- 初始化编辑 Mask ---
-            # 优先使用 GT，如果没有则使用 Pred，再没有则全0
-            if gt_data is not None:
-                self.editable_mask = gt_data.copy()
-                self.edit_source = 'gt'
-            elif pred_data is not None:
-                self.editable_mask = pred_data.copy()
-                self.edit_source = 'pred'
+                with stage("metrics", "load"):
+                    d1, i1, d2, i2 = self.calculate_metrics(pred_data, gt_data)
+            
+            # 更新侧边栏 (详细)；表面距离指标后台补齐
+            self.metrics_text.set(self.format_metrics_text((d1, i1, d2, i2)))
+            self.update_surface_metrics(case, (d1, i1, d2, i2))
+            
+            # 更新底部状态栏 (简略)
+            msg_short = f"Dice1:{d1:.3f} Dice2:{d2:.3f} | IoU1:{i1:.3f} IoU2:{i2:.3f}"
+            self.status_metrics_msg.set(msg_short)
+            self.lbl_metrics_bottom.config(fg="blue") # 设置为蓝色区分
+            
+            # 功能全开
+            self.rb_diff.config(state=tk.NORMAL)
+            self.rb_right.config(state=tk.NORMAL)
+            self.chk_gt.config(state=tk.NORMAL)
+        else:
+            # 缺失 Pred 或 GT，部分功能禁用
+            if pred_data is None:
+                self.metrics_text.set("No Prediction Data")
+                self.status_metrics_msg.set("No Pred")
             else:
-                self.editable_mask = np.zeros_like(mri_data, dtype=np.int8)
-                self.edit_source = 'blank'
+                self.metrics_text.set("No Ground Truth")
+                self.status_metrics_msg.set("No GT")
+            
+            self.lbl_metrics_bottom.config(fg="gray") # 灰色表示无效
             
-            self.undo_stack.clear() # 清空撤销栈
-
-            # 重置切片索引到中间
-            self.total_slices = mri_data.shape[2]
-            self.current_slice_index = self.total_slices // 2
-            self.ras_index_r = mri_data.shape[0] // 2
-            self.ras_index_a = mri_data.shape[1] // 2
-            self.ras_index_s = mri_data.shape[2] // 2
+            # 禁用差异分析
+            self.rb_diff.config(state=tk.DISABLED)
             
-            # 更新滑动条
-            self.slice_scale.config(to=self.total_slices - 1)
-            self.slice_scale.set(self.current_slice_index)
+            # 如果没有GT，禁用GT查看; 否则启用
+            if gt_data is None:
+                # [Fix] 如果在编辑模式，右屏作为编辑器需要保持启用
+                if not self.edit_mode.get():
+                    self.rb_right.config(state=tk.DISABLED)
+                self.chk_gt.config(state=tk.DISABLED)
+            else:
+                self.rb_right.config(state=tk.NORMAL)
+                self.chk_gt.config(state=tk.NORMAL)
             
+            # 如果当前处于不可用模式(例如Diff)，强制切回左图
+            if self.layout_mode.get() == "diff":
+                self.layout_mode.set("left")
+            elif self.layout_mode.get() == "right" and gt_data is None:
+                # [Fix] 如果在编辑模式，允许停留在 right
+                if not self.edit_mode.get():
+                    self.layout_mode.set("left")
+
+        # --- 初始化编辑 Mask ---
+        self.label_index = None
+        self.slice_minimap.clear()
+        with stage("init_mask", "load"):
+            self.init_editable_mask()
+        self.open_edit_journal(case)
+        
+        self.undo_stack.clear() # 清空撤销栈
+
+        # 重置切片索引到中间
+        self.total_slices = mri_data.shape[2]
+        self.current_slice_index = self.total_slices // 2
+        self.ras_index_r = mri_data.shape[0] // 2
+        self.ras_index_a = mri_data.shape[1] // 2
+        self.ras_index_s = mri_data.shape[2] // 2
+        
+        # 更新滑动条
+        self.slice_scale.config(to=self.total_slices - 1)
+        self.slice_scale.set(self.current_slice_index)
+        self.setup_time_controls()
+        
+        self.update_display()
+        self.build_label_index()
+        self.load_other_channels()
+
+    def _on_case_load_error(self, e):
+        messagebox.showerror("加载错误", f"无法加载文件: {str(e)}")
+        self.close_time_series()
+        self.current_case_data = {}
+        self.editable_mask = None # 上一个病例的编辑不能再以当前 (加载失败的) 病例名导出
+        self.label_index = None
+        self.metrics_text.set("")
+        self.status_metrics_msg.set("")
+        self.panel_left.show_text("Error")
+        self.panel_right.show_text("Error")
+
+    def on_render_process_toggle(self):
+        """开启/关闭独立渲染进程；开启后从下一次加载病例起生效"""
+        if self.render_process_enabled.get():
+            if self.render_worker is None:
+                try:
+                    self.render_worker = RenderWorker()
+                except Exception as e:
+                    self.render_process_enabled.set(False)
+                    messagebox.showerror("错误", f"无法启动渲染进程: {e}")
+                    return
+            self.status_msg.set("渲染进程已启动，下次加载病例时生效")
+        else:
+            self.stop_render_worker()
             self.update_display()
 
+    def stop_render_worker(self):
+        """停止渲染进程；已映射的共享内存数组仍可继续在本进程中使用"""
+        if self._render_poll_after_id is not None:
+            self.root.after_cancel(self._render_poll_after_id)
+            self._render_poll_after_id = None
+        if self.render_worker is not None:
+            self.render_worker.stop()
+            self.render_worker = None
+
+    def release_worker_case(self):
+        """切换病例前通知渲染进程释放上一个病例的共享内存"""
+        token = self.current_case_data.get('shared_token') if self.current_case_data else None
+        if token is not None and self.render_worker is not None:
+            self.render_worker.release(token)
+
+    def start_worker_case_load(self, case):
+        """请求渲染进程解码病例；完成后在 _poll_render_worker 中继续 _finish_case_load"""
+        self.current_case_data = {}
+        self.editable_mask = None
+        self.label_index = None
+        self.slice_minimap.clear()
+        self.undo_stack.clear()
+        self.metrics_text.set("")
+        self.status_metrics_msg.set("")
+        self.panel_left.show_text("Loading...")
+        self.panel_right.show_text("Loading...")
+        self._pending_worker_case = case
+        self.render_worker.load_case(self.case_token, case)
+        self._schedule_render_poll()
+
+    def use_render_worker(self):
+        """当前病例的非编辑面板是否交给渲染进程合成 (切换到其他通道或 4D 序列时在本进程渲染)"""
+        data = self.current_case_data
+        return (self.render_worker is not None and data.get('shared_token') == self.case_token
+                and data.get('channel') == 0 and self.time_series is None)
+
+    def request_worker_frame(self, panel, request, display_constraints, t_start):
+        """把一个面板的渲染请求 (附当前视图状态) 发给渲染进程"""
+        self._render_seq += 1
+        request.update({
+            'rotation_k': self.rotation_k,
+            'zoom_level': self.zoom_level,
+            'pan_center_x': self.pan_center_x,
+            'pan_center_y': self.pan_center_y,
+            'gamma': self.get_gamma(),
+            'overlay_style': self.get_overlay_style(),
+            'display_constraints': display_constraints
+        })
+        self.render_worker.render(self.case_token, str(panel), self._render_seq, request, t_start)
+        self._schedule_render_poll()
+
+    def _schedule_render_poll(self):
+        if self._render_poll_after_id is None:
+            self._render_poll_after_id = self.root.after(5, self._poll_render_worker)
+
+    def _poll_render_worker(self):
+        """在 UI 线程中非阻塞地取回渲染进程的解码与渲染结果，过期结果丢弃"""
+        self._render_poll_after_id = None
+        worker = self.render_worker
+        if worker is None:
+            return
+        if not worker.is_alive():
+            self.stop_render_worker()
+            self.render_process_enabled.set(False)
+            self.status_msg.set("渲染进程意外退出，已改为在主进程中渲染")
+            self.status_color.set("red")
+            self.root.event_generate("<<UpdateStatusColor>>")
+            return
+
+        panels = {str(panel): panel for panel in (self.panel_left, self.panel_right, self.panel_ras_r,
+                                                  self.panel_ras_a, self.panel_ras_s)}
+        for msg in worker.poll():
+            kind, token = msg[0], msg[1]
+            if kind == "loaded":
+                if token != self.case_token:
+                    worker.release(token) # 解码期间已切换病例
+                    continue
+                self.on_worker_case_loaded(token, msg[2], msg[3])
+            elif kind == "frame":
+                if token == self.case_token and self.current_case_data.get('shared_token') == token:
+                    panels[msg[2]].show_image(msg[4], msg[5])
+                    self.update_frame_time_info()
+            elif kind == "error" and token == self.case_token:
+                if msg[2] is None:
+                    self._on_case_load_error(RuntimeError(msg[4]))
+                else:
+                    self.status_msg.set(f"渲染进程错误: {msg[4]}")
+
+        worker.close_retired()
+        if worker.busy():
+            self._schedule_render_poll()
+
+    def on_worker_case_loaded(self, token, specs, meta):
+        """渲染进程解码完成：映射共享内存 (零拷贝) 并完成病例加载"""
+        case = self._pending_worker_case
+        try:
+            arrays = self.render_worker.attach(token, specs)
+            self.current_voxel_sizes = meta['voxel_sizes']
+            meta = dict(meta)
+            meta['shared_token'] = token
+            meta['canonical_to_raw'] = nib.orientations.ornt_transform(
+                nib.orientations.io_orientation(meta['canonical_affine']),
+                nib.orientations.io_orientation(meta['ref_affine']))
+            self._finish_case_load(case, arrays['mri'], arrays.get('pred'), arrays.get('gt'), meta)
         except Exception as e:
-            messagebox.showerror("加载错误", f"无法加载文件: {str(e)}")
-            self.current_case_data = {}
-            self.metrics_text.set("")
-            self.status_metrics_msg.set("")
-            self.panel_left.config(image='', text="Error")
-            self.panel_right.config(image='', text="Error")
+            self._on_case_load_error(e)
 
-    def calculate_metrics(self, pred, gt):
-        """计算 Label 1 和 2 的 Dice 和 IoU"""
-        def compute_dice_iou(p, g, label):
-            p_mask = (p == label)
-            g_mask = (g == label)
-            
-            intersection = np.logical_and(p_mask, g_mask).sum()
-            union = np.logical_or(p_mask, g_mask).sum()
-            sum_masks = p_mask.sum() + g_mask.sum()
-            
-            # Dice
-            dice = 1.0 if sum_masks == 0 else 2.0 * intersection / sum_masks
-            # IoU
-            iou = 1.0 if union == 0 else intersection / union
-                
-            return dice, iou
+    def load_other_channels(self):
+        """在后台依次解码当前病例的其余通道；每解码完一个即可切换，无需等待全部完成"""
+        data = self.current_case_data
+        paths = data.get('channel_paths', [])
+        if len(paths) < 2 or self.time_series is not None:
+            return
+        channels = data['channels']
+        shape = data['mri'].shape
+
+        def worker(progress):
+            todo = [c for c in range(len(paths)) if c not in channels]
+            for i, c in enumerate(todo):
+                progress(i / len(todo), f"后台解码通道 {self.channel_name(c)} ...")
+                channel_data = load_canonical(paths[c])[0]
+                if channel_data.shape != shape:
+                    raise ValueError(f"通道 {self.channel_name(c)} 维度 {channel_data.shape} 与 {shape} 不匹配")
+                channels[c] = (channel_data,) + tuple(intensity_range(channel_data))
+            return len(todo)
+
+        def on_done(count):
+            self.status_msg.set(f"已解码 {len(paths)} 个通道，按 c / Shift+c 切换")
+
+        def on_error(e):
+            self.status_msg.set(f"通道解码失败: {e}")
+            self.status_color.set("red")
+            self.root.event_generate("<<UpdateStatusColor>>")
 
-        d1, i1 = compute_dice_iou(pred, gt, 1)
-        d2, i2 = compute_dice_iou(pred, gt, 2)
-        return d1, i1, d2, i2
+        self.run_background_task(f"channel_load:{self.case_token}", worker, on_done, on_error=on_error)
 
-    def normalize_mri(self, slice_data):
-        """将MRI切片归一化到 0-255 并进行 Gamma 变换"""
-        if slice_data is None:
-            return None
-            
-        # 使用全局统计量，如果不存在则退化为局部统计量
-        g_min = self.current_case_data.get('global_min', slice_data.min())
-        g_max = self.current_case_data.get('global_max', slice_data.max())
-        
-        # 截断数据到全局范围内
-        slice_data = np.clip(slice_data, g_min, g_max)
-        
-        if g_max == g_min:
-            return np.zeros_like(slice_data, dtype=np.uint8)
-        
-        # 线性归一化到 0-255
-        norm = (slice_data - g_min) / (g_max - g_min) * 255
-        
-        # Gamma 变换
-        gamma = self.gamma_val.get()
-        # 防止除以0或溢出，先归一化回0-1计算gamma再乘255
-        norm = 255 * np.power(norm / 255, 1.0 / gamma)
-        
-        return norm.astype(np.uint8)
+    def channel_name(self, c):
+        """通道显示名，如 _0001"""
+        path = self.current_case_data['channel_paths'][c]
+        return os.path.basename(path)[-CHANNEL_SUFFIX_LEN:-len(".nii.gz")]
 
-    def get_slice_view(self, data, idx):
-        """提取切片并转换为 Radiological 视图 (Ant-Top, Right-Left)"""
-        if data is None:
-            return None
-        
-        # 原始数据 (RAS): Dim 0 = L->R, Dim 1 = P->A
-        raw_slice = data[:, :, idx]
-        
-        # 转换为 Radiological View:
-        # 目标: Rows = A->P (Top=Ant), Cols = R->L (Left=Right)
-        
-        # 1. Transpose: (X, Y) -> (Y, X) => Rows: P->A, Cols: L->R
-        # 2. Flip Both: Rows: A->P, Cols: R->L
-        slice_radio = raw_slice.T[::-1, ::-1]
-        
-        # 应用用户旋转
-        if self.rotation_k != 0:
-            slice_radio = np.rot90(slice_radio, k=self.rotation_k)
-            
-        return slice_radio
+    def channel_label(self):
+        paths = self.current_case_data.get('channel_paths', [])
+        if len(paths) < 2:
+            return ""
+        return f"  Ch{self.channel_name(self.current_case_data['channel'])}"
 
-    def get_slice_view_axis(self, data, axis, idx):
-        """按指定轴提取切片并转换为统一视图"""
-        if data is None:
-            return None
+    def cycle_channel(self, delta):
+        """切换到下一个/上一个通道 (c / Shift+c)"""
+        data = self.current_case_data
+        paths = data.get('channel_paths', []) if data else []
+        if len(paths) < 2:
+            return
+        if self.time_series is not None:
+            self.status_msg.set("4D 序列暂不支持切换通道")
+            return
+        self.show_channel((data['channel'] + delta) % len(paths))
+
+    def show_channel(self, c):
+        """切换显示通道：已解码时只替换数据引用与归一化参数；未解码完成时等待后台结果"""
+        data = self.current_case_data
+        entry = data['channels'].get(c)
+        if entry is None:
+            if not self.is_task_running(f"channel_load:{self.case_token}"):
+                # 通道可能因内存回收被丢弃，重新后台解码
+                self.load_other_channels()
+            if not self.is_task_running(f"channel_load:{self.case_token}"):
+                self.status_msg.set(f"通道 {self.channel_name(c)} 未能解码")
+                return
+            self.status_msg.set(f"通道 {self.channel_name(c)} 正在后台解码...")
+            self._pending_channel = c
+            token = self.case_token
+            # 只响应最后一次切换请求
+            self.root.after(50, lambda: token == self.case_token and self._pending_channel == c
+                            and self.show_channel(c))
+            return
+        self._pending_channel = None
+        data['mri'], data['global_min'], data['global_max'] = entry
+        data['channel'] = c
+        self.status_msg.set(f"当前通道: {self.channel_name(c)} ({c + 1}/{len(data['channel_paths'])})")
+        self.update_display()
 
-        if axis == "R":
-            raw_slice = data[idx, :, :]
-        elif axis == "A":
-            raw_slice = data[:, idx, :]
-        else:  # "S"
-            raw_slice = data[:, :, idx]
+    def setup_time_controls(self):
+        """根据当前病例是否为 4D 序列显示/隐藏时间轴控件"""
+        series = self.time_series
+        if series is None:
+            self.time_frame.pack_forget()
+            self.time_info_text.set("")
+            return
+        self.time_index = 0
+        self.time_scale.config(to=series.n_frames - 1)
+        self.time_scale.set(0)
+        self.time_frame.pack(fill=tk.X, pady=(0, 10), after=self.slice_frame)
+        series.prefetch(0, self.cine_prefetch)
+        self.update_time_info()
+
+    def close_time_series(self):
+        """停止回放并释放 4D 序列的文件句柄与帧缓存"""
+        self.stop_cine()
+        if self._time_wait_after_id is not None:
+            self.root.after_cancel(self._time_wait_after_id)
+            self._time_wait_after_id = None
+        if self.time_series is not None:
+            self.time_series.close()
+            self.time_series = None
+        self.time_frame.pack_forget()
+        self.time_info_text.set("")
+
+    def update_time_info(self):
+        series = self.time_series
+        if series is None:
+            return
+        text = f"T: {self.time_index + 1} / {series.n_frames}"
+        if self.cine_playing:
+            text += f"  {self._cine_measured_fps:.1f} fps"
+        self.time_info_text.set(text)
 
-        slice_view = raw_slice.T[::-1, ::-1]
-        if self.rotation_k != 0:
-            slice_view = np.rot90(slice_view, k=self.rotation_k)
-        return slice_view
+    def on_time_slider_change(self, val):
+        if self.time_series is None:
+            return
+        new_index = int(val)
+        if new_index != self.time_index:
+            self.set_time_index(new_index)
 
-    def set_slice_view(self, data, idx, slice_view):
-        """将 Radiological 视图切片写回原始 3D 数据 (RAS)"""
-        if data is None or slice_view is None:
+    def move_time(self, delta):
+        """逐帧切换时间点 (逗号/句号)"""
+        if self.time_series is None:
+            return
+        self.set_time_index((self.time_index + delta) % self.time_series.n_frames)
+
+    def set_time_index(self, t):
+        """切换时间点：命中缓存立即显示，否则在后台读取完成后再显示，界面不阻塞"""
+        series = self.time_series
+        self.time_index = int(t)
+        series.prefetch(self.time_index, self.cine_prefetch)
+        if self._time_wait_after_id is None:
+            self._wait_time_frame()
+
+    def _wait_time_frame(self):
+        self._time_wait_after_id = None
+        series = self.time_series
+        if series is None:
             return
+        frame = series.get_cached(self.time_index)
+        if frame is None:
+            self.time_info_text.set(f"T: {self.time_index + 1} / {series.n_frames}  读取中...")
+            self._time_wait_after_id = self.root.after(15, self._wait_time_frame)
+            return
+        self.show_time_frame(frame)
 
-        view = slice_view
-        if self.rotation_k != 0:
-            view = np.rot90(view, k=-self.rotation_k)
+    def show_time_frame(self, frame):
+        self.current_case_data['mri'] = frame
+        if int(self.time_scale.get()) != self.time_index:
+            self.time_scale.set(self.time_index)
+        self.update_time_info()
+        self.update_display()
 
-        raw_slice = view[::-1, ::-1].T
-        data[:, :, idx] = raw_slice
+    def toggle_cine(self):
+        if self.cine_playing:
+            self.stop_cine()
+        elif self.time_series is not None:
+            self.cine_playing = True
+            self.btn_cine.config(text="⏸ 暂停")
+            self._cine_deadline = time.perf_counter()
+            self._cine_last_shown = None
+            self._cine_measured_fps = 0.0
+            self._cine_tick()
+
+    def stop_cine(self):
+        self.cine_playing = False
+        if self._cine_after_id is not None:
+            self.root.after_cancel(self._cine_after_id)
+            self._cine_after_id = None
+        self.btn_cine.config(text="▶ 播放")
+        self.update_time_info()
+
+    def _cine_tick(self):
+        """按目标帧率推进时间点；下一帧尚未预取完成时保持当前帧，不阻塞界面"""
+        self._cine_after_id = None
+        series = self.time_series
+        if not self.cine_playing or series is None:
+            return
+        try:
+            fps = min(60, max(1, int(self.cine_fps.get())))
+        except (tk.TclError, ValueError):
+            fps = 15
+        interval = 1.0 / fps
+
+        next_index = (self.time_index + 1) % series.n_frames
+        frame = series.get_cached(next_index)
+        if frame is not None:
+            now = time.perf_counter()
+            if self._cine_last_shown is not None:
+                inst_fps = 1.0 / max(now - self._cine_last_shown, 1e-6)
+                self._cine_measured_fps += 0.2 * (inst_fps - self._cine_measured_fps)
+            self._cine_last_shown = now
+            self.time_index = next_index
+            self.show_time_frame(frame)
+        series.prefetch(self.time_index, self.cine_prefetch)
+
+        # 以绝对时间排程，渲染耗时不会累积成帧率漂移；落后超过一帧时重新对齐
+        now = time.perf_counter()
+        self._cine_deadline += interval
+        if self._cine_deadline < now - interval:
+            self._cine_deadline = now
+        delay_ms = max(1, int((self._cine_deadline - now) * 1000))
+        self._cine_after_id = self.root.after(delay_ms, self._cine_tick)
+
+    def init_editable_mask(self):
+        """按优先级 GT > Pred > 全0 建立写时复制的编辑 Mask，不复制源标签"""
+        gt_data = self.current_case_data.get('gt')
+        pred_data = self.current_case_data.get('pred')
+        if gt_data is not None:
+            self.editable_mask = CopyOnWriteMask(gt_data)
+            self.edit_source = 'gt'
+        elif pred_data is not None:
+            self.editable_mask = CopyOnWriteMask(pred_data)
+            self.edit_source = 'pred'
+        else:
+            self.editable_mask = CopyOnWriteMask(None, shape=self.current_case_data['mri'].shape, dtype=np.int8)
+            self.edit_source = 'blank'
+        self.editable_mask.listeners.append(self.on_mask_slice_changed)
+        if self.label_index is not None:
+            self.label_index.copy_source(self.edit_source, 'edit')
+
+    def _journal_source_tag(self, case):
+        """编辑来源标识：来源文件变化后旧日志不再适用"""
+        source_path = {'gt': case.get('gt_path'), 'pred': case.get('pred_path')}.get(self.edit_source)
+        if not source_path:
+            return self.edit_source or 'blank'
+        st = os.stat(source_path)
+        return f"{self.edit_source}:{st.st_size}:{int(st.st_mtime)}"
+
+    def open_edit_journal(self, case):
+        """为当前病例打开编辑日志；存在未导出的编辑时询问是否恢复"""
+        self.close_edit_journal()
+        if not self.root_dir or self.editable_mask is None:
+            return
 
-    def create_overlay(self, mri_slice, mask_slice, color_mask_enabled=True, preview_mask=None, preview_val=1):
-        """
-        创建叠加图像
-        :param mri_slice: 2D numpy array (MRI values)
-        :param mask_slice: 2D numpy array (Label values 0, 1, 2)
-        :param color_mask_enabled: bool
-        :param preview_mask: 2D boolean array (Preview mask)
-        :param preview_val: int (Label value for preview)
-        """
-        if mri_slice is None:
-            return None
-            
-        # 1. 准备底图 MRI -> RGBA
-        mri_norm = self.normalize_mri(mri_slice)
-        # 将灰度转为 RGBA
-        img_pil = Image.fromarray(mri_norm).convert("RGBA")
+        mask = self.editable_mask
+        # 按病例与编辑来源分别记录，切换 GT/Pred 来源不会覆盖另一来源的日志
+        journal_dir = os.path.join(self.root_dir, ".nii_viewer_journal")
+        path = os.path.join(journal_dir, f"{case['name']}.{self.edit_source or 'blank'}.journal")
+        legacy_path = os.path.join(journal_dir, f"{case['name']}.journal")
+        backup_msg = None
+        try:
+            source_tag = self._journal_source_tag(case)
+            if not os.path.exists(path) and os.path.exists(legacy_path) and \
+                    EditJournal.read_records(legacy_path, mask.shape, source_tag) is not None:
+                os.replace(legacy_path, path) # 旧版本按病例名命名的日志
+            records = EditJournal.read_records(path, mask.shape, source_tag) if os.path.exists(path) else None
+            restored = 0
+            if records:
+                if messagebox.askyesno("恢复编辑", f"检测到 {case['name']} 上次未导出的编辑记录，是否恢复？"):
+                    EditJournal.replay(records, mask)
+                    restored = len(mask.modified_slices())
+                else:
+                    os.replace(path, path + ".bak")
+            elif records is None and os.path.exists(path):
+                # 来源标签文件已变化 (大小/修改时间) 或维度不符：旧日志无法回放，保留为 .bak 而不是清空
+                os.replace(path, path + ".bak")
+                backup_msg = f"{case['name']} 的编辑日志与当前标签文件不符，已另存为 {os.path.basename(path)}.bak"
+
+            # 以当前净差分重写日志 (压缩历史记录)，之后的编辑只追加
+            journal = EditJournal(path, mask.shape, source_tag)
+            journal.start(reset=True)
+            for z in mask.modified_slices():
+                journal.record(z, mask.base_slice(z), mask.get_slice(z))
+            journal.flush()
+        except OSError as e:
+            self.status_msg.set(f"无法创建编辑日志 (编辑不会自动保存): {e}")
+            self.status_color.set("red")
+            self.root.event_generate("<<UpdateStatusColor>>")
+            return
 
-        # 2. 准备 Mask 层 (包含已有 Label 和 预览)
-        if (not color_mask_enabled or mask_slice is None) and preview_mask is None:
-            return img_pil
+        mask.listeners.append(journal.record)
+        self.edit_journal = journal
+        if restored:
+            self.status_msg.set(f"已从编辑日志恢复 {case['name']}: {restored} 个切片")
+            self.status_color.set("blue")
+            self.root.event_generate("<<UpdateStatusColor>>")
+        elif backup_msg:
+            self.status_msg.set(backup_msg)
+            self.status_color.set("red")
+            self.root.event_generate("<<UpdateStatusColor>>")
 
-        rgba_mask = np.zeros((mri_slice.shape[0], mri_slice.shape[1], 4), dtype=np.uint8)
-        
-        # 绘制已有 Label
-        if color_mask_enabled and mask_slice is not None:
-            # Label 1: 透明绿
-            rgba_mask[mask_slice == 1] = [0, 255, 0, 76]
-            # Label 2: 透明黄
-            rgba_mask[mask_slice == 2] = [255, 255, 0, 76] 
-
-        # 绘制预览 Label (覆盖在上面)
-        if preview_mask is not None:
-             # 设置预览颜色，稍微不透明一点以便区分，或者加个边框效果(这里简单处理)
-             # Label 1: 亮绿 [0, 255, 0, 150]
-             # Label 2: 亮黄 [255, 255, 0, 150]
-             # Eraser (val=0): 红色或者是擦除效果? 
-             # 如果是橡皮擦，preview_val应为0，我们可以显示红色半透明表示即将被擦除的区域
-             
-             if preview_val == 1:
-                 color = [0, 255, 0, 160]
-             elif preview_val == 2:
-                 color = [255, 255, 0, 160]
-             else: # Eraser / 0
-                 color = [255, 0, 0, 128] # 红色示警
-                 
-             rgba_mask[preview_mask] = color
+    def close_edit_journal(self):
+        """停止当前日志并把剩余编辑写盘"""
+        journal = self.edit_journal
+        if journal is None:
+            return
+        self.edit_journal = None
+        if self.editable_mask is not None and journal.record in self.editable_mask.listeners:
+            self.editable_mask.listeners.remove(journal.record)
+        try:
+            journal.close()
+        except OSError:
+            pass
+
+    @staticmethod
+    def axis_layout_source(data, axis):
+        """返回按视图顺序排列的 3D 视图 (不复制)，第 i 层等于 get_slice_view_axis 旋转前的切片"""
+        if axis == "R":
+            return data.transpose(0, 2, 1)[:, ::-1, ::-1]
+        if axis == "A":
+            return data.transpose(1, 2, 0)[:, ::-1, ::-1]
+        return data.transpose(2, 1, 0)[:, ::-1, ::-1]
+
+    def ensure_axis_layouts(self, arrays):
+        """RAS 模式下按需在后台构建轴向连续缓存 (已连续的轴跳过)"""
+        if not self.axis_layout_enabled.get() or self.is_task_running("axis_layout"):
+            return
+        if self.time_series is not None:
+            return # 4D 序列逐帧替换数据，缓存无法复用
+        if self.memory_pressure:
+            return # 已因超出内存高水位回收过，当前病例不再重建
+
+        missing = []
+        for data in arrays:
+            if data is None:
+                continue
+            for axis in ("R", "A", "S"):
+                entry = self.axis_layout_cache.get((id(data), axis))
+                if entry is not None and entry[0] is data:
+                    continue
+                sample = self.axis_layout_source(data, axis)[0]
+                if sample.flags.c_contiguous or sample[::-1, ::-1].flags.c_contiguous:
+                    continue # 原始内存布局下该轴切片已连续
+                missing.append((data, axis))
+        if not missing:
+            return
+
+        def worker(progress):
+            built = []
+            for i, (data, axis) in enumerate(missing):
+                src = self.axis_layout_source(data, axis)
+                out = np.empty(src.shape, dtype=src.dtype)
+                step = max(1, src.shape[0] // 16)
+                for j in range(0, src.shape[0], step):
+                    out[j:j + step] = src[j:j + step]
+                    progress((i + (j + step) / src.shape[0]) / len(missing), f"构建 {axis} 轴连续缓存...")
+                built.append((data, axis, out))
+            return built
+
+        def on_done(built):
+            for data, axis, out in built:
+                self.axis_layout_cache[(id(data), axis)] = (data, out)
+            self.update_axis_layout_info()
+            self.update_display()
+
+        self.run_background_task("axis_layout", worker, on_done)
+
+    def clear_projections(self):
+        self.full_projections = None
+        self.slab_projectors.clear()
+
+    def projection_nbytes(self):
+        total = sum(p.nbytes() for p in self.slab_projectors.values())
+        if self.full_projections is not None:
+            total += sum(a.nbytes for a in self.full_projections[2].values())
+        return total
+
+    def get_slab_thickness(self):
+        try:
+            return max(0, int(self.slab_thickness.get()))
+        except (tk.TclError, ValueError):
+            return 0
+
+    def ensure_full_projections(self, mri_data, label_data):
+        """后台分块计算整卷 MIP/MinIP 与标签最大投影；通道切换后重新计算"""
+        entry = self.full_projections
+        if entry is not None and entry[0] is mri_data and entry[1] is label_data:
+            return entry[2]
+        name = f"projection:{self.case_token}"
+        if self.is_task_running(name):
+            return None
 
-        # 转换为 PIL Overlay
-        mask_layer = Image.fromarray(rgba_mask, mode="RGBA")
+        def worker(progress):
+            projections = axis_projections(mri_data, progress=lambda f: progress(f * 0.8))
+            if label_data is not None:
+                for key, proj in axis_projections(label_data, ops=("max",)).items():
+                    projections[key + ("label",)] = proj
+            progress(1.0)
+            return projections
+
+        def on_done(projections):
+            self.full_projections = (mri_data, label_data, projections)
+            if self.current_case_data.get('mri') is mri_data:
+                self.update_display()
 
-        # 3. 混合
-        combined = Image.alpha_composite(img_pil, mask_layer)
-        return combined
+        self.run_background_task(name, worker, on_done)
+        return None
 
-    def create_diff_overlay(self, mri_slice, pred_slice, gt_slice):
+    def projection_views(self, axis, index, mri_data, label_data):
         """
-        创建差异分析图
-        Green系: Label 1 (FP=亮绿, FN=暗绿)
-        Yellow系: Label 2 (FP=亮黄, FN=暗橙黄)
+        RAS 窗的投影：厚度为 0 (或不小于该方向层数) 时用整卷投影，否则以 index 为中心的厚层投影
+        :return: (强度投影, 标签最大投影或 None, 标题)，均扩展为该方向上只有 1 层的 3D 数组；整卷投影未就绪时返回 None
         """
-        mri_norm = self.normalize_mri(mri_slice)
-        img_pil = Image.fromarray(mri_norm).convert("RGBA")
-        
-        if pred_slice is None or gt_slice is None:
-            return img_pil
-            
-        rgba_mask = np.zeros((mri_slice.shape[0], mri_slice.shape[1], 4), dtype=np.uint8)
-        
-        # --- Label 1 (Green) ---
-        # False Positive (多标): Pred=1, GT!=1 -> 亮绿色
-        # RGBA: [0, 255, 0, 100]
-        mask_fp_1 = (pred_slice == 1) & (gt_slice != 1)
-        rgba_mask[mask_fp_1] = [0, 255, 0, 100]
-        
-        # False Negative (少标/漏标): Pred!=1, GT=1 -> 暗绿色 (ForestGreen)
-        # RGBA: [34, 139, 34, 120]
-        mask_fn_1 = (pred_slice != 1) & (gt_slice == 1)
-        rgba_mask[mask_fn_1] = [34, 139, 34, 120] 
+        op = "max" if self.ras_projection.get() == "mip" else "min"
+        name = "MIP" if op == "max" else "MinIP"
+        n = mri_data.shape[PROJECTION_AXES[axis]]
+        width = self.get_slab_thickness()
+        dim = PROJECTION_AXES[axis]
+        if width == 0 or width >= n:
+            projections = self.ensure_full_projections(mri_data, label_data)
+            if projections is None:
+                return None
+            mri_proj = projections[(axis, op)]
+            label_proj = projections.get((axis, "max", "label"))
+            title = f"{axis} {name}"
+        else:
+            for key in [key for key in self.slab_projectors if key[3] != width]:
+                del self.slab_projectors[key] # 厚度变化后旧的分块累积不再可用
+
+            def projector(data, data_op):
+                key = (id(data), axis, data_op, width)
+                proj = self.slab_projectors.get(key)
+                if proj is None or proj.data is not data:
+                    proj = self.slab_projectors[key] = SlabProjector(data, axis, width, data_op)
+                return proj
+
+            with self.profiler.stage("projection"):
+                mri_projector = projector(mri_data, op)
+                mri_proj = mri_projector.project(index)
+                label_proj = projector(label_data, "max").project(index) if label_data is not None else None
+            start = mri_projector.window_start(index)
+            title = f"{axis} {name} {start + 1}-{start + width}"
+        label_proj = np.expand_dims(label_proj, dim) if label_proj is not None else None
+        return np.expand_dims(mri_proj, dim), label_proj, title
+
+    def clear_axis_layouts(self):
+        self.axis_layout_cache.clear()
+        self.update_axis_layout_info()
+
+    def update_axis_layout_info(self):
+        """在控制面板显示轴向缓存占用的内存"""
+        if not self.axis_layout_cache:
+            self.axis_layout_info.set("")
+            return
+        nbytes = sum(entry[1].nbytes for entry in self.axis_layout_cache.values())
+        axes = "".join(sorted({key[1] for key in self.axis_layout_cache}))
+        self.axis_layout_info.set(f"  连续缓存 {axes}: {nbytes / 1024 ** 2:.1f} MB")
 
-        # --- Label 2 (Yellow) ---
-        # False Positive (多标): Pred=2, GT!=2 -> 亮黄色
-        # RGBA: [255, 255, 0, 100]
-        mask_fp_2 = (pred_slice == 2) & (gt_slice != 2)
-        rgba_mask[mask_fp_2] = [255, 255, 0, 100]
-        
-        # False Negative (少标/漏标): Pred!=2, GT=2 -> 暗橙色 (DarkOrange)
-        # RGBA: [255, 140, 0, 120]
-        mask_fn_2 = (pred_slice != 2) & (gt_slice == 2)
-        rgba_mask[mask_fn_2] = [255, 140, 0, 120]
-        
-        mask_layer = Image.fromarray(rgba_mask, mode="RGBA")
-        return Image.alpha_composite(img_pil, mask_layer)
+    def on_axis_layout_toggle(self):
+        if not self.axis_layout_enabled.get():
+            self.clear_axis_layouts()
+        self.update_display()
 
-    def on_resize(self, event):
-        """窗口大小改变时的回调"""
-        # 只有在开启自适应且有数据加载时才自动刷新
-        if self.auto_fit_window.get() and self.current_case_data:
+    def pyramid_sources(self):
+        """需要金字塔的体数据及其源文件: [(data, 是否标签, 源文件路径)]"""
+        data = self.current_case_data
+        sources = [(data['mri'], False, data['channel_paths'][data['channel']]),
+                   (data.get('pred'), True, data.get('pred_path')),
+                   (data.get('gt'), True, data.get('gt_path'))]
+        return [item for item in sources if item[0] is not None]
+
+    def pyramid_cache_file(self, source_path, factor):
+        """磁盘缓存文件名包含源文件大小与修改时间，源文件变化后自动失效"""
+        st = os.stat(source_path)
+        name = os.path.basename(source_path)
+        if name.endswith(".nii.gz"):
+            name = name[:-len(".nii.gz")]
+        folder = os.path.basename(os.path.dirname(source_path))
+        return os.path.join(self.root_dir, ".nii_viewer_cache", "pyramid",
+                            f"{folder}_{name}_{st.st_size}_{int(st.st_mtime)}_x{factor}.npy")
+
+    def ensure_pyramids(self):
+        """大体数据在后台构建 2/4/8 倍下采样层级 (可从磁盘缓存读取)"""
+        if not self.pyramid_enabled.get() or self.time_series is not None:
+            return # 4D 序列逐帧替换数据，金字塔无法复用
+        if self.memory_pressure:
+            return # 已因超出内存高水位回收过，当前病例不再重建
+        task_name = f"pyramid:{self.case_token}"
+        if self.is_task_running(task_name):
+            return
+
+        todo = []
+        for data, labels, path in self.pyramid_sources():
+            entry = self.pyramid_cache.get(id(data))
+            if entry is not None and entry[0] is data:
+                continue
+            if data.size < self.pyramid_min_voxels:
+                continue
+            todo.append((data, labels, path))
+        if not todo:
+            return
+        use_disk = self.pyramid_disk_cache.get() and bool(self.root_dir)
+
+        def worker(progress):
+            built = []
+            steps = len(todo) * len(self.pyramid_factors)
+            for i, (data, labels, path) in enumerate(todo):
+                levels = {}
+                prev = data
+                for j, factor in enumerate(self.pyramid_factors):
+                    done = i * len(self.pyramid_factors) + j
+                    cache_file = self.pyramid_cache_file(path, factor) if use_disk and path else None
+                    level = None
+                    expected = tuple(-(-n // factor) for n in data.shape)
+                    if cache_file and os.path.exists(cache_file):
+                        try:
+                            level = np.load(cache_file, mmap_mode='r')
+                        except (OSError, ValueError):
+                            level = None
+                        if level is not None and level.shape != expected:
+                            level = None
+                    if level is None:
+                        level = downsample2(prev, labels=labels, progress=lambda f: progress(
+                            (done + f) / steps, f"构建多分辨率金字塔 (x{factor})..."))
+                        if cache_file:
+                            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                            tmp_path = cache_file + ".part"
+                            with open(tmp_path, "wb") as fh:
+                                np.save(fh, level)
+                            os.replace(tmp_path, cache_file)
+                    levels[factor] = level
+                    prev = level
+                built.append((data, levels))
+            return built
+
+        def on_done(built):
+            for data, levels in built:
+                self.pyramid_cache[id(data)] = (data, levels)
+            self.update_pyramid_info()
             self.update_display()
 
-    def process_zoom_pan(self, img_pil, display_constraints):
+        self.run_background_task(task_name, worker, on_done)
+
+    def select_pyramid_factor(self, volumes, view_w, view_h, display_constraints, axis=None):
         """
-        应用缩放和平移
-        :param display_constraints: 
-            int: 固定高度模式，值为 height
-            tuple (w, h): 自适应模式，值为容器最大宽高
+        按缩放级别与面板尺寸选择下采样倍数: 取每个屏幕像素覆盖的源像素数以内最大的可用层级，
+        所有参与叠加的体数据都需具备该层级；编辑模式下始终返回 1 (原分辨率)
         """
-        w, h = img_pil.size
-        
-        # 确保 zoom_level >= 1.0
-        if self.zoom_level < 1.0:
-            self.zoom_level = 1.0
-            
-        fov_w = w / self.zoom_level
-        fov_h = h / self.zoom_level
-        
-        # 计算左上角位置
-        left = (self.pan_center_x * w) - (fov_w / 2)
-        top = (self.pan_center_y * h) - (fov_h / 2)
-        
-        # 边界限制 clamping
-        # 确保不会超出图像边界
-        if left < 0: left = 0
-        if left + fov_w > w: left = w - fov_w
-        
-        if top < 0: top = 0
-        if top + fov_h > h: top = h - fov_h
-        
-        # 更新实际中心点 (因为可能被Clamp移动了)
-        self.pan_center_x = (left + fov_w / 2) / w
-        self.pan_center_y = (top + fov_h / 2) / h
-        
-        # 裁剪
-        crop_box = (left, top, left + fov_w, top + fov_h)
-        img_crop = img_pil.crop(crop_box)
-        
-        # 计算目标显示尺寸
-        aspect_ratio = w / h
-        
-        if isinstance(display_constraints, int):
-            # 固定高度模式
-            disp_h = display_constraints
-            disp_w = int(disp_h * aspect_ratio)
+        if not self.pyramid_enabled.get() or self.edit_mode.get() or not self.pyramid_cache:
+            return 1
+        entries = []
+        for data in volumes:
+            if data is None:
+                continue
+            entry = self.pyramid_cache.get(id(data))
+            if entry is None or entry[0] is not data:
+                return 1
+            entries.append(entry[1])
+
+        if axis is None:
+            phys_w, phys_h = view_w, view_h
         else:
-            # 自适应模式 (max_w, max_h)
-            max_w, max_h = display_constraints
-            
-            # 防止无效尺寸
-            if max_w <= 10: max_w = 400
-            if max_h <= 10: max_h = 400
-            
-            win_ratio = max_w / max_h
-            if aspect_ratio > win_ratio:
-                # 图片更宽，以宽为准 (contain)
-                disp_w = max_w
-                disp_h = int(max_w / aspect_ratio)
-            else:
-                # 图片更高，以高为准
-                disp_h = max_h
-                disp_w = int(max_h * aspect_ratio)
-        
-        img_final = img_crop.resize((disp_w, disp_h), Image.Resampling.NEAREST)
-        self.current_disp_size = (disp_w, disp_h)
-        
-        return img_final
+            phys_w, phys_h = self.ras_physical_size(view_w, view_h, axis)
+        _, _, fov_w, fov_h, disp_w, disp_h = self.zoom_pan_geometry(phys_w, phys_h, display_constraints)
+        density = min(fov_w * view_w / phys_w / disp_w, fov_h * view_h / phys_h / disp_h)
+
+        factor = 1
+        for f in self.pyramid_factors:
+            if f <= density and all(f in levels for levels in entries):
+                factor = f
+        return factor
+
+    def pyramid_level(self, data, factor):
+        """返回 data 的指定下采样层级 (factor=1 时为原数据)"""
+        if data is None or factor == 1:
+            return data
+        return self.pyramid_cache[id(data)][1][factor]
+
+    def clear_pyramids(self):
+        self.pyramid_cache.clear()
+        self.update_pyramid_info()
+
+    def update_pyramid_info(self):
+        """在控制面板显示金字塔占用的内存 (磁盘缓存以 mmap 方式映射，不计入)"""
+        nbytes = sum(level.nbytes for _, levels in self.pyramid_cache.values()
+                     for level in levels.values() if not isinstance(level, np.memmap))
+        if not self.pyramid_cache:
+            self.pyramid_info.set("")
+        else:
+            self.pyramid_info.set(f"  金字塔 {len(self.pyramid_cache)} 个体数据: {nbytes / 1024 ** 2:.1f} MB")
 
-    def adjust_ras_physical_aspect(self, img_pil, axis):
-        """按体素间距修正 R/A/S 切片的物理长宽比"""
-        if img_pil is None:
-            return img_pil
+    def on_pyramid_toggle(self):
+        if not self.pyramid_enabled.get():
+            self.clear_pyramids()
+        self.update_display()
 
-        sx, sy, sz = self.current_voxel_sizes
-        if axis == "R":
-            row_spacing, col_spacing = sz, sy   # rows=Z, cols=Y
-        elif axis == "A":
-            row_spacing, col_spacing = sz, sx   # rows=Z, cols=X
-        else:  # "S"
-            row_spacing, col_spacing = sy, sx   # rows=Y, cols=X
+    def set_slice_view(self, data, idx, slice_view):
+        """将 Radiological 视图切片写回原始 3D 数据 (RAS)"""
+        if data is None or slice_view is None:
+            return
 
-        if row_spacing <= 0 or col_spacing <= 0:
-            return img_pil
+        view = slice_view
+        if self.rotation_k != 0:
+            view = np.rot90(view, k=-self.rotation_k)
 
-        w, h = img_pil.size
-        base = min(row_spacing, col_spacing)
-        target_w = max(1, int(round(w * (col_spacing / base))))
-        target_h = max(1, int(round(h * (row_spacing / base))))
-        if target_w == w and target_h == h:
-            return img_pil
+        raw_slice = view[::-1, ::-1].T
+        data[:, :, idx] = raw_slice
 
-        return img_pil.resize((target_w, target_h), Image.Resampling.NEAREST)
+    def on_resize(self, event):
+        """窗口大小改变时的回调"""
+        # 只有在开启自适应且有数据加载时才自动刷新
+        if self.auto_fit_window.get() and self.current_case_data:
+            self.update_display()
+
+    def schedule_ras_hq_render(self):
+        """交互停止一段时间后用高质量滤波重绘 RAS 窗口"""
+        if self._ras_hq_after_id is not None:
+            self.root.after_cancel(self._ras_hq_after_id)
+            self._ras_hq_after_id = None
+        if self.ras_hq_filter.get() == "nearest":
+            return
+        self._ras_hq_after_id = self.root.after(self.ras_hq_delay_ms, self._render_ras_hq)
+
+    def _render_ras_hq(self):
+        self._ras_hq_after_id = None
+        if self.layout_mode.get() != "ras":
+            return
+        self._ras_hq_pass = True
+        try:
+            self.update_display()
+        finally:
+            self._ras_hq_pass = False
 
     def update_display(self):
-        """刷新双面板图像"""
+        """刷新双面板图像 (开启性能分析时记录整帧耗时并刷新 HUD)"""
+        profiler = self.profiler
+        if not profiler.enabled:
+            self._render_frame()
+            return
+        start = time.perf_counter_ns()
+        with profiler.stage("update_display", "frame"):
+            self._render_frame()
+        profiler.frame_done((time.perf_counter_ns() - start) / 1e6)
+        self.update_profiler_hud()
+
+    def _render_frame(self):
         if not self.current_case_data:
             return
+        stage = self.profiler.stage
 
         # --- 布局与图像生成 ---
         mode = self.layout_mode.get()
         mri_data = self.current_case_data['mri']
+        use_worker = self.use_render_worker() # 非编辑面板交给渲染进程合成，本进程只计算视图几何
         shape_x, shape_y, shape_z = mri_data.shape
 
         # 计算显示约束
@@ -1252,126 +4932,275 @@ class NiiViewerApp:
             self.slice_scale.config(to=max(0, shape_z - 1))
             if int(self.slice_scale.get()) != self.ras_index_s:
                 self.slice_scale.set(self.ras_index_s)
-            self.slice_info_text.set(f"S Slice: {self.ras_index_s + 1} / {shape_z}")
+            self.slice_info_text.set(f"S Slice: {self.ras_index_s + 1} / {shape_z}{self.channel_label()}")
         else:
             idx = self.current_slice_index
             self.slice_scale.config(to=max(0, shape_z - 1))
             if int(self.slice_scale.get()) != idx:
                 self.slice_scale.set(idx)
-            self.slice_info_text.set(f"Slice: {idx + 1} / {self.total_slices}")
+            self.slice_info_text.set(f"Slice: {idx + 1} / {self.total_slices}{self.channel_label()}")
 
-            # 使用 helper 获取转换视角的切片
-            mri_slice = self.get_slice_view(mri_data, idx)
-            pred_slice = self.get_slice_view(self.current_case_data.get('pred'), idx)
-            gt_slice = self.get_slice_view(self.current_case_data.get('gt'), idx)
-
-        # 1. 重置布局 (防止残留)
-        self.panel_left.pack_forget()
-        self.panel_right.pack_forget()
-        self.panel_ras_r.pack_forget()
-        self.panel_ras_a.pack_forget()
-        self.panel_ras_s.pack_forget()
+            # 使用 helper 获取转换视角的切片；缩小显示时改用金字塔中分辨率匹配的层级
+            with stage("slice"):
+                pred_data = self.current_case_data.get('pred')
+                gt_data = self.current_case_data.get('gt')
+                view_h, view_w = self.get_slice_view(mri_data, idx).shape
+                factor = self.select_pyramid_factor([mri_data, pred_data, gt_data], view_w, view_h, display_constraints)
+                mri_slice = self.get_slice_view(self.pyramid_level(mri_data, factor), idx // factor)
+                pred_level = self.pyramid_level(pred_data, factor)
+                gt_level = self.pyramid_level(gt_data, factor)
+                pred_slice = self.get_slice_view(pred_level, idx // factor)
+                gt_slice = self.get_slice_view(gt_level, idx // factor)
 
-        # 2. 根据模式 Pack
-        if mode == "dual":
-            self.panel_left.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
-            self.panel_right.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=2)
-        elif mode == "left" or mode == "diff":
-            self.panel_left.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
-        elif mode == "right":
-            self.panel_right.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=2)
-        elif mode == "ras":
-            self.panel_ras_s.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
-            self.panel_ras_a.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
-            self.panel_ras_r.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
+        if not use_worker:
+            self.ensure_pyramids()
 
-        # 强制更新布局计算，防止渲染和变量延迟
-        self.root.update_idletasks()
+        # 布局变化时才重新 Pack，并强制更新布局计算，防止渲染和变量延迟
+        if self.pack_panels(mode):
+            self.root.update_idletasks()
 
         if mode == "ras":
-            mri_r = self.get_slice_view_axis(mri_data, "R", self.ras_index_r)
-            mri_a = self.get_slice_view_axis(mri_data, "A", self.ras_index_a)
-            mri_s = self.get_slice_view_axis(mri_data, "S", self.ras_index_s)
-
             # RAS 模式下标签优先级: labelsTr(GT) > predictsTr(Pred) > None
             ras_label_data = self.current_case_data.get('gt')
             if ras_label_data is None:
                 ras_label_data = self.current_case_data.get('pred')
-
-            if ras_label_data is not None:
-                label_r = self.get_slice_view_axis(ras_label_data, "R", self.ras_index_r)
-                label_a = self.get_slice_view_axis(ras_label_data, "A", self.ras_index_a)
-                label_s = self.get_slice_view_axis(ras_label_data, "S", self.ras_index_s)
-                img_r_pil = self.create_overlay(mri_r, label_r, True)
-                img_a_pil = self.create_overlay(mri_a, label_a, True)
-                img_s_pil = self.create_overlay(mri_s, label_s, True)
+            if not use_worker:
+                self.ensure_axis_layouts([mri_data, ras_label_data])
+
+            # 交互中用最近邻保证速度，静止后再用高质量滤波重绘一次
+            if self._ras_hq_pass:
+                resample = {
+                    "bilinear": Image.Resampling.BILINEAR,
+                    "lanczos": Image.Resampling.LANCZOS
+                }.get(self.ras_hq_filter.get(), Image.Resampling.NEAREST)
             else:
-                img_r_pil = self.create_overlay(mri_r, None, False)
-                img_a_pil = self.create_overlay(mri_a, None, False)
-                img_s_pil = self.create_overlay(mri_s, None, False)
-
-            img_r_pil = self.adjust_ras_physical_aspect(img_r_pil, "R")
-            img_a_pil = self.adjust_ras_physical_aspect(img_a_pil, "A")
-            img_s_pil = self.adjust_ras_physical_aspect(img_s_pil, "S")
-
-            img_r_display = self.process_zoom_pan(img_r_pil, display_constraints)
-            img_a_display = self.process_zoom_pan(img_a_pil, display_constraints)
-            img_s_display = self.process_zoom_pan(img_s_pil, display_constraints)
-
-            self.tk_img_ras_r = ImageTk.PhotoImage(img_r_display)
-            self.tk_img_ras_a = ImageTk.PhotoImage(img_a_display)
-            self.tk_img_ras_s = ImageTk.PhotoImage(img_s_display)
-
-            self.panel_ras_r.config(image=self.tk_img_ras_r, text="R", compound=tk.TOP)
-            self.panel_ras_a.config(image=self.tk_img_ras_a, text="A", compound=tk.TOP)
-            self.panel_ras_s.config(image=self.tk_img_ras_s, text="S", compound=tk.TOP)
+                resample = Image.Resampling.NEAREST
+                self.schedule_ras_hq_render()
+
+            # 投影模式在本进程计算 (4D 序列每帧数据不同，仍显示切片)
+            projection = self.ras_projection.get() if self.time_series is None else "slice"
+            for axis, index, panel in (("R", self.ras_index_r, self.panel_ras_r),
+                                       ("A", self.ras_index_a, self.panel_ras_a),
+                                       ("S", self.ras_index_s, self.panel_ras_s)):
+                t_start = time.perf_counter()
+                views = None
+                if projection != "slice":
+                    views = self.projection_views(axis, index, mri_data, ras_label_data)
+                title = views[2] if views is not None else axis
+                if self._ras_titles.get(axis) != title:
+                    self._ras_titles[axis] = title
+                    panel.set_title(title)
+                if views is not None:
+                    mri_view = self.get_slice_view_axis(views[0], axis, 0)
+                    label_view = self.get_slice_view_axis(views[1], axis, 0)
+                    img_pil = self.create_overlay(mri_view, label_view, label_view is not None)
+                    img_display = self.process_ras_view(img_pil, axis, display_constraints, resample)
+                    with stage("blit"):
+                        panel.show_image(img_display, t_start)
+                    continue
+                if use_worker:
+                    view_h, view_w = self.get_slice_view_axis(mri_data, axis, index).shape
+                    phys_w, phys_h = self.ras_physical_size(view_w, view_h, axis)
+                    self.current_disp_size = self.zoom_pan_geometry(phys_w, phys_h, display_constraints)[4:]
+                    ras_mask = 'gt' if self.current_case_data.get('gt') is not None else (
+                        'pred' if self.current_case_data.get('pred') is not None else None)
+                    self.request_worker_frame(panel, {'kind': "ras", 'axis': axis, 'idx': index, 'mask': ras_mask,
+                                                      'resample': resample}, display_constraints, t_start)
+                    continue
+                with stage("slice"):
+                    view_h, view_w = self.get_slice_view_axis(mri_data, axis, index).shape
+                    factor = self.select_pyramid_factor([mri_data, ras_label_data], view_w, view_h,
+                                                        display_constraints, axis)
+                    mri_view = self.get_slice_view_axis(self.pyramid_level(mri_data, factor), axis, index // factor)
+                    label_view = None
+                    if ras_label_data is not None:
+                        label_level = self.pyramid_level(ras_label_data, factor)
+                        label_view = self.get_slice_view_axis(label_level, axis, index // factor)
+                if label_view is not None:
+                    img_pil = self.create_overlay(mri_view, label_view, True,
+                                                  cache_key=self.slice_cache_key((label_level,), axis, index // factor))
+                else:
+                    img_pil = self.create_overlay(mri_view, None, False)
+                img_display = self.process_ras_view(img_pil, axis, display_constraints, resample)
+                with stage("blit"):
+                    panel.show_image(img_display, t_start)
+            self.update_frame_time_info()
             return
 
+        if use_worker:
+            # 渲染进程使用原分辨率切片；视图几何在本进程计算，供鼠标坐标映射与编辑使用
+            geometry = self.zoom_pan_geometry(*self.get_slice_view(mri_data, idx).shape[::-1], display_constraints)
+            self.current_view_geometry = geometry
+            self.current_disp_size = geometry[4:]
+
         # --- 生成左图 (MRI + Pred) OR (Diff Map) ---
-        if mode in ["dual", "left"]:
-            img_left_pil = self.create_overlay(mri_slice, pred_slice, self.show_pred.get())
+        if use_worker and mode in ["dual", "left", "diff"]:
+            request = ({'kind': "diff", 'idx': idx} if mode == "diff" else
+                       {'kind': "overlay", 'idx': idx, 'mask': 'pred', 'show_mask': self.show_pred.get()})
+            self.request_worker_frame(self.panel_left, request, display_constraints, time.perf_counter())
+        elif mode in ["dual", "left"]:
+            t_start = time.perf_counter()
+            img_left_pil = self.create_overlay(mri_slice, pred_slice, self.show_pred.get(),
+                                               cache_key=self.slice_cache_key((pred_level,), "S", idx // factor))
             img_left_display = self.process_zoom_pan(img_left_pil, display_constraints)
-            self.tk_img_left = ImageTk.PhotoImage(img_left_display)
-            self.panel_left.config(image=self.tk_img_left, text="")
+            with stage("blit"):
+                self.panel_left.show_image(img_left_display, t_start)
         elif mode == "diff":
             # 差异图模式
-            img_diff_pil = self.create_diff_overlay(mri_slice, pred_slice, gt_slice)
+            t_start = time.perf_counter()
+            img_diff_pil = self.create_diff_overlay(mri_slice, pred_slice, gt_slice,
+                                                    self.slice_cache_key((pred_level, gt_level), "diff", idx // factor))
             img_left_display = self.process_zoom_pan(img_diff_pil, display_constraints)
-            self.tk_img_left = ImageTk.PhotoImage(img_left_display)
-            self.panel_left.config(image=self.tk_img_left, text="")
+            with stage("blit"):
+                self.panel_left.show_image(img_left_display, t_start)
 
         # --- 生成右图 (MRI + GT or Empty or Edited) ---
-        if mode in ["dual", "right"]:
+        if (use_worker and mode in ["dual", "right"]
+                and not (self.edit_mode.get() and self.editable_mask is not None)):
+            self.request_worker_frame(self.panel_right, {'kind': "overlay", 'idx': idx, 'mask': 'gt',
+                                                         'show_mask': self.show_gt.get()},
+                                      display_constraints, time.perf_counter())
+        elif mode in ["dual", "right"]:
+            t_start = time.perf_counter()
             # 如果在编辑模式，优先显示 editable_mask
             if self.edit_mode.get() and self.editable_mask is not None:
                 # 获取切片视图，确保方向正确
                 mask_slice = self.get_slice_view(self.editable_mask, idx)
                 
-                # 生成预览 Mask
+                # 魔棒预览依赖图像内容，仍以像素叠加；画笔/橡皮/填充的光标由 update_brush_cursor 画成 Canvas 图元
                 preview_mask = None
                 preview_val = 1
-                if self.preview_cursor_pos:
+                if self.preview_cursor_pos and self.current_tool.get() == "wand":
                     px, py = self.preview_cursor_pos
-                    # 获取 MRI slice view 用于 wand 计算 (如果需要)
-                    # 注意: get_tool_mask 需要的是 view 坐标系下的数据
-                    # mri_slice 已经是 view
-                    preview_mask = self.get_tool_mask(self.current_tool.get(), px, py, mri_slice)
-                    preview_val = self.edit_label_val.get() if self.current_tool.get() != "eraser" else 0
+                    # 注意: get_tool_mask 需要的是 view 坐标系下的数据, mri_slice 已经是 view
+                    with stage("wand_preview"):
+                        preview_mask = self.get_tool_mask("wand", px, py, mri_slice)
+                    preview_val = self.edit_label_val.get()
                 
                 img_right_pil = self.create_overlay(mri_slice, mask_slice, self.show_gt.get(), preview_mask, preview_val)
-                img_right_display = self.process_zoom_pan(img_right_pil, display_constraints)
-                self.tk_img_right = ImageTk.PhotoImage(img_right_display)
-                self.panel_right.config(image=self.tk_img_right, text="")
             elif gt_slice is not None:
-                img_right_pil = self.create_overlay(mri_slice, gt_slice, self.show_gt.get())
-                img_right_display = self.process_zoom_pan(img_right_pil, display_constraints)
-                self.tk_img_right = ImageTk.PhotoImage(img_right_display)
-                self.panel_right.config(image=self.tk_img_right, text="")
+                img_right_pil = self.create_overlay(mri_slice, gt_slice, self.show_gt.get(),
+                                                    cache_key=self.slice_cache_key((gt_level,), "S", idx // factor))
             else:
                 img_right_pil = self.create_overlay(mri_slice, None, False)
-                img_right_display = self.process_zoom_pan(img_right_pil, display_constraints)
-                self.tk_img_right = ImageTk.PhotoImage(img_right_display)
-                self.panel_right.config(image=self.tk_img_right, text="")
+            img_right_display = self.process_zoom_pan(img_right_pil, display_constraints)
+            with stage("blit"):
+                self.panel_right.show_image(img_right_display, t_start)
+
+        self.update_brush_cursor()
+        self.update_frame_time_info()
+
+    def on_profiler_toggle(self):
+        """开启时清空历史记录，关闭时清空 HUD"""
+        enabled = self.profiler_enabled.get()
+        if enabled:
+            self.profiler.reset()
+        self.profiler.enabled = enabled
+        self.profiler_hud.set("Profiler: 等待刷新..." if enabled else "")
+        self.update_display()
+
+    def update_profiler_hud(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self._hud_last_update < self.hud_interval:
+            return
+        self._hud_last_update = now
+        self.profiler_hud.set(self.profiler.hud_text())
+
+    def export_profile_trace(self):
+        """导出已记录的阶段耗时为 Chrome trace JSON (可在 chrome://tracing 或 Perfetto 中打开)"""
+        if not self.profiler.events:
+            messagebox.showinfo("提示", "暂无性能记录，请先勾选“性能分析 HUD”并操作一段时间。")
+            return
+        file_path = filedialog.asksaveasfilename(
+            initialdir=self.last_export_dir,
+            initialfile="nii_viewer_trace.json",
+            defaultextension=".json",
+            filetypes=[("Chrome Trace", "*.json")]
+        )
+        if not file_path:
+            return
+        try:
+            count = self.profiler.export_chrome_trace(file_path)
+        except OSError as e:
+            messagebox.showerror("导出失败", str(e))
+            return
+        self.status_msg.set(f"已导出 {count} 条性能记录: {file_path}")
+
+    def pack_panels(self, mode):
+        """按布局模式 Pack 显示面板；布局未变化时不做任何事，返回是否重新布局"""
+        if mode == self._packed_layout:
+            return False
+        self._packed_layout = mode
+
+        # 1. 重置布局 (防止残留)
+        for panel in (self.panel_left, self.panel_right, self.panel_ras_r, self.panel_ras_a, self.panel_ras_s):
+            panel.pack_forget()
+
+        # 2. 根据模式 Pack
+        if mode == "dual":
+            self.panel_left.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
+            self.panel_right.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=2)
+        elif mode == "left" or mode == "diff":
+            self.panel_left.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
+        elif mode == "right":
+            self.panel_right.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=2)
+        elif mode == "ras":
+            self.panel_ras_s.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
+            self.panel_ras_a.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
+            self.panel_ras_r.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
+        return True
+
+    def update_frame_time_info(self):
+        """在侧边栏显示当前布局下各面板的合成/上屏耗时 (指数平滑)"""
+        mode = self._packed_layout
+        if mode == "ras":
+            panels = (("S", self.panel_ras_s), ("A", self.panel_ras_a), ("R", self.panel_ras_r))
+        else:
+            panels = []
+            if mode in ("dual", "left", "diff"):
+                panels.append(("L", self.panel_left))
+            if mode in ("dual", "right"):
+                panels.append(("R", self.panel_right))
+        parts = [f"{name} {p.render_ms:.1f}/{p.blit_ms:.1f}" for name, p in panels if p.frame_count]
+        self.frame_time_info.set(("  合成/上屏 ms: " + "  ".join(parts)) if parts else "")
+
+    def image_to_screen_coords(self, img_x, img_y):
+        """将 Slice 图像坐标 (可为小数) 转换为右侧面板坐标，是 screen_to_image_coords 的逆变换"""
+        geometry = getattr(self, 'current_view_geometry', None)
+        if not geometry:
+            return None
+        left, top, fov_w, fov_h, disp_w, disp_h = geometry
+        off_x, off_y = self.panel_right.image_offset()
+        sx = off_x + (img_x - left) * disp_w / fov_w
+        sy = off_y + (img_y - top) * disp_h / fov_h
+        return sx, sy
+
+    def update_brush_cursor(self):
+        """画笔/橡皮/填充的光标以 Canvas 圆形图元显示，移动鼠标时无需重新合成图像"""
+        panel = self.panel_right
+        tool = self.current_tool.get()
+        if (not self.edit_mode.get() or self.editable_mask is None or not self.preview_cursor_pos
+                or tool == "wand" or self._packed_layout not in ("dual", "right")):
+            panel.hide_cursor()
+            return
+        px, py = self.preview_cursor_pos
+        # 像素中心对齐，与 get_tool_mask 的离散圆一致
+        center = self.image_to_screen_coords(px + 0.5, py + 0.5)
+        if center is None:
+            panel.hide_cursor()
+            return
+        left, top, fov_w, fov_h, disp_w, disp_h = self.current_view_geometry
+        scale = disp_w / fov_w
+        if tool == "fill":
+            radius = 0.5 * scale
+            color = "white"
+        else:
+            radius = self.brush_size.get() / 2.0 * scale
+            if tool == "eraser":
+                color = "#ff4040"
+            else:
+                color = "#00ff00" if self.edit_label_val.get() == 1 else "#ffff00"
+        panel.set_cursor_circle(center[0], center[1], radius, color)
 
     def screen_to_image_coords(self, sx, sy, img_w, img_h):
         """将屏幕坐标转换为 Slice 图像坐标"""
@@ -1380,7 +5209,7 @@ class NiiViewerApp:
              
         disp_w, disp_h = self.current_disp_size
         
-        # 获取 Panel 尺寸来计算居中偏移 (Tkinter Label 默认居中显示图像)
+        # 获取 Panel 尺寸来计算居中偏移 (ImagePanel 居中显示图像)
         # 这里使用 panel_right 的尺寸，因为编辑主要在右侧进行
         # 如果将来需要在左侧编辑，需要传入 widget 参数区分
         p_w = self.panel_right.winfo_width()
@@ -1428,7 +5257,7 @@ class NiiViewerApp:
         if event.widget != self.panel_right:
             if self.preview_cursor_pos is not None:
                 self.preview_cursor_pos = None
-                self.update_display()
+                self.refresh_preview()
             return
             
         # 注意: 这里我们需要 View 的尺寸来做坐标转换
@@ -1442,34 +5271,53 @@ class NiiViewerApp:
         if not (0 <= img_x < view_w and 0 <= img_y < view_h):
              if self.preview_cursor_pos is not None:
                  self.preview_cursor_pos = None
-                 self.update_display()
+                 self.refresh_preview()
              return
 
-        # 更新预览位置并请求重绘
+        # 更新预览位置 (像素未变化时跳过)
+        if self.preview_cursor_pos == (img_x, img_y):
+            return
         self.preview_cursor_pos = (img_x, img_y)
-        self.update_display()
+        self.refresh_preview()
 
     def on_mouse_leave(self, event):
         """鼠标离开控件"""
         if self.preview_cursor_pos is not None:
             self.preview_cursor_pos = None
+            self.refresh_preview()
+
+    def refresh_preview(self):
+        """刷新工具预览：魔棒需要重新合成图像，其余工具只移动 Canvas 光标"""
+        if self.current_tool.get() == "wand":
             self.update_display()
+        else:
+            self.update_brush_cursor()
 
     def on_mouse_down(self, event):
         """处理鼠标按下: 如果是编辑模式则开始绘制，否则平移"""
         if self.edit_mode.get() and self.editable_mask is not None:
             # 判断是否点击在右侧面板 (或双窗模式下的右半屏)
             if event.widget == self.panel_right:
-                self.start_edit_action() # 准备 Undo 栈
+                if self.is_task_running("volume_edit"):
+                    self.status_msg.set("3D 编辑正在后台执行，请稍候...")
+                    return
 
                 # 获取坐标并检查边界
                 idx = self.current_slice_index
                 mri_view = self.get_slice_view(self.current_case_data['mri'], idx)
                 view_h, view_w = mri_view.shape
                 img_x, img_y = self.screen_to_image_coords(event.x, event.y, view_w, view_h)
+                tool = self.current_tool.get()
+                in_bounds = 0 <= img_x < view_w and 0 <= img_y < view_h
+
+                if in_bounds and tool in ("wand", "fill") and self.volume_tool_mode.get():
+                    # 3D 模式：整卷区域生长/填充，在后台执行，撤销栈由完成回调写入
+                    self.apply_volume_tool(tool, img_x, img_y)
+                    return
+
+                self.start_edit_action() # 准备 Undo 栈
 
-                if 0 <= img_x < view_w and 0 <= img_y < view_h:
-                    tool = self.current_tool.get()
+                if in_bounds:
                     if tool == "fill":
                          # 填充模式：单次点击触发
                          self.apply_flood_fill(img_x, img_y)
@@ -1536,8 +5384,11 @@ class NiiViewerApp:
         # 因为后续恢复时是直接覆盖 3D array 的这一层
         current_slice_data = self.editable_mask[:, :, idx].copy()
         
-        self.undo_stack.append((idx, current_slice_data))
-        # 限制栈大小
+        self.push_undo(('slice', idx, current_slice_data))
+
+    def push_undo(self, entry):
+        """压入撤销栈并限制栈大小"""
+        self.undo_stack.append(entry)
         if len(self.undo_stack) > 20:
             self.undo_stack.pop(0)
 
@@ -1546,13 +5397,18 @@ class NiiViewerApp:
         if not self.undo_stack:
             return
             
-        idx, old_data = self.undo_stack.pop()
-        
+        entry = self.undo_stack.pop()
+        if entry[0] == 'slice':
+            slices = [(entry[1], entry[2])]
+        else: # 'slices': 3D 操作作为一个整体撤销
+            slices = entry[1]
+
         # 恢复数据
-        self.editable_mask[:, :, idx] = old_data
+        for idx, old_data in slices:
+            self.editable_mask[:, :, idx] = old_data
         
-        # 如果当前就在这个切片，刷新显示
-        if idx == self.current_slice_index:
+        # 如果当前就在这些切片中，刷新显示
+        if any(idx == self.current_slice_index for idx, _ in slices):
             self.update_display()
 
     def invert_current_slice_labels(self):
@@ -1597,26 +5453,130 @@ class NiiViewerApp:
             return
 
         src = self.editable_mask
-        target_mask = (src == target_label)
-        if not np.any(target_mask):
+        num_slices = src.shape[2]
+        present = [bool(np.any(src[:, :, z] == target_label)) for z in range(num_slices)]
+        if not any(present):
             self.status_msg.set(f"当前数据中不存在 Label {target_label}，未执行反转")
             self.status_color.set("red")
             self.root.event_generate("<<UpdateStatusColor>>")
             return
 
-        # 仅反转目标标签体素，其他标签保持不变
-        reversed_target_mask = target_mask[:, :, ::-1]
-        dst = src.copy()
-        dst[target_mask] = 0
-        dst[reversed_target_mask] = target_label
-        self.editable_mask = dst
-        self.undo_stack.clear()  # 当前撤销栈仅支持单切片，避免跨序列错误撤销
+        # 仅反转目标标签体素，其他标签保持不变；逐层计算，只写入发生变化的切片
+        new_slices = {}
+        for z in range(num_slices):
+            mirror_z = num_slices - 1 - z
+            if not present[z] and not present[mirror_z]:
+                continue
+            cur = src[:, :, z]
+            cur_target = (cur == target_label)
+            mirror_target = (src[:, :, mirror_z] == target_label)
+            if np.array_equal(cur_target, mirror_target):
+                continue
+            dst = cur.copy()
+            dst[cur_target] = 0
+            dst[mirror_target] = target_label
+            new_slices[z] = dst
+
+        if new_slices:
+            self.push_undo(('slices', [(z, src[:, :, z].copy()) for z in sorted(new_slices)]))
+            for z, dst in new_slices.items():
+                src[:, :, z] = dst
 
         self.status_msg.set(f"已反转 Label {target_label} 序列 (0..N-1 -> N-1..0)")
         self.status_color.set("blue")
         self.root.event_generate("<<UpdateStatusColor>>")
         self.update_display()
 
+    def interpolate_label_slices(self):
+        """
+        基于形状 (有符号距离图) 在已标注切片之间插值，填补中间未标注的切片
+        已标注切片只取本次编辑中修改过且含该标签的切片，原始 Pred/GT 中的切片不作为插值端点
+        """
+        if not self.edit_mode.get():
+            return
+        if self.editable_mask is None:
+            messagebox.showwarning("警告", "没有可编辑的标签数据")
+            return
+        if self.is_task_running("volume_edit"):
+            self.status_msg.set("3D 编辑正在后台执行，请稍候...")
+            return
+
+        mask_data = self.editable_mask
+        spacing = self.current_voxel_sizes[:2]
+        edited = np.asarray(mask_data.modified_slices(), dtype=np.int64)
+        if edited.size < 2:
+            self.status_msg.set("层间插值: 至少需要手动编辑过两个切片")
+            return
+        if not messagebox.askyesno("层间插值",
+                                   f"将在本次编辑中修改过的 {edited.size} 个切片之间插值：\n"
+                                   "对每个标签，只有两侧都是修改过且含该标签的切片时，才填补其间的切片；\n"
+                                   "未修改的原始切片不作为插值端点，只填充背景，不覆盖其他标签。\n\n是否继续？"):
+            return
+
+        def worker(progress):
+            progress(None, "层间插值: 统计已标注切片...")
+            labels = [int(v) for v in mask_data.unique_values() if v != 0]
+            new_slices = {} # z -> 插值后的切片 (仅包含有变化的切片)
+
+            for li, label in enumerate(labels):
+                label_mask = mask_data.equal_to(label)
+                # 只以手动修改过的切片为端点，避免把原始分割中相邻的切片当作已标注
+                annotated = edited[label_mask[:, :, edited].any(axis=(0, 1))]
+                gaps = [(a, b) for a, b in zip(annotated[:-1], annotated[1:]) if b - a > 1]
+                if not gaps:
+                    continue
+
+                # 所有已标注切片的联合包围盒 (外扩 1 像素保证含背景)，距离图只在该区域内计算
+                plane_any = label_mask[:, :, annotated].any(axis=2)
+                xs = np.flatnonzero(plane_any.any(axis=1))
+                ys = np.flatnonzero(plane_any.any(axis=0))
+                x0, x1 = xs[0], xs[-1] + 1
+                y0, y1 = ys[0], ys[-1] + 1
+                stack = np.moveaxis(label_mask[x0:x1, y0:y1, annotated], 2, 0)
+                stack = np.pad(stack, ((0, 0), (1, 1), (1, 1)), mode="constant", constant_values=False)
+
+                # 各已标注切片的有符号距离图一次性批量计算 (仅在切片平面内)
+                sdt = signed_distance(stack, (1.0,) + tuple(spacing), axes=(1, 2))
+                position = {int(z): i for i, z in enumerate(annotated)}
+
+                for a, b in gaps:
+                    sd_a = sdt[position[int(a)]]
+                    sd_b = sdt[position[int(b)]]
+                    for z in range(a + 1, b):
+                        t = (z - a) / (b - a)
+                        inside = ((1.0 - t) * sd_a + t * sd_b)[1:-1, 1:-1] < 0
+                        if not inside.any():
+                            continue
+                        slice_data = new_slices.get(z)
+                        if slice_data is None:
+                            slice_data = mask_data[:, :, z].copy()
+                        region = slice_data[x0:x1, y0:y1]
+                        # 只填充背景，不覆盖其他标签
+                        fill = inside & (region == 0)
+                        if fill.any():
+                            region[fill] = label
+                            new_slices[z] = slice_data
+                progress((li + 1) / len(labels), f"层间插值: Label {label} 完成")
+            return new_slices
+
+        def on_done(new_slices):
+            if mask_data is not self.editable_mask:
+                return
+            if not new_slices:
+                self.status_msg.set("层间插值: 没有需要填补的切片")
+                return
+            touched = sorted(new_slices)
+            self.push_undo(('slices', [(z, mask_data[:, :, z].copy()) for z in touched]))
+            for z in touched:
+                mask_data[:, :, z] = new_slices[z]
+
+            self.status_msg.set(f"层间插值完成: 填补 {len(touched)} 个切片 (可一次撤销)")
+            self.status_color.set("blue")
+            self.root.event_generate("<<UpdateStatusColor>>")
+            self.update_display()
+
+        self.run_background_task("volume_edit", worker, on_done)
+
     def get_tool_mask(self, tool, img_x, img_y, mri_view):
         """
         计算当前工具产生的 Mask (View 坐标系)
@@ -1770,6 +5730,71 @@ class NiiViewerApp:
             mask_view[change_mask] = target_val
             self.set_slice_view(self.editable_mask, idx, mask_view)
 
+    def view_to_voxel(self, img_x, img_y, idx):
+        """将当前 Radiological 视图坐标映射回原始 3D (RAS) 体素坐标"""
+        shape_x, shape_y = self.current_case_data['mri'].shape[:2]
+        # 对平面索引图施加与显示相同的变换，读出视图坐标处的原始平面位置
+        index_plane = np.arange(shape_x * shape_y).reshape(shape_x, shape_y, 1)
+        flat_index = int(self.get_slice_view(index_plane, 0)[img_y, img_x])
+        x, y = divmod(flat_index, shape_y)
+        return x, y, idx
+
+    def apply_volume_tool(self, tool, img_x, img_y):
+        """3D 魔棒 / 3D 填充：在后台计算整卷连通区域，完成后作为单步可撤销操作写入"""
+        if self.editable_mask is None:
+            return
+
+        seed = self.view_to_voxel(img_x, img_y, self.current_slice_index)
+        connectivity = self.volume_connectivity.get()
+        target_val = self.edit_label_val.get()
+        mask_data = self.editable_mask
+
+        if tool == "wand":
+            mri_data = self.current_case_data['mri']
+            seed_val = float(mri_data[seed])
+            tolerance = self.wand_tolerance.get()
+            title = "3D 魔棒"
+        else:
+            old_val = int(mask_data[seed])
+            if old_val == target_val:
+                return
+            title = "3D 填充"
+
+        def worker(progress):
+            progress(None, f"{title}: 计算中 (种子 {seed}, {connectivity} 邻域)...")
+            if tool == "wand":
+                # 按最后一轴分块阈值化，限制浮点临时数组的内存
+                binary = np.empty(mri_data.shape, dtype=bool)
+                step = max(1, (1 << 22) // max(1, mri_data.shape[0] * mri_data.shape[1]))
+                for z0 in range(0, mri_data.shape[2], step):
+                    slab = mri_data[:, :, z0:z0 + step]
+                    binary[:, :, z0:z0 + step] = np.abs(slab - seed_val) <= tolerance
+            else:
+                binary = mask_data.equal_to(old_val)
+            return flood_fill_3d(binary, seed, connectivity)
+
+        def on_done(region):
+            if mask_data is not self.editable_mask:
+                return
+            changed = region & ~mask_data.equal_to(target_val)
+            touched = np.flatnonzero(changed.any(axis=(0, 1)))
+            if touched.size == 0:
+                self.status_msg.set(f"{title}: 无需修改")
+                return
+
+            self.push_undo(('slices', [(int(z), mask_data[:, :, z].copy()) for z in touched]))
+            for z in touched:
+                slice_data = mask_data[:, :, z].copy()
+                slice_data[changed[:, :, z]] = target_val
+                mask_data[:, :, z] = slice_data
+
+            self.status_msg.set(f"{title}完成: {int(changed.sum())} 体素, 涉及 {touched.size} 个切片 (可一次撤销)")
+            self.status_color.set("blue")
+            self.root.event_generate("<<UpdateStatusColor>>")
+            self.update_display()
+
+        self.run_background_task("volume_edit", worker, on_done)
+
     def region_grow_optimize(self, img, mask, seed_x, seed_y, tolerance):
         """
         优化的区域生长/泛洪填充算法
@@ -1819,14 +5844,17 @@ class NiiViewerApp:
         if self.editable_mask is None:
             messagebox.showwarning("警告", "没有可导出的编辑数据")
             return
+        if self.is_task_running("export"):
+            messagebox.showwarning("警告", "上一次导出尚未完成，请稍候")
+            return
             
-        # 检查是否有选中的case
+        # 导出对象是当前已加载的病例，而不是列表中高亮的行 (增量查找只高亮不加载)
         try:
-            selection = self.case_listbox.curselection()
-            if not selection:
-                messagebox.showwarning("警告", "请先选择一个病例")
+            index = self.current_case_index
+            if index is None:
+                messagebox.showwarning("警告", "请先加载一个病例")
                 return
-            current_case = self.valid_cases[selection[0]]
+            current_case = self.valid_cases[index]
         except (IndexError, TypeError):
             messagebox.showerror("错误", "无法获取当前病例信息")
             return
@@ -1865,30 +5893,53 @@ class NiiViewerApp:
         if os.path.exists(file_path):
             if not messagebox.askyesno("覆盖确认", f"文件 {filename} 在 EditLabelTrs 中已存在。\n是否覆盖？", icon='warning'):
                 return
-            
-        try:
-            # 导出时恢复到原始 MRI 方向，保证方向码与原始数据一致
-            ref_img_raw = nib.load(current_case['mri_path'])
-            ref_img_canonical = nib.as_closest_canonical(ref_img_raw)
-
-            raw_ornt = nib.orientations.io_orientation(ref_img_raw.affine)
-            canonical_ornt = nib.orientations.io_orientation(ref_img_canonical.affine)
-            canonical_to_raw = nib.orientations.ornt_transform(canonical_ornt, raw_ornt)
 
-            export_data_canonical = self.editable_mask.astype(np.uint8)
+        # 在 UI 线程取快照，后台线程只处理这份副本，导出期间可继续编辑
+        export_data_canonical = self.editable_mask.to_array(np.uint8)
+        num_modified = len(self.editable_mask.modified_slices())
+        ref_affine = self.current_case_data['ref_affine']
+        ref_header = self.current_case_data['ref_header'].copy()
+        canonical_to_raw = self.current_case_data['canonical_to_raw']
+        compress_level = int(np.clip(self.export_compress_level.get(), 1, 9))
+        journal = self.edit_journal
+        journal_seq = journal.seq if journal is not None else None
+
+        def worker(progress):
+            progress(0.0, f"正在导出: {filename} ...")
+            # 导出时恢复到原始 MRI 方向，保证方向码与原始数据一致 (方向变换在加载时已记录)
             export_data_raw = nib.orientations.apply_orientation(export_data_canonical, canonical_to_raw)
-
-            new_img = nib.Nifti1Image(export_data_raw, ref_img_raw.affine, header=ref_img_raw.header.copy())
+            new_img = nib.Nifti1Image(export_data_raw, ref_affine, header=ref_header)
             new_img.set_data_dtype(np.uint8)
-            nib.save(new_img, file_path)
-            
-            self.status_msg.set(f"成功导出: {filename} 至 EditLabelTrs")
+            new_img.update_header()
+            header = new_img.header
+            header.set_slope_inter(1.0, 0.0) # uint8 原样写出，与 to_bytes 结果一致
+            head = io.BytesIO()
+            header.write_to(head)
+            offset = int(header.get_data_offset())
+
+            def chunks():
+                # 头部之后按 Fortran 顺序逐个 z 板块写出数据，不生成整份未压缩的 NIfTI
+                yield head.getvalue().ljust(offset, b"\0")
+                step = max(1, (1 << 22) // max(1, export_data_raw.shape[0] * export_data_raw.shape[1]))
+                for z0 in range(0, export_data_raw.shape[2], step):
+                    yield export_data_raw[:, :, z0:z0 + step].tobytes(order="F")
+
+            write_gzip_parallel(chunks(), file_path, level=compress_level, progress=progress,
+                                total=offset + export_data_raw.nbytes)
+
+        def on_done(_):
+            # 导出后未再编辑，则日志中的内容都已保存，清空日志
+            if journal is not None and journal is self.edit_journal and journal.seq == journal_seq:
+                journal.reset()
+            self.status_msg.set(f"成功导出: {filename} 至 EditLabelTrs (已修改 {num_modified} 个切片)")
             self.status_color.set("blue")
             self.root.event_generate("<<UpdateStatusColor>>")
-            
-        except Exception as e:
+
+        def on_error(e):
             messagebox.showerror("导出失败", f"保存文件时出错:\n{e}")
 
+        self.run_background_task("export", worker, on_done, case_bound=False, on_error=on_error)
+
     def on_scroll(self, event):
         """处理鼠标滚轮事件"""
         # 如果按下了 Control 键，则不进行切片切换 (避免与缩放冲突)
@@ -1961,6 +6012,154 @@ class NiiViewerApp:
             self.slice_scale.set(new_index) # 更新滑动条
             self.update_display()
 
+    def goto_slice(self, index):
+        """跳到 S 轴第 index 层 (RAS 模式下为 S 窗)"""
+        if self.layout_mode.get() == "ras":
+            self.ras_index_s = index
+        else:
+            self.current_slice_index = index
+        self.slice_scale.set(index)
+        self.update_display()
+
+    def format_metrics_text(self, overlap, surface=None, error=False):
+        """侧边栏指标文本；surface 为 None 时表面距离指标显示为计算中，error 为 True 时显示计算失败"""
+        blocks = []
+        for label, (dice, iou) in ((1, overlap[:2]), (2, overlap[2:])):
+            text = f"Label {label}:\n  Dice: {dice:.4f}\n  IoU : {iou:.4f}\n"
+            if error:
+                text += "  HD95: 计算失败"
+            elif surface is None:
+                text += "  HD95: 计算中..."
+            else:
+                text += (f"  HD95: {format_metric(surface[f'hd95_{label}'], '.2f', ' mm')}\n"
+                         f"  ASSD: {format_metric(surface[f'assd_{label}'], '.2f', ' mm')}\n"
+                         f"  NSD : {format_metric(surface[f'nsd_{label}'], '.4f')}")
+            blocks.append(text)
+        return "\n\n".join(blocks)
+
+    def update_surface_metrics(self, case, overlap):
+        """
+        表面距离指标 (HD95 / ASSD / 表面 Dice)：病例指标表中已有且文件未变时直接使用，否则后台计算
+        计算只在两者并集的外接框内进行，与病例指标表的批量结果一致
+        """
+        record = self.metric_table.get(case) if self.metric_table else None
+        if record and record.get('stamps') == case_file_stamps(case) and 'hd95_1' in record.get('metrics', {}):
+            self.metrics_text.set(self.format_metrics_text(overlap, record['metrics']))
+            return
+        data = self.current_case_data
+        pred, gt = data['pred'], data['gt']
+        spacing = self.current_voxel_sizes
+
+        def worker(progress):
+            progress(None, "计算表面距离指标...")
+            with self.profiler.stage("surface_metrics", "load"):
+                return surface_metrics(pred, gt, spacing, tolerance=SURFACE_DICE_TOLERANCE)
+
+        def on_done(metrics):
+            self.metrics_text.set(self.format_metrics_text(overlap, metrics))
+
+        def on_error(e):
+            self.metrics_text.set(self.format_metrics_text(overlap, error=True))
+            self.status_msg.set(f"表面距离指标计算失败: {e}")
+            self.status_color.set("red")
+            self.root.event_generate("<<UpdateStatusColor>>")
+
+        self.run_background_task(f"surface_metrics:{self.case_token}", worker, on_done, on_error=on_error)
+
+    def build_label_index(self):
+        """后台计算当前病例的逐层标签索引；期间的编辑在完成后按修改过的层补齐"""
+        data = self.current_case_data
+        pred, gt = data.get('pred'), data.get('gt')
+        n_slices = data['mri'].shape[2]
+
+        def worker(progress):
+            return LabelSliceIndex.build(n_slices, pred, gt)
+
+        def on_done(index):
+            self.label_index = index
+            mask = self.editable_mask
+            if mask is not None:
+                index.copy_source(self.edit_source, 'edit')
+                for z in mask.modified_slices():
+                    self.on_mask_slice_changed(z, None, mask.get_slice(z))
+            self.refresh_slice_minimap()
+
+        def on_error(e):
+            self.status_msg.set(f"标签索引计算失败: {e}")
+
+        self.run_background_task(f"label_index:{self.case_token}", worker, on_done, on_error=on_error)
+
+    def on_mask_slice_changed(self, z, old, new):
+        """编辑 Mask 第 z 层变化：增量更新标签索引 (编辑 GT 时同时更新与 Pred 的不一致数)"""
+        index = self.label_index
+        if index is None:
+            return # 索引完成时会按修改过的层补齐
+        index.update_slice('edit', z, new)
+        pred = self.current_case_data.get('pred')
+        if self.edit_source == 'gt' and pred is not None and index.disagree is not None:
+            index.disagree[z] = np.count_nonzero(pred[:, :, z] != new)
+        if self._minimap_source == 'edit':
+            self.slice_minimap.update_slice(z, sum(int(c[z]) for c in index.counts['edit'].values()),
+                                            None if index.disagree is None else int(index.disagree[z]))
+
+    def refresh_slice_minimap(self):
+        """按当前显示的标签 (编辑模式下为编辑 Mask，否则 GT 优先) 重设热度条"""
+        index = self.label_index
+        if index is None:
+            self._minimap_source = None
+            self.slice_minimap.clear()
+            return
+        if self.edit_mode.get() and self.editable_mask is not None:
+            source = 'edit'
+        else:
+            source = 'gt' if 'gt' in index.counts else 'pred'
+        self._minimap_source = source
+        self.slice_minimap.set_data(index.total(source), index.disagree)
+
+    def label_nav_sources(self):
+        """导航依据当前显示的标签：编辑模式下为 Pred + 编辑 Mask，否则为 Pred + GT"""
+        if self.edit_mode.get() and self.editable_mask is not None:
+            return ('pred', 'edit')
+        return ('pred', 'gt')
+
+    def jump_label_slice(self, direction, disagreement=False):
+        """跳到下一个/上一个含标签 (disagreement=True 时为 Pred/GT 不一致) 的层"""
+        if not self.current_case_data:
+            return
+        index = self.label_index
+        if index is None:
+            self.status_msg.set("标签索引计算中，请稍候...")
+            return
+        if disagreement and index.disagree is None:
+            self.status_msg.set("需要同时有 Pred 与 GT 才能按不一致导航")
+            return
+
+        sources = self.label_nav_sources()
+        present = index.disagreement() if disagreement else index.presence(sources)
+        current = self.ras_index_s if self.layout_mode.get() == "ras" else self.current_slice_index
+        target = LabelSliceIndex.find_next(present, current, direction)
+        if target is None:
+            what = "Pred/GT 不一致" if disagreement else "标签"
+            self.status_msg.set(f"{'之后' if direction > 0 else '之前'}没有含{what}的层")
+            return
+        self.goto_slice(target)
+
+        # 状态栏: 该层各来源的标签体素数及其在 S 轴上的范围
+        names = {'pred': "Pred", 'gt': "GT", 'edit': "Edit"}
+        parts = []
+        for source in sources:
+            items = []
+            for label in index.labels([source]):
+                count = int(index.counts[source][label][target])
+                if count:
+                    z0, z1 = index.bbox(source, label)[4:]
+                    items.append(f"L{label} {count} (S {z0 + 1}-{z1 + 1})")
+            if items:
+                parts.append(f"{names[source]}: {', '.join(items)}")
+        if index.disagree is not None:
+            parts.append(f"不一致 {int(index.disagree[target])} 体素")
+        self.status_msg.set(f"S {target + 1}/{index.n_slices}  " + "  |  ".join(parts))
+
     def on_slider_change(self, val):
         """处理滑动条拖动"""
         if not self.current_case_data:
@@ -1978,8 +6177,8 @@ class NiiViewerApp:
             self.update_display()
 
     def move_case(self, delta):
-        """键盘快速切换病例（↑/↓）"""
-        total = len(self.valid_cases)
+        """键盘快速切换病例（↑/↓），按列表当前的排序/筛选顺序"""
+        total = self.case_listbox.size()
         if total <= 0:
             return
 
@@ -1993,9 +6192,7 @@ class NiiViewerApp:
         if not (0 <= new_index < total):
             return
 
-        self.case_listbox.selection_clear(0, tk.END)
         self.case_listbox.selection_set(new_index)
-        self.case_listbox.activate(new_index)
         self.case_listbox.see(new_index)
         self.load_selected_case(None)
 
@@ -2038,7 +6235,7 @@ class NiiViewerApp:
                 
                 # 如果有预览光标，立即刷新以显示新大小
                 if self.preview_cursor_pos:
-                    self.update_display()
+                    self.update_brush_cursor()
                 return
 
         if not self.current_case_data:
@@ -0,0 +1,251 @@
+"""
+批量 QC 报告 (无需显示器)
+
+对数据集中每个病例，用 nii_viewer.SliceRenderer 的真实渲染代码离屏生成拼图 PNG:
+行为 S/A/R 三个方向的中间层，以及 Pred/GT 不一致体素最多的层 (最差层)；
+列为 MRI + Pred、MRI + GT 与 Diff。同时计算 Dice/IoU 与 HD95/ASSD/表面 Dice。
+病例在进程池中并行处理，最后生成静态 HTML 报告。
+
+用法:
+    python src/qc_report.py /path/to/dataset -o qc_out
+    python src/qc_report.py /path/to/dataset -o qc_out --workers 16 --tile 192 --sort dice
+    python src/qc_report.py /path/to/dataset -o qc_out --sort hd95 --tolerance 2
+"""
+
+import argparse
+import html
+import json
+import os
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PIL import Image, ImageDraw
+
+from nii_viewer import (SURFACE_DICE_TOLERANCE, SliceRenderer, json_safe, load_case_volumes, scan_dataset,
+                        surface_metrics)
+
+AXES = ("S", "A", "R")
+AXIS_DIM = {"R": 0, "A": 1, "S": 2} # RAS 数组中各方向切片对应的维度
+COLUMNS = ("Pred", "GT", "Diff")
+LABEL_BAR = 18 # 每个小图顶部的文字栏高度
+
+
+def worst_slices(pred, gt):
+    """一次比较得到不一致掩码，再按三个方向求和，返回 {axis: (最差层号, 不一致体素数)}"""
+    diff = pred != gt
+    per_axis = {
+        "R": diff.sum(axis=(1, 2)),
+        "A": diff.sum(axis=(0, 2)),
+        "S": diff.sum(axis=(0, 1)),
+    }
+    return {axis: (int(counts.argmax()), int(counts.max())) for axis, counts in per_axis.items()}
+
+
+def render_tile(renderer, axis, idx, column, tile):
+    """渲染一个方向/层/列的小图，按物理长宽比缩放并居中放入 tile x tile"""
+    data = renderer.current_case_data
+    mri_slice = renderer.get_slice_view_axis(data['mri'], axis, idx)
+    pred_slice = renderer.get_slice_view_axis(data['pred'], axis, idx)
+    gt_slice = renderer.get_slice_view_axis(data['gt'], axis, idx)
+
+    if column == "Diff":
+        if pred_slice is None or gt_slice is None:
+            return None
+        img = renderer.create_diff_overlay(mri_slice, pred_slice, gt_slice)
+    else:
+        mask_slice = pred_slice if column == "Pred" else gt_slice
+        if mask_slice is None:
+            return None
+        img = renderer.create_overlay(mri_slice, mask_slice, True)
+
+    img = renderer.adjust_ras_physical_aspect(img, axis)
+    scale = min(tile / img.width, tile / img.height)
+    size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+    # 放大时用最近邻保持标签边界清晰，缩小时用双线性避免混叠
+    img = img.resize(size, Image.Resampling.NEAREST if scale >= 1 else Image.Resampling.BILINEAR)
+    out = Image.new("RGB", (tile, tile))
+    out.paste(img.convert("RGB"), ((tile - img.width) // 2, (tile - img.height) // 2))
+    return out
+
+
+def render_case(case, out_dir, tile=256, tolerance=SURFACE_DICE_TOLERANCE):
+    """
+    进程池任务：读取并渲染一个病例，保存拼图 PNG
+    :return: 报告记录 dict (失败时含 'error')
+    """
+    record = {'name': case['name'], 'has_pred': case['pred_path'] is not None,
+              'has_gt': case['gt_path'] is not None}
+    t0 = time.perf_counter()
+    try:
+        volumes = load_case_volumes(case)
+        renderer = SliceRenderer()
+        renderer.current_case_data = volumes
+        renderer.current_voxel_sizes = volumes['voxel_sizes']
+        mri, pred, gt = volumes['mri'], volumes['pred'], volumes['gt']
+        record['shape'] = list(mri.shape)
+        record['spacing'] = [round(v, 4) for v in volumes['voxel_sizes']]
+
+        rows = [(f"{axis} mid {mri.shape[AXIS_DIM[axis]] // 2}", axis, mri.shape[AXIS_DIM[axis]] // 2)
+                for axis in AXES]
+        if pred is not None and gt is not None:
+            d1, i1, d2, i2 = renderer.calculate_metrics(pred, gt)
+            record['metrics'] = {'dice1': d1, 'iou1': i1, 'dice2': d2, 'iou2': i2}
+            record['metrics'].update(surface_metrics(pred, gt, volumes['voxel_sizes'], tolerance=tolerance))
+            worst = worst_slices(pred, gt)
+            record['worst'] = {axis: list(worst[axis]) for axis in AXES}
+            for axis in AXES:
+                idx, count = worst[axis]
+                if count > 0:
+                    rows.append((f"{axis} worst {idx} ({count} vox)", axis, idx))
+
+        columns = [c for c in COLUMNS if c != "Diff" or (pred is not None and gt is not None)]
+        cell_h = tile + LABEL_BAR
+        montage = Image.new("RGB", (tile * len(columns), cell_h * len(rows)), (24, 24, 24))
+        draw = ImageDraw.Draw(montage)
+        for r, (title, axis, idx) in enumerate(rows):
+            for c, column in enumerate(columns):
+                x, y = c * tile, r * cell_h
+                draw.text((x + 4, y + 3), f"{column} | {title}", fill=(230, 230, 230))
+                img = render_tile(renderer, axis, idx, column, tile)
+                if img is None:
+                    draw.text((x + 4, y + LABEL_BAR + tile // 2), f"No {column}", fill=(160, 160, 160))
+                else:
+                    montage.paste(img, (x, y + LABEL_BAR))
+
+        png_name = f"{case['name']}.png"
+        # 低压缩级别：拼图数量多时编码耗时远大于文件体积的收益
+        montage.save(os.path.join(out_dir, "montages", png_name), compress_level=3)
+        record['png'] = f"montages/{png_name}"
+    except Exception as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+    record['seconds'] = round(time.perf_counter() - t0, 3)
+    return record
+
+
+def min_dice(record):
+    metrics = record.get('metrics')
+    return min(metrics['dice1'], metrics['dice2']) if metrics else float("inf")
+
+
+def max_hd95(record):
+    metrics = record.get('metrics')
+    return max(metrics['hd95_1'], metrics['hd95_2']) if metrics else float("-inf")
+
+
+SORT_TITLES = {"name": "名称", "dice": "最小 Dice 升序", "hd95": "最大 HD95 降序"}
+
+
+def write_html(records, out_dir, root_dir, sort_key):
+    """生成静态 HTML 报告 (图片懒加载，数千个病例也能直接在浏览器中打开)"""
+    if sort_key == "dice":
+        records = sorted(records, key=lambda r: (min_dice(r), r['name']))
+    elif sort_key == "hd95":
+        records = sorted(records, key=lambda r: (-max_hd95(r), r['name']))
+    else:
+        records = sorted(records, key=lambda r: r['name'])
+
+    failed = sum(1 for r in records if 'error' in r)
+    rows = []
+    for r in records:
+        name = html.escape(r['name'], quote=True)
+        metrics = r.get('metrics')
+        if metrics:
+            metric_text = (f"Dice1 {metrics['dice1']:.4f} / IoU1 {metrics['iou1']:.4f}<br>"
+                           f"Dice2 {metrics['dice2']:.4f} / IoU2 {metrics['iou2']:.4f}<br>"
+                           f"HD95 {metrics['hd95_1']:.2f} / {metrics['hd95_2']:.2f} mm<br>"
+                           f"ASSD {metrics['assd_1']:.2f} / {metrics['assd_2']:.2f} mm<br>"
+                           f"NSD {metrics['nsd_1']:.4f} / {metrics['nsd_2']:.4f}")
+        else:
+            missing = [label for label, ok in (("Pred", r['has_pred']), ("GT", r['has_gt'])) if not ok]
+            metric_text = f"缺少 {' / '.join(missing)}" if missing else ""
+        info = f"{r.get('shape', '')} @ {r.get('spacing', '')}" if 'shape' in r else ""
+        if 'error' in r:
+            body = f'<span class="error">{html.escape(r["error"])}</span>'
+        else:
+            # 病例名可能含 # % & 等字符，链接需按 URL 编码
+            src = html.escape(urllib.parse.quote(r["png"]), quote=True)
+            body = f'<a href="{src}"><img loading="lazy" src="{src}" alt="{name}"></a>'
+        rows.append(f'<tr id="{name}"><td><b>{name}</b><br><small>{html.escape(info)}</small><br>'
+                    f'{metric_text}</td><td>{body}</td></tr>')
+
+    page = f"""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+<meta charset="utf-8">
+<title>QC Report - {html.escape(os.path.basename(os.path.abspath(root_dir)))}</title>
+<style>
+body {{ font-family: sans-serif; background: #f0f0f0; margin: 20px; }}
+table {{ border-collapse: collapse; background: white; }}
+td {{ border: 1px solid #ccc; padding: 8px; vertical-align: top; }}
+td:first-child {{ min-width: 220px; font-family: monospace; }}
+img {{ max-width: 100%; }}
+.error {{ color: red; }}
+</style>
+</head>
+<body>
+<h2>QC Report</h2>
+<p>数据集: {html.escape(os.path.abspath(root_dir))}<br>
+病例数: {len(records)}，失败: {failed}，排序: {SORT_TITLES[sort_key]}</p>
+<table>
+{chr(10).join(rows)}
+</table>
+</body>
+</html>
+"""
+    path = os.path.join(out_dir, "index.html")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(page)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量生成 QC 拼图与 HTML 报告 (无需显示器)")
+    parser.add_argument("root_dir", help="数据根目录 (包含 imagesTr，可选 predictsTr / labelsTr)")
+    parser.add_argument("-o", "--output", default="qc_report", help="输出目录 (默认 qc_report)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="进程数 (默认 CPU 核数)")
+    parser.add_argument("--tile", type=int, default=256, help="拼图中每个小图的边长 (像素)")
+    parser.add_argument("--sort", choices=tuple(SORT_TITLES), default="name", help="报告排序方式")
+    parser.add_argument("--tolerance", type=float, default=SURFACE_DICE_TOLERANCE,
+                        help=f"表面 Dice 的距离容差 mm (默认 {SURFACE_DICE_TOLERANCE})")
+    parser.add_argument("--cases", help="只处理指定病例 (逗号分隔)")
+    args = parser.parse_args()
+
+    root_dir = args.root_dir
+    if not os.path.isdir(os.path.join(root_dir, "imagesTr")):
+        parser.error(f"未找到 {os.path.join(root_dir, 'imagesTr')}")
+    cases = scan_dataset(root_dir,
+                         os.path.isdir(os.path.join(root_dir, "predictsTr")),
+                         os.path.isdir(os.path.join(root_dir, "labelsTr")))
+    if args.cases:
+        wanted = set(args.cases.split(","))
+        cases = [case for case in cases if case['name'] in wanted]
+    if not cases:
+        print("未找到病例", file=sys.stderr)
+        return 1
+
+    os.makedirs(os.path.join(args.output, "montages"), exist_ok=True)
+    t0 = time.perf_counter()
+    records = []
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = [executor.submit(render_case, case, args.output, args.tile, args.tolerance) for case in cases]
+        for done, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            records.append(record)
+            if 'error' in record:
+                print(f"[{done}/{len(cases)}] {record['name']} 失败: {record['error']}", file=sys.stderr)
+            elif done % 50 == 0 or done == len(cases):
+                elapsed = time.perf_counter() - t0
+                print(f"[{done}/{len(cases)}] {elapsed:.1f}s, {done / elapsed:.1f} 例/秒", file=sys.stderr)
+
+    with open(os.path.join(args.output, "report.json"), "w", encoding="utf-8") as f:
+        json.dump(json_safe(sorted(records, key=lambda r: r['name'])), f, ensure_ascii=False, indent=1,
+                  allow_nan=False)
+    path = write_html(records, args.output, root_dir, args.sort)
+    print(f"报告已生成: {path} ({len(records)} 例，用时 {time.perf_counter() - t0:.1f}s)")
+    return 0 if all('error' not in r for r in records) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,519 @@
+"""
+本地切片/瓦片服务 (浏览器审阅，无需安装 Tk)
+
+复用 nii_viewer 的数据集扫描 (scan_dataset)、病例读取 (load_case_volumes) 与 SliceRenderer 的渲染代码
+(get_slice_view_axis / create_overlay / create_diff_overlay)，通过本地 HTTP 提供 PNG / WebP 切片与瓦片。
+编码结果按 ETag (病例文件大小/修改时间 + 请求参数) 缓存，浏览器重复请求直接返回 304；
+渲染在有界线程池中执行，相同请求并发到达时只渲染一次。
+
+用法:
+    python src/slice_server.py /path/to/dataset                 # 默认 http://127.0.0.1:8765/
+    python src/slice_server.py /path/to/dataset --port 9000 --workers 8 --cache-mb 512
+
+接口:
+    GET /                                              简易浏览页面
+    GET /api/cases                                     病例列表 (JSON)
+    GET /api/cases/{name}                              病例信息: shape、spacing、Dice/IoU (JSON)
+    GET /api/cases/{name}/slice/{axis}/{idx}.{png|webp}?layer=pred|gt|diff|none&gamma=1.0&size=512
+        整张切片 (按体素间距修正长宽比)；size 为最长边像素数，省略时为物理比例下的原始尺寸
+    GET /api/cases/{name}/tile/{axis}/{idx}/{level}/{tx}_{ty}.{png|webp}?layer=...&gamma=...
+        瓦片金字塔: level 0 为物理比例原始尺寸，level k 缩小 2^k 倍，按 256 像素切分
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from PIL import Image, features
+
+from nii_viewer import SliceRenderer, case_file_stamps, load_case_volumes, overlap_metrics, scan_dataset
+
+AXIS_DIM = {"R": 0, "A": 1, "S": 2} # RAS 数组中各方向切片对应的维度
+LAYERS = ("pred", "gt", "diff", "none")
+TILE = 256
+FORMATS = {"png": "image/png", "webp": "image/webp"}
+RENDER_TIMEOUT = 30.0 # 秒；排队 + 渲染超过该时间返回 503
+
+ROUTES = [
+    ("cases", re.compile(r"^/api/cases/?$")),
+    ("case", re.compile(r"^/api/cases/(?P<name>[^/]+)/?$")),
+    ("slice", re.compile(r"^/api/cases/(?P<name>[^/]+)/slice/(?P<axis>[RAS])/(?P<idx>\d+)\.(?P<fmt>png|webp)$")),
+    ("tile", re.compile(r"^/api/cases/(?P<name>[^/]+)/tile/(?P<axis>[RAS])/(?P<idx>\d+)/(?P<level>\d+)/"
+                        r"(?P<tx>\d+)_(?P<ty>\d+)\.(?P<fmt>png|webp)$")),
+]
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存，按 size_fn 计算的字节数限制总容量"""
+
+    def __init__(self, max_bytes, size_fn=len):
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn
+        self.items = OrderedDict() # key -> (value, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        nbytes = self.size_fn(value)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self.items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.nbytes -= evicted
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.items), 'mb': round(self.nbytes / 1024 ** 2, 1),
+                    'hits': self.hits, 'misses': self.misses}
+
+
+def volumes_nbytes(volumes):
+    return sum(volumes[key].nbytes for key in ('mri', 'pred', 'gt') if volumes[key] is not None)
+
+
+def composed_nbytes(item):
+    img = item[0]
+    return img.width * img.height * len(img.getbands())
+
+
+class SliceService:
+    """
+    与 HTTP 无关的渲染服务：病例体数据 LRU、合成切片 LRU、编码结果 LRU 三级缓存，
+    渲染任务在有界线程池中执行，相同 ETag 的并发请求合并为一次渲染
+    """
+
+    def __init__(self, root_dir, workers=4, cache_mb=256, volume_mb=2048):
+        self.root_dir = root_dir
+        self.cases = scan_dataset(root_dir,
+                                  os.path.isdir(os.path.join(root_dir, "predictsTr")),
+                                  os.path.isdir(os.path.join(root_dir, "labelsTr")))
+        self.case_by_name = {case['name']: case for case in self.cases}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="render")
+        self.encoded = LRUCache(cache_mb * 1024 ** 2 * 3 // 4, lambda item: len(item[0])) # etag -> (bytes, content_type)
+        self.composed = LRUCache(cache_mb * 1024 ** 2 // 4, composed_nbytes) # 瓦片共用同一张合成切片
+        self.volumes = LRUCache(volume_mb * 1024 ** 2, lambda item: volumes_nbytes(item[1]))
+        self.inflight = {} # etag -> Future
+        self.inflight_lock = threading.Lock()
+        self.case_locks = {} # name -> Lock，同一病例只读取一次
+        self.case_locks_lock = threading.Lock()
+        self.webp = features.check("webp")
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_case(self, name):
+        case = self.case_by_name.get(name)
+        if case is None:
+            raise HTTPError(404, f"未找到病例: {name}")
+        return case
+
+    def case_volumes(self, case):
+        """读取 (或从 LRU 取回) 病例体数据；文件变化后重新读取"""
+        stamps = case_file_stamps(case)
+        cached = self.volumes.get(case['name'])
+        if cached is not None and cached[0] == stamps:
+            return cached[1]
+        with self.case_locks_lock:
+            lock = self.case_locks.setdefault(case['name'], threading.Lock())
+        with lock:
+            cached = self.volumes.get(case['name'])
+            if cached is not None and cached[0] == stamps:
+                return cached[1]
+            volumes = load_case_volumes(case)
+            self.volumes.put(case['name'], (stamps, volumes))
+            return volumes
+
+    def etag(self, case, *params):
+        """ETag 由病例文件 (大小, mtime) 与渲染参数决定，文件未变时浏览器缓存一直有效"""
+        key = json.dumps([case['name'], case_file_stamps(case), params], separators=(",", ":"))
+        return '"' + hashlib.sha1(key.encode("utf-8")).hexdigest()[:24] + '"'
+
+    def case_info(self, case):
+        volumes = self.case_volumes(case)
+        info = {'name': case['name'], 'shape': list(volumes['mri'].shape),
+                'spacing': [round(v, 4) for v in volumes['voxel_sizes']],
+                'has_pred': volumes['pred'] is not None, 'has_gt': volumes['gt'] is not None}
+        if volumes['pred'] is not None and volumes['gt'] is not None:
+            d1, i1, d2, i2 = overlap_metrics(volumes['pred'], volumes['gt'])
+            info['metrics'] = {'dice1': d1, 'iou1': i1, 'dice2': d2, 'iou2': i2}
+        return json.dumps(info, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+
+    def run(self, etag, fn):
+        """
+        取编码缓存；未命中时提交到线程池，同一 ETag 的并发请求等待同一个 Future
+        :return: (body bytes, content_type)
+        """
+        cached = self.encoded.get(etag)
+        if cached is not None:
+            return cached
+        with self.inflight_lock:
+            future = self.inflight.get(etag)
+            if future is None:
+                future = self.inflight[etag] = self.executor.submit(self._run_and_cache, etag, fn)
+        try:
+            return future.result(timeout=RENDER_TIMEOUT)
+        except FutureTimeout:
+            raise HTTPError(503, "渲染队列繁忙，请稍后重试")
+
+    def _run_and_cache(self, etag, fn):
+        try:
+            result = fn()
+            self.encoded.put(etag, result)
+            return result
+        finally:
+            with self.inflight_lock:
+                self.inflight.pop(etag, None)
+
+    def parse_view(self, case, query):
+        layer = query.get("layer", "pred")
+        if layer not in LAYERS:
+            raise HTTPError(400, f"layer 必须为 {'/'.join(LAYERS)}")
+        try:
+            gamma = round(float(query.get("gamma", 1.0)), 3)
+        except ValueError:
+            raise HTTPError(400, "gamma 必须为数字")
+        if not 0.05 <= gamma <= 10:
+            raise HTTPError(400, "gamma 超出范围 (0.05 - 10)")
+        if layer in ("pred", "diff") and case['pred_path'] is None:
+            layer = "none" if layer == "pred" else "gt"
+        if layer in ("gt", "diff") and case['gt_path'] is None:
+            layer = "none" if layer == "gt" else "pred"
+        return layer, gamma
+
+    def check_format(self, fmt):
+        if fmt == "webp" and not self.webp:
+            raise HTTPError(415, "当前 Pillow 未编译 WebP 支持")
+
+    def compose(self, case, axis, idx, layer, gamma):
+        """
+        渲染一张原分辨率切片 (按体素间距修正长宽比)，同一切片的多个瓦片共用
+        :return: (PIL RGB 图像, 物理比例尺寸 (w, h))
+        """
+        key = (case['name'], json.dumps(case_file_stamps(case)), axis, idx, layer, gamma)
+        cached = self.composed.get(key)
+        if cached is not None:
+            return cached
+        volumes = self.case_volumes(case)
+        if not 0 <= idx < volumes['mri'].shape[AXIS_DIM[axis]]:
+            raise HTTPError(404, f"{axis} 切片号超出范围: {idx}")
+        renderer = SliceRenderer()
+        renderer.current_case_data = volumes
+        renderer.current_voxel_sizes = volumes['voxel_sizes']
+        renderer.gamma = gamma
+        mri_slice = renderer.get_slice_view_axis(volumes['mri'], axis, idx)
+        if layer == "diff":
+            img = renderer.create_diff_overlay(mri_slice, renderer.get_slice_view_axis(volumes['pred'], axis, idx),
+                                               renderer.get_slice_view_axis(volumes['gt'], axis, idx))
+        else:
+            mask_slice = renderer.get_slice_view_axis(volumes.get(layer), axis, idx) if layer != "none" else None
+            img = renderer.create_overlay(mri_slice, mask_slice, mask_slice is not None)
+        img = img.convert("RGB")
+        result = (img, renderer.ras_physical_size(img.width, img.height, axis))
+        self.composed.put(key, result)
+        return result
+
+    def render_slice(self, case, axis, idx, layer, gamma, size, fmt):
+        img, (phys_w, phys_h) = self.compose(case, axis, idx, layer, gamma)
+        scale = 1.0 if size is None else size / max(phys_w, phys_h)
+        out_size = (max(1, round(phys_w * scale)), max(1, round(phys_h * scale)))
+        return encode(resize(img, out_size), fmt)
+
+    def render_tile(self, case, axis, idx, layer, gamma, level, tx, ty, fmt):
+        img, (phys_w, phys_h) = self.compose(case, axis, idx, layer, gamma)
+        # 第 level 级图像尺寸 (物理比例尺寸缩小 2^level)，瓦片在该坐标系下按 TILE 切分
+        level_w = max(1, -(-phys_w // 2 ** level))
+        level_h = max(1, -(-phys_h // 2 ** level))
+        x0, y0 = tx * TILE, ty * TILE
+        if x0 >= level_w or y0 >= level_h:
+            raise HTTPError(404, "瓦片超出范围")
+        x1, y1 = min(x0 + TILE, level_w), min(y0 + TILE, level_h)
+        sx, sy = img.width / level_w, img.height / level_h
+        return encode(resize(img, (x1 - x0, y1 - y0), (x0 * sx, y0 * sy, x1 * sx, y1 * sy)), fmt)
+
+
+def resize(img, size, box=None):
+    """放大时用最近邻保持标签边界清晰，缩小时用双线性避免混叠"""
+    src_w = img.width if box is None else box[2] - box[0]
+    if box is None and size == img.size:
+        return img
+    resample = Image.Resampling.NEAREST if size[0] >= src_w else Image.Resampling.BILINEAR
+    return img.resize(size, resample, box=box)
+
+
+def encode(img, fmt):
+    buf = io.BytesIO()
+    if fmt == "webp":
+        img.save(buf, "WEBP", quality=90, method=2)
+    else:
+        # 低压缩级别：交互浏览时编码耗时比传输体积更关键
+        img.save(buf, "PNG", compress_level=1)
+    return buf.getvalue(), FORMATS[fmt]
+
+
+class SliceRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive，连续滚动时复用连接
+    service = None # SliceService，由 make_server 注入
+    verbose = False
+
+    def do_GET(self):
+        try:
+            self.handle_get()
+        except HTTPError as e:
+            self.send_body(e.status, json.dumps({'error': str(e)}, ensure_ascii=False).encode("utf-8"),
+                           "application/json; charset=utf-8")
+        except (BrokenPipeError, ConnectionResetError):
+            pass # 浏览器已取消请求 (快速滚动时常见)
+        except Exception as e:
+            self.send_body(500, json.dumps({'error': f"{type(e).__name__}: {e}"}, ensure_ascii=False).encode("utf-8"),
+                           "application/json; charset=utf-8")
+
+    def handle_get(self):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        service = self.service
+
+        if path in ("/", "/index.html"):
+            self.send_body(200, INDEX_HTML.encode("utf-8"), "text/html; charset=utf-8")
+            return
+        if path == "/api/stats":
+            stats = {'encoded': service.encoded.stats(), 'composed': service.composed.stats(),
+                     'volumes': service.volumes.stats()}
+            self.send_body(200, json.dumps(stats).encode("utf-8"), "application/json")
+            return
+
+        for route, pattern in ROUTES:
+            match = pattern.match(path)
+            if match:
+                break
+        else:
+            raise HTTPError(404, f"未知路径: {path}")
+        params = match.groupdict()
+
+        if route == "cases":
+            body = [{'name': c['name'], 'has_pred': c['pred_path'] is not None, 'has_gt': c['gt_path'] is not None}
+                    for c in service.cases]
+            self.send_body(200, json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+            return
+
+        case = service.get_case(params['name'])
+        if route == "case":
+            etag = service.etag(case, "info")
+            if self.not_modified(etag):
+                return
+            body, content_type = service.run(etag, lambda: service.case_info(case))
+            self.send_body(200, body, content_type, etag)
+            return
+
+        fmt = params['fmt']
+        service.check_format(fmt)
+        axis, idx = params['axis'], int(params['idx'])
+        layer, gamma = service.parse_view(case, query)
+        if route == "slice":
+            size = query.get("size")
+            try:
+                size = None if size is None else max(16, min(4096, int(size)))
+            except ValueError:
+                raise HTTPError(400, "size 必须为整数")
+            etag = service.etag(case, "slice", axis, idx, layer, gamma, size, fmt)
+            if self.not_modified(etag):
+                return
+            body, content_type = service.run(
+                etag, lambda: service.render_slice(case, axis, idx, layer, gamma, size, fmt))
+        else:
+            level, tx, ty = int(params['level']), int(params['tx']), int(params['ty'])
+            if level > 16:
+                raise HTTPError(404, "level 超出范围")
+            etag = service.etag(case, "tile", axis, idx, layer, gamma, level, tx, ty, fmt)
+            if self.not_modified(etag):
+                return
+            body, content_type = service.run(
+                etag, lambda: service.render_tile(case, axis, idx, layer, gamma, level, tx, ty, fmt))
+        self.send_body(200, body, content_type, etag)
+
+    def not_modified(self, etag):
+        if etag not in (tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")):
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return True
+
+    def send_body(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache") # 每次用 ETag 验证，文件更新后立即可见
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(root_dir, host="127.0.0.1", port=8765, workers=4, cache_mb=256, volume_mb=2048, verbose=False):
+    """创建服务 (port=0 时由系统分配端口，便于本机测试)；调用方负责 serve_forever() 与 server_close()"""
+    service = SliceService(root_dir, workers, cache_mb, volume_mb)
+    handler = type("Handler", (SliceRequestHandler,), {'service': service, 'verbose': verbose})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+INDEX_HTML = """<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+<meta charset="utf-8">
+<title>NIfTI Viewer - Slice Server</title>
+<style>
+body { font-family: sans-serif; background: #f0f0f0; margin: 0; display: flex; height: 100vh; }
+#side { width: 240px; padding: 10px; background: #fff; overflow: auto; }
+#cases div { padding: 2px 4px; cursor: pointer; font-family: monospace; }
+#cases div.sel { background: #cde; }
+#main { flex: 1; padding: 10px; display: flex; flex-direction: column; }
+#view { flex: 1; background: #000; display: flex; align-items: center; justify-content: center; }
+#img { max-width: 100%; max-height: 100%; image-rendering: pixelated; }
+</style>
+</head>
+<body>
+<div id="side"><input id="filter" placeholder="搜索病例" style="width: 95%"><div id="cases"></div></div>
+<div id="main">
+  <div>
+    方向 <select id="axis"><option>S</option><option>A</option><option>R</option></select>
+    图层 <select id="layer"><option>pred</option><option>gt</option><option>diff</option><option>none</option></select>
+    Gamma <input id="gamma" type="number" value="1.0" step="0.1" min="0.1" max="5" style="width: 4em">
+    <input id="slice" type="range" min="0" max="0" value="0" style="width: 40%">
+    <span id="info"></span>
+  </div>
+  <div id="view"><img id="img"></div>
+</div>
+<script>
+let cases = [], current = null, shape = null, loading = false, dirty = false;
+const $ = id => document.getElementById(id);
+const dims = {R: 0, A: 1, S: 2};
+
+function listCases() {
+  const q = $("filter").value.toLowerCase();
+  $("cases").innerHTML = "";
+  for (const c of cases) {
+    if (q && !c.name.toLowerCase().includes(q)) continue;
+    const div = document.createElement("div");
+    div.textContent = c.name;
+    if (c.name === current) div.className = "sel";
+    div.onclick = () => openCase(c.name);
+    $("cases").appendChild(div);
+  }
+}
+
+async function openCase(name) {
+  current = name;
+  listCases();
+  const info = await (await fetch("/api/cases/" + encodeURIComponent(name))).json();
+  shape = info.shape;
+  const m = info.metrics;
+  $("info").textContent = m ? `Dice1 ${m.dice1.toFixed(4)}  Dice2 ${m.dice2.toFixed(4)}` : "";
+  setAxis();
+}
+
+function setAxis() {
+  const n = shape[dims[$("axis").value]];
+  $("slice").max = n - 1;
+  $("slice").value = Math.floor(n / 2);
+  show();
+}
+
+// 上一张图片加载完成后才请求下一张 (最新优先)，快速拖动时不会堆积请求
+function show() {
+  if (!current) return;
+  if (loading) { dirty = true; return; }
+  loading = true;
+  const view = $("view");
+  const size = Math.min(view.clientWidth, view.clientHeight) * (window.devicePixelRatio || 1);
+  $("img").src = `/api/cases/${encodeURIComponent(current)}/slice/${$("axis").value}/${$("slice").value}.png` +
+    `?layer=${$("layer").value}&gamma=${$("gamma").value}&size=${Math.round(size)}`;
+}
+$("img").onload = $("img").onerror = () => { loading = false; if (dirty) { dirty = false; show(); } };
+
+$("slice").oninput = show;
+$("layer").onchange = show;
+$("gamma").onchange = show;
+$("axis").onchange = setAxis;
+$("filter").oninput = listCases;
+fetch("/api/cases").then(r => r.json()).then(data => { cases = data; listCases(); });
+</script>
+</body>
+</html>
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地切片/瓦片服务 (浏览器审阅)")
+    parser.add_argument("root_dir", help="数据根目录 (包含 imagesTr，可选 predictsTr / labelsTr)")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址 (默认仅本机 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="端口 (默认 8765)")
+    parser.add_argument("--workers", type=int, default=4, help="渲染线程数 (默认 4)")
+    parser.add_argument("--cache-mb", type=int, default=256, help="渲染结果缓存上限 (MB)")
+    parser.add_argument("--volume-mb", type=int, default=2048, help="已读取病例体数据缓存上限 (MB)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="打印每个请求")
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.root_dir, "imagesTr")):
+        parser.error(f"未找到 {os.path.join(args.root_dir, 'imagesTr')}")
+    t0 = time.perf_counter()
+    server = make_server(args.root_dir, args.host, args.port, args.workers, args.cache_mb, args.volume_mb,
+                         args.verbose)
+    host, port = server.server_address[:2]
+    print(f"{len(server.service.cases)} 个病例 (扫描 {time.perf_counter() - t0:.1f}s)，"
+          f"服务地址: http://{host}:{port}/  (Ctrl+C 退出)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
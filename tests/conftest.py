@@ -0,0 +1,5 @@
+import os
+import sys
+
+# src/ 下的模块以脚本方式组织 (无包结构)，测试时直接加入导入路径
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,129 @@
+"""并行 gzip 写出、自然排序、编辑日志与写时复制 mask"""
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+from nii_viewer import CopyOnWriteMask, EditJournal, natural_sort_key, write_gzip_parallel
+
+
+def sample_bytes(size, seed=0):
+    # 一半随机、一半重复，覆盖难压缩与易压缩两种块
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 256, size // 2, dtype=np.uint8).tobytes()
+    return noise + b"nii_viewer " * ((size - len(noise)) // 11 + 1)
+
+
+def test_write_gzip_parallel_bytes(tmp_path):
+    data = sample_bytes(300_000)
+    path = tmp_path / "out.gz"
+    write_gzip_parallel(data, str(path), block_size=1 << 14, workers=3)
+    assert gzip.decompress(path.read_bytes()) == data
+
+
+def test_write_gzip_parallel_chunk_iterable(tmp_path):
+    data = sample_bytes(200_003, seed=1)
+    # 片段大小与块大小不对齐，且含空片段
+    cuts = [0, 1, 5000, 5000, 70_001, 150_000, len(data)]
+    chunks = (data[a:b] for a, b in zip(cuts[:-1], cuts[1:]))
+    path = tmp_path / "stream.gz"
+    write_gzip_parallel(chunks, str(path), block_size=1 << 15, workers=2, total=len(data))
+    assert gzip.decompress(path.read_bytes()) == data
+
+
+def test_write_gzip_parallel_empty(tmp_path):
+    path = tmp_path / "empty.gz"
+    write_gzip_parallel(b"", str(path))
+    assert gzip.decompress(path.read_bytes()) == b""
+
+
+def test_natural_sort_key():
+    names = ["Case10", "case2", "Case1", "Case2_b", "Case02", "abc"]
+    assert sorted(names, key=natural_sort_key) == ["abc", "Case1", "Case02", "case2", "Case2_b", "Case10"]
+
+
+def random_slice(rng, shape, labels=(0, 1, 2)):
+    return rng.choice(labels, size=shape).astype(np.int8)
+
+
+def test_edit_journal_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    shape = (6, 5, 4)
+    base = random_slice(rng, shape)
+    mask = CopyOnWriteMask(base)
+    path = str(tmp_path / "journal" / "case.pred.journal")
+    journal = EditJournal(path, shape, "pred", flush_interval=60)
+    journal.start(reset=True)
+    mask.listeners.append(journal.record)
+    for z in (1, 3, 1, 0):
+        mask[:, :, z] = random_slice(rng, shape[:2])
+    journal.close()
+
+    records = EditJournal.read_records(path, shape, "pred")
+    assert len(records) == journal.seq
+    restored = CopyOnWriteMask(base)
+    EditJournal.replay(records, restored)
+    assert np.array_equal(restored.to_array(), mask.to_array())
+
+
+def test_edit_journal_header_mismatch_and_truncated_tail(tmp_path):
+    shape = (4, 4, 3)
+    path = str(tmp_path / "case.gt.journal")
+    journal = EditJournal(path, shape, "gt")
+    journal.start(reset=True)
+    journal.record(0, np.zeros(shape[:2]), np.ones(shape[:2]))
+    journal.record(2, np.zeros(shape[:2]), np.full(shape[:2], 2))
+    journal.close()
+
+    assert EditJournal.read_records(path, shape, "pred") is None
+    assert EditJournal.read_records(path, (4, 4, 5), "gt") is None
+    assert EditJournal.read_records(str(tmp_path / "missing.journal"), shape, "gt") is None
+
+    # 崩溃时写了一半的末尾记录被忽略
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        f.truncate(size - 3)
+    records = EditJournal.read_records(path, shape, "gt")
+    assert [z for z, _, _ in records] == [0]
+
+
+def test_copy_on_write_mask():
+    base = np.zeros((4, 3, 5), dtype=np.int8)
+    base[1, 1, 2] = 1
+    mask = CopyOnWriteMask(base)
+    events = []
+    mask.listeners.append(lambda z, old, new: events.append(z))
+
+    new = mask[:, :, 3].copy()
+    new[0, 0] = 2
+    mask[:, :, 3] = new
+    assert mask[0, 0, 3] == 2 and base[0, 0, 3] == 0
+    assert mask.modified_slices() == [3] and events == [3]
+    assert mask.unique_values() == [0, 1, 2]
+    expected = base.copy()
+    expected[0, 0, 3] = 2
+    assert np.array_equal(mask.to_array(), expected)
+    assert np.array_equal(mask.equal_to(2), expected == 2)
+
+    # 写回与源标签一致的内容时释放副本
+    mask[:, :, 3] = base[:, :, 3]
+    assert mask.modified_slices() == [] and mask.unique_values() == [0, 1]
+
+    with pytest.raises(ValueError):
+        mask[:, :, 2][0, 0] = 5 # 未修改的切片是源标签的只读视图
+    for key in ((slice(None), 0, 0), (slice(0, 2), slice(None), 1)):
+        with pytest.raises(TypeError):
+            mask[key]
+        with pytest.raises(TypeError):
+            mask[key] = 0
+    with pytest.raises(TypeError):
+        np.asarray(mask)
+
+
+def test_copy_on_write_mask_blank():
+    mask = CopyOnWriteMask(None, shape=(3, 3, 2))
+    assert mask.unique_values() == [0] and mask.to_array().dtype == np.int8
+    mask[:, :, 1] = np.full((3, 3), 1)
+    assert mask.unique_values() == [0, 1]
+    assert mask.equal_to(0).sum() == 9
@@ -0,0 +1,168 @@
+"""连通域 / 距离变换 / 表面距离指标：与逐体素暴力实现对照"""
+import itertools
+from collections import deque
+
+import numpy as np
+import pytest
+
+from nii_viewer import (_paint_runs, component_sizes, distance_transform_sq, flood_fill_3d, label_runs_3d,
+                        signed_distance, surface_metrics, surface_voxels)
+
+
+def neighbor_offsets(connectivity):
+    offsets = [d for d in itertools.product((-1, 0, 1), repeat=3) if any(d)]
+    if connectivity == 6:
+        offsets = [d for d in offsets if sum(map(abs, d)) == 1]
+    return offsets
+
+
+def brute_labels(binary, connectivity):
+    """逐体素 BFS 的连通域标记 (0 为背景)"""
+    labels = np.zeros(binary.shape, dtype=np.int64)
+    offsets = neighbor_offsets(connectivity)
+    n = 0
+    for start in zip(*np.nonzero(binary)):
+        if labels[start]:
+            continue
+        n += 1
+        labels[start] = n
+        queue = deque([start])
+        while queue:
+            p = queue.popleft()
+            for d in offsets:
+                q = tuple(a + b for a, b in zip(p, d))
+                if all(0 <= q[i] < binary.shape[i] for i in range(3)) and binary[q] and not labels[q]:
+                    labels[q] = n
+                    queue.append(q)
+    return labels
+
+
+def brute_sq_distance(features, spacing):
+    """各点到最近特征点的平方距离 (暴力枚举全部特征点)"""
+    points = np.argwhere(np.ones(features.shape, dtype=bool)) * np.asarray(spacing, dtype=np.float64)
+    feats = np.argwhere(features) * np.asarray(spacing, dtype=np.float64)
+    d2 = ((points[:, None, :] - feats[None, :, :]) ** 2).sum(axis=2)
+    return d2.min(axis=1).reshape(features.shape)
+
+
+def random_mask(seed, shape=(9, 8, 10), density=0.35):
+    return np.random.default_rng(seed).random(shape) < density
+
+
+@pytest.mark.parametrize("connectivity", [6, 26])
+@pytest.mark.parametrize("seed", range(4))
+def test_label_runs_3d_matches_bfs(connectivity, seed):
+    binary = random_mask(seed)
+    padded_shape, _, starts, ends, run_labels = label_runs_3d(binary, connectivity)
+    expected = brute_labels(binary, connectivity)
+
+    # 每个游程分量还原后应恰好是暴力标记中的一个连通域
+    components = np.unique(run_labels)
+    assert len(components) == expected.max()
+    for label in components:
+        selected = run_labels == label
+        mask = _paint_runs(padded_shape, starts[selected], ends[selected])
+        values = np.unique(expected[mask])
+        assert len(values) == 1 and values[0] > 0
+        assert np.array_equal(mask, expected == values[0])
+
+
+@pytest.mark.parametrize("connectivity", [6, 26])
+@pytest.mark.parametrize("seed", range(4))
+def test_flood_fill_3d_matches_bfs(connectivity, seed):
+    binary = random_mask(seed)
+    expected = brute_labels(binary, connectivity)
+    for point in np.argwhere(binary)[::7]:
+        point = tuple(int(v) for v in point)
+        assert np.array_equal(flood_fill_3d(binary, point, connectivity), expected == expected[point])
+
+
+def test_flood_fill_3d_diagonal_only_joins_with_26():
+    binary = np.zeros((3, 3, 3), dtype=bool)
+    binary[0, 0, 0] = binary[1, 1, 1] = True
+    assert flood_fill_3d(binary, (0, 0, 0), 6).sum() == 1
+    assert flood_fill_3d(binary, (0, 0, 0), 26).sum() == 2
+
+
+def test_flood_fill_3d_background_seed_is_empty():
+    binary = random_mask(0)
+    seed = tuple(int(v) for v in np.argwhere(~binary)[0])
+    result = flood_fill_3d(binary, seed)
+    assert result.shape == binary.shape and not result.any()
+
+
+def test_flood_fill_3d_run_cap():
+    # 棋盘格：每个体素都是单独的游程
+    binary = np.indices((6, 6, 6)).sum(axis=0) % 2 == 0
+    with pytest.raises(ValueError):
+        flood_fill_3d(binary, (0, 0, 0), 26, max_runs=10)
+    assert flood_fill_3d(binary, (0, 0, 0), 26, max_runs=binary.sum()).sum() == binary.sum()
+
+
+@pytest.mark.parametrize("connectivity", [6, 26])
+def test_component_sizes(connectivity):
+    binary = random_mask(5)
+    expected = np.bincount(brute_labels(binary, connectivity).reshape(-1))[1:]
+    assert np.array_equal(component_sizes(binary, connectivity), np.sort(expected)[::-1])
+    assert component_sizes(np.zeros((4, 4, 4), dtype=bool)).size == 0
+
+
+@pytest.mark.parametrize("spacing", [(1.0, 1.0, 1.0), (0.7, 1.3, 2.5)])
+def test_distance_transform_sq_matches_brute_force(spacing):
+    features = random_mask(1, shape=(7, 6, 8), density=0.05)
+    features[3, 2, 4] = True
+    assert np.allclose(distance_transform_sq(features, spacing), brute_sq_distance(features, spacing))
+
+
+def test_distance_transform_sq_axes_are_independent_planes():
+    features = random_mask(2, shape=(6, 7, 3), density=0.1)
+    features[0, 0, :] = True
+    result = distance_transform_sq(features, (0.8, 1.5, 1.0), axes=(0, 1))
+    for z in range(features.shape[2]):
+        plane = features[:, :, z:z + 1]
+        assert np.allclose(result[:, :, z], brute_sq_distance(plane, (0.8, 1.5, 1.0))[:, :, 0])
+
+
+def test_signed_distance_sign_and_magnitude():
+    mask = np.zeros((9, 9, 9), dtype=bool)
+    mask[2:7, 3:6, 1:8] = True
+    spacing = (1.0, 0.5, 2.0)
+    sd = signed_distance(mask, spacing)
+    assert np.all(sd[mask] < 0) and np.all(sd[~mask] > 0)
+    assert np.allclose(sd[~mask], np.sqrt(brute_sq_distance(mask, spacing))[~mask])
+    assert np.allclose(-sd[mask], np.sqrt(brute_sq_distance(~mask, spacing))[mask])
+
+
+def test_surface_metrics_empty_masks():
+    empty = np.zeros((5, 5, 5), dtype=np.uint8)
+    full = np.zeros_like(empty)
+    full[1:4, 1:4, 1:4] = 1
+    both = surface_metrics(empty, empty)
+    assert (both['hd95_1'], both['assd_1'], both['nsd_1']) == (0.0, 0.0, 1.0)
+    for pred, gt in ((empty, full), (full, empty)):
+        one = surface_metrics(pred, gt)
+        assert np.isinf(one['hd95_1']) and np.isinf(one['assd_1']) and one['nsd_1'] == 0.0
+        # Label 2 两侧都为空
+        assert (one['hd95_2'], one['assd_2'], one['nsd_2']) == (0.0, 0.0, 1.0)
+
+
+def test_surface_metrics_matches_brute_force():
+    rng = np.random.default_rng(3)
+    pred = np.zeros((12, 11, 10), dtype=np.uint8)
+    gt = np.zeros_like(pred)
+    pred[2:8, 3:9, 2:7] = 1
+    gt[3:10, 2:8, 3:8] = 1
+    pred[rng.random(pred.shape) < 0.02] = 1
+    spacing = (0.8, 1.0, 1.7)
+    tolerance = 1.0
+
+    surf_p = np.argwhere(surface_voxels(pred == 1)) * spacing
+    surf_g = np.argwhere(surface_voxels(gt == 1)) * spacing
+    d = np.sqrt(((surf_p[:, None, :] - surf_g[None, :, :]) ** 2).sum(axis=2))
+    d_pg, d_gp = d.min(axis=1), d.min(axis=0)
+
+    result = surface_metrics(pred, gt, spacing, tolerance=tolerance)
+    assert result['hd95_1'] == pytest.approx(max(np.percentile(d_pg, 95), np.percentile(d_gp, 95)))
+    assert result['assd_1'] == pytest.approx((d_pg.sum() + d_gp.sum()) / (d_pg.size + d_gp.size))
+    assert result['nsd_1'] == pytest.approx(((d_pg <= tolerance).sum() + (d_gp <= tolerance).sum())
+                                            / (d_pg.size + d_gp.size))